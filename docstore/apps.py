@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DocstoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'docstore'
+
+    def ready(self):
+        from . import cache, signals  # noqa: F401
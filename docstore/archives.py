@@ -0,0 +1,300 @@
+"""
+Exporting and importing the whole document store, for backups and for cloning
+one environment into another.
+
+An export is a stream of records, one JSON object per topic, folder and
+document, that refer to each other by their public IDs. Topics come first,
+then folders a level of the tree at a time, so that every folder comes after
+its parent, then documents. Folders and documents list the public IDs of their
+topics. Paths, search vectors and the document counters are not exported, as
+they are all rebuilt from the rest on import.
+
+Records are written either as newline-delimited JSON, which has no document
+contents and expects the blob store to be copied separately, or as a tar
+archive, which has the contents as one member per blob under blobs/, followed
+by the records in members of up to RECORDS_PER_MEMBER lines under records/.
+
+Both directions stream: rows are read from the database and written out a
+chunk at a time, and imports insert them BATCH_SIZE at a time as they are
+read, so memory use does not grow with the size of the store. Imports insert
+with COPY on Postgres and bulk_create() elsewhere.
+"""
+
+import io
+import tarfile
+import uuid
+from typing import BinaryIO, Dict, Iterator, Optional
+
+import orjson
+from django.db import connections, models, router
+
+from .models import Topic, Folder, FolderClosure, Document
+from .renderers import dumps
+from .search import update_search_vectors
+from .serializers import FastDocumentListingSerializer, FastFolderListingSerializer
+from .storage import get_blob_storage
+from .streaming import iterate
+
+FORMATS = ('ndjson', 'tar')
+
+# rows inserted per statement when importing
+BATCH_SIZE = 1000
+
+# records per records/ member of a tar archive, each of which is built in
+# memory as tar needs to know its size up front.
+RECORDS_PER_MEMBER = 10000
+
+# distinct content hashes read at a time when exporting blobs
+BLOB_BATCH_SIZE = 1000
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def export_records() -> Iterator[dict]:
+    topics = Topic.objects.order_by('pk').values('uuid', 'short_desc', 'full_desc')
+    for row in iterate(topics):
+        yield {'model': 'topic', 'id': row['uuid'], 'short_desc': row['short_desc'], 'full_desc': row['full_desc']}
+
+    # a level at a time: every folder's closure row from its root ancestor
+    # gives its depth.
+    folders = (Folder.objects
+               .filter(ancestor_links__ancestor__parent=None)
+               .annotate(depth=models.F('ancestor_links__depth'))
+               .order_by('depth', 'pk')
+               .values('id', 'uuid', 'name', 'parent__uuid'))
+    topics = FastFolderListingSerializer(fields=['topics'])
+    for row in iterate(folders, prefetch=topics.attach_related):
+        yield {'model': 'folder', 'id': row['uuid'], 'name': row['name'], 'parent': row['parent__uuid'], 'topics': row['topics']}
+
+    documents = Document.objects.order_by('pk').values('id', 'uuid', 'name', 'folder__uuid', 'content_hash', 'size')
+    topics = FastDocumentListingSerializer(fields=['topics'])
+    for row in iterate(documents, prefetch=topics.attach_related):
+        yield {
+            'model': 'document', 'id': row['uuid'], 'name': row['name'], 'folder': row['folder__uuid'],
+            'topics': row['topics'], 'content_hash': row['content_hash'], 'size': row['size'],
+        }
+
+
+def write_ndjson(out: BinaryIO, records: Iterator[dict]) -> int:
+    count = 0
+    for record in records:
+        out.write(dumps(record) + b'\n')
+        count += 1
+    return count
+
+
+def write_tar(out: BinaryIO, records: Iterator[dict], compression: str = '') -> int:
+    """
+    Write a tar archive of the blobs and records to out, which only has to
+    support writing. compression is '' or one of the compression methods that
+    tarfile supports, such as 'gz'.
+    """
+    storage = get_blob_storage()
+    count = 0
+    with tarfile.open(fileobj=out, mode='w|' + compression) as archive:
+        # the blobs go first, so that they are already stored by the time the
+        # documents that refer to them are imported.
+        hashes = Document.objects.exclude(content_hash='').order_by('content_hash').values_list('content_hash', 'size')
+        last = ''
+        while True:
+            batch = list(hashes.filter(content_hash__gt=last).distinct()[:BLOB_BATCH_SIZE])
+            if not batch:
+                break
+            for blob_hash, size in batch:
+                info = tarfile.TarInfo('blobs/' + blob_hash)
+                info.size = size
+                with storage.open(blob_hash) as f:
+                    archive.addfile(info, f)
+            last = batch[-1][0]
+
+        member = 0
+        while True:
+            buf = io.BytesIO()
+            lines = write_ndjson(buf, (record for _, record in zip(range(RECORDS_PER_MEMBER), records)))
+            if not lines:
+                break
+            info = tarfile.TarInfo('records/{:06d}.ndjson'.format(member))
+            info.size = buf.tell()
+            buf.seek(0)
+            archive.addfile(info, buf)
+            count += lines
+            member += 1
+    return count
+
+
+def read_ndjson(f: BinaryIO) -> Iterator[dict]:
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            raise ArchiveError("Line {:d} is not valid JSON: {}".format(number, e))
+
+
+def read_tar(f: BinaryIO) -> Iterator[dict]:
+    """
+    Read the records of a tar archive, storing the blobs in it in the blob
+    store as they go by. f only has to support reading.
+    """
+    storage = get_blob_storage()
+    with tarfile.open(fileobj=f, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            directory, _, name = member.name.partition('/')
+            if directory == 'blobs':
+                blob_hash, _ = storage.save(archive.extractfile(member))
+                if blob_hash != name:
+                    raise ArchiveError("The contents of blob {} do not match its hash.".format(name))
+            elif directory == 'records':
+                yield from read_ndjson(archive.extractfile(member))
+
+
+def import_records(records: Iterator[dict], batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """
+    Insert the exported records into the database, which must not already
+    have any of them, and give how many of each kind were imported. Should be
+    run in a transaction, along with counters.rebuild() afterwards.
+    """
+    importer = _Importer(batch_size)
+    for record in records:
+        importer.add(record)
+    importer.flush()
+    return importer.counts
+
+
+class _Importer:
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.kind = None
+        self.pending = []
+        # public IDs of the folders in pending, so that a folder whose parent
+        # has not been inserted yet can flush it first.
+        self.pending_ids = set()
+        self.counts = {'topic': 0, 'folder': 0, 'document': 0}
+        self.connection = connections[router.db_for_write(Document)]
+
+    def add(self, record: dict):
+        kind = record.get('model')
+        if kind not in self.counts:
+            raise ArchiveError("Unknown record type {!r}.".format(kind))
+        if kind != self.kind or len(self.pending) >= self.batch_size or _public_id(record.get('parent')) in self.pending_ids:
+            self.flush()
+            self.kind = kind
+
+        self.pending.append(record)
+        if kind == 'folder':
+            self.pending_ids.add(_public_id(record['id']))
+
+    def flush(self):
+        if self.pending:
+            getattr(self, 'insert_' + self.kind + 's')(self.pending)
+            self.counts[self.kind] += len(self.pending)
+        self.pending = []
+        self.pending_ids = set()
+
+    def insert_topics(self, records: list):
+        topics = [Topic(uuid=_public_id(r['id']), short_desc=r['short_desc'], full_desc=r['full_desc']) for r in records]
+        self.insert(Topic, topics)
+
+    def insert_folders(self, records: list):
+        parents = self.lookup(Folder, (r.get('parent') for r in records), 'path')
+        folders = []
+        for r in records:
+            f = Folder(uuid=_public_id(r['id']), name=r['name'], parent=self.resolve(parents, r.get('parent'), 'folder'))
+            f.path = f.compute_path()
+            folders.append(f)
+        self.insert(Folder, folders)
+        self.insert(FolderClosure, FolderClosure.objects.leaf_links(folders))
+        self.link_topics(Folder, folders, records)
+
+    def insert_documents(self, records: list):
+        folders = self.lookup(Folder, (r.get('folder') for r in records), 'path')
+        documents = []
+        for r in records:
+            d = Document(
+                uuid=_public_id(r['id']), name=r['name'], folder=self.resolve(folders, r.get('folder'), 'folder'),
+                content_hash=r.get('content_hash', ''), size=r.get('size', 0),
+            )
+            d.path = d.compute_path()
+            documents.append(d)
+        self.insert(Document, documents)
+        update_search_vectors(documents)
+        self.link_topics(Document, documents, records)
+
+    def link_topics(self, model, instances: list, records: list):
+        field = model._meta.get_field('topics')
+        through = field.remote_field.through
+        source = field.m2m_field_name() + '_id'
+        topics = self.lookup(Topic, (t for r in records for t in r.get('topics', ())))
+        links = [
+            through(**{source: instance.pk, 'topic_id': self.resolve(topics, t, 'topic').pk})
+            for instance, r in zip(instances, records)
+            for t in set(r.get('topics', ()))
+        ]
+        self.insert(through, links)
+
+    def lookup(self, model, public_ids: Iterator, *fields) -> dict:
+        # stand-ins for the already imported objects that a batch refers to,
+        # with just enough loaded to link to them.
+        wanted = {_public_id(i) for i in public_ids if i is not None}
+        return model.objects.filter(uuid__in=wanted).only('pk', 'uuid', *fields).in_bulk(field_name='uuid')
+
+    @staticmethod
+    def resolve(objects: dict, public_id, kind: str):
+        if public_id is None:
+            return None
+        try:
+            return objects[_public_id(public_id)]
+        except KeyError:
+            raise ArchiveError("No {:s} with ID {} comes before it is referred to.".format(kind, public_id))
+
+    def insert(self, model, objs: list):
+        if not objs:
+            return
+        if self.connection.vendor != 'postgresql':
+            model.objects.bulk_create(objs)
+            return
+
+        _copy(self.connection, model, objs)
+        if any(f.name == 'uuid' for f in model._meta.fields):
+            # COPY does not give back the primary keys of the rows it
+            # inserted, so they are looked up by public ID.
+            pks = dict(model.objects.filter(uuid__in=[o.uuid for o in objs]).values_list('uuid', 'pk'))
+            for obj in objs:
+                obj.pk = pks[obj.uuid]
+
+
+def _public_id(value) -> Optional[uuid.UUID]:
+    if value is None:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise ArchiveError("{!r} is not a valid ID.".format(value))
+
+
+def _copy(connection, model, objs: list):
+    # COPY ... FROM STDIN in CSV format. NULLs are written as an unquoted \N,
+    # and every other value is quoted, so that no value can be mistaken for
+    # one.
+    fields = [f for f in model._meta.concrete_fields if not isinstance(f, models.AutoField)]
+    qn = connection.ops.quote_name
+
+    buf = io.StringIO()
+    for obj in objs:
+        values = []
+        for f in fields:
+            value = f.get_db_prep_save(f.pre_save(obj, True), connection)
+            values.append('\\N' if value is None else '"' + str(value).replace('"', '""') + '"')
+        buf.write(','.join(values) + '\n')
+    buf.seek(0)
+
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+        qn(model._meta.db_table), ', '.join(qn(f.column) for f in fields),
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buf)
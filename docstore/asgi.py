@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator
+
+import django
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.db import connections
+
+
+async def iterate_in_thread(iterator: Iterator) -> AsyncIterator:
+    """
+    Iterate over a blocking iterator from async code. Every step runs on the
+    same dedicated thread, as a database cursor that the iterator reads from
+    (such as a streamed listing's) cannot move between threads, and the
+    thread's connections are closed at the end.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    done = object()
+
+    def finish():
+        try:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            connections.close_all()
+
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        await loop.run_in_executor(executor, finish)
+        executor.shutdown(wait=False)
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """
+    Django's ASGI handler, but sending the bodies of streaming responses
+    without blocking the event loop.
+
+    Django 3.2 iterates streaming bodies on the event loop, which blocks it for
+    every chunk read, and fails outright for bodies that query the database.
+    Here a response's async_streaming_content (see AsyncStreamingHttpResponse)
+    is sent when it has one, and any other streaming body is iterated in a
+    worker thread.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        body = getattr(response, 'async_streaming_content', None)
+        if body is None:
+            body = iterate_in_thread(iter(response.streaming_content))
+
+        # Django sends the headers and then the (now empty) synchronous body,
+        # ending with a body message without more_body set. The async body is
+        # sent just ahead of that final message.
+        response.streaming_content = ()
+
+        async def send_async_body(message):
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                async for chunk in body:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send(message)
+
+        await super().send_response(response, send_async_body)
+
+
+def get_asgi_application():
+    # the same as django.core.asgi.get_asgi_application(), using the handler
+    # above.
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,96 @@
+"""
+Async versions of the document endpoints, used in place of the ones in
+docstore.views when DOCSTORE_ASYNC_VIEWS is set (it is by default under ASGI;
+see spekit/asgi.py).
+
+Django 3.2's ORM and DRF are synchronous only, so the database work of each
+request still runs in a worker thread. What the async views buy is that the
+event loop is never blocked while it happens, and above all that document
+contents are read in chunks off the loop, so a slow download only holds on to
+a connection and not a whole worker.
+"""
+
+import functools
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+
+from .http import contents_response, contents_validators, open_contents
+from .models import Document
+from .routers import read_from_replica
+from .views import DocumentListView, DocumentDetailView
+
+
+def in_thread(func):
+    """
+    Wrap a blocking function to run in a worker thread when awaited. Database
+    connections are handled in the thread the same way Django handles them for
+    each synchronous request.
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    # not thread_sensitive, so that requests do not queue up on the one thread
+    # that sync views share.
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def async_view(sync_view):
+    """
+    Make an async view that runs a synchronous DRF view in a worker thread,
+    including rendering its response.
+    """
+    def run(request, **kwargs):
+        response = sync_view(request, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    run = in_thread(run)
+
+    @functools.wraps(sync_view)
+    async def view(request, **kwargs):
+        return await run(request, **kwargs)
+
+    # DRF exempts its views from CSRF checks and does its own. csrf_exempt()
+    # cannot be used here, as it would hide that the view is async.
+    view.csrf_exempt = True
+    return view
+
+
+document_list = async_view(DocumentListView.as_view())
+
+document_detail = async_view(DocumentDetailView.as_view())
+
+
+@read_from_replica
+async def document_contents(request, doc_id: uuid.UUID):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+    query = Document.objects.only('id', 'name', 'content_hash', 'size', 'updated_at')
+    try:
+        d = await in_thread(query.get)(uuid=doc_id)
+    except ObjectDoesNotExist:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+    f, encoding, size = await in_thread(open_contents)(request, d)
+    validators = contents_validators(d, encoding)
+    not_modified = validators.precondition_response(request)
+    if not_modified is not None:
+        await in_thread(f.close)()
+        patch_vary_headers(not_modified, ['Accept-Encoding'])
+        return not_modified
+
+    response = contents_response(request, f, size, d.name, asynchronous=True, encoding=encoding, validators=validators)
+    return validators.apply(response)
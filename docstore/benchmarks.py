@@ -0,0 +1,286 @@
+"""
+Benchmark suite for the API, run with the benchmark management command against
+a dataset from the generate_dataset command.
+
+Every endpoint is requested in-process through Django's test client, so the
+numbers are of the application alone and not of any server in front of it.
+Each one is run once with its queries captured, and then repeatedly for
+timing. Requests that write are made inside a savepoint that is rolled back
+afterwards, so every iteration, and every endpoint after it, sees the same
+data.
+
+serializer_throughput() measures the listing serializers on their own, in rows
+per second from querying the rows to rendering the JSON, for DRF's model
+serializers and for the fast path that the list endpoints use.
+"""
+
+import json
+import statistics
+import time
+from typing import Callable, Dict, List, Optional
+
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern
+from rest_framework.renderers import JSONRenderer
+
+from . import uploads
+from .models import Topic, Folder, Document, Job, Upload
+from .renderers import ORJSONRenderer
+from .serializers import (
+    TopicListingSerializer, FolderListingSerializer, DocumentListingSerializer,
+    FastTopicListingSerializer, FastFolderListingSerializer, FastDocumentListingSerializer,
+)
+from .views import topic_ids, with_related_ids
+
+API_PREFIX = '/api/v1/'
+
+
+class Samples:
+    """
+    The objects of the dataset that the endpoints are requested for, picked the
+    same way every time so that runs against the same dataset are comparable.
+    """
+
+    def __init__(self):
+        self.topic = Topic.objects.order_by('id').first()
+        self.root = Folder.objects.filter(parent=None).order_by('id').first()
+        self.other_root = Folder.objects.filter(parent=None).exclude(pk=self.root.pk).order_by('id').first()
+        self.document = Document.objects.select_related('folder').order_by('id').first()
+        # the folder the sample document is in, which has documents to output
+        self.folder = self.document.folder
+        # a folder two levels below the root, with a subtree of its own
+        self.subfolder = Folder.objects.filter(parent__parent=self.root).order_by('id').first()
+        self.folders = list(Folder.objects.select_related('parent').order_by('id')[:100])
+        self.documents = list(Document.objects.order_by('id')[:100])
+        self.job = Job.objects.create(kind='delete_subtree', status=Job.DONE)
+        self.upload = Upload.objects.create()
+
+
+class Endpoint:
+    def __init__(self, name: str, route: str, method: str = 'GET', query: str = '',
+                 kwargs: Optional[Callable[[Samples], dict]] = None,
+                 data: Optional[Callable[[Samples], object]] = None,
+                 headers: Optional[Callable[[Samples], dict]] = None):
+        self.name = name
+        self.route = route
+        self.method = method
+        self.query = query
+        self.kwargs = kwargs or (lambda s: {})
+        # sent as JSON, unless it is bytes
+        self.data = data
+        self.headers = headers or (lambda s: {})
+
+    @property
+    def writes(self) -> bool:
+        return self.method != 'GET'
+
+    def url(self, samples: Samples) -> str:
+        path = self.route
+        for key, value in self.kwargs(samples).items():
+            path = path.replace('<uuid:{:s}>'.format(key), str(value))
+        query = self.query.format(s=samples) if self.query else ''
+        return API_PREFIX + path + ('?' + query if query else '')
+
+
+def _topic(s):
+    return {'topic_id': s.topic.uuid}
+
+
+def _folder(s):
+    return {'folder_id': s.folder.uuid}
+
+
+def _document(s):
+    return {'doc_id': s.document.uuid}
+
+
+def _upload(s):
+    return {'upload_id': s.upload.pk}
+
+
+def _new_topics(s):
+    return [{'short_desc': 'bench {:d}'.format(i), 'full_desc': 'benchmark topic'} for i in range(100)]
+
+
+def _new_documents(s):
+    return [{'name': 'bench-{:d}.txt'.format(i), 'folder': str(s.folder.uuid), 'contents': 'benchmark'} for i in range(100)]
+
+
+ENDPOINTS = [
+    Endpoint('topic_list', 'topics/'),
+    Endpoint('topic_list_stream', 'topics/', query='stream=ndjson'),
+    Endpoint('topic_create', 'topics/', 'POST', data=lambda s: {'short_desc': 'bench', 'full_desc': 'benchmark topic'}),
+    Endpoint('topic_bulk_create', 'topics/bulk/', 'POST', data=_new_topics),
+    Endpoint('topic_detail', 'topics/<uuid:topic_id>/', kwargs=_topic),
+    Endpoint('topic_update', 'topics/<uuid:topic_id>/', 'PUT', kwargs=_topic,
+             data=lambda s: {'short_desc': s.topic.short_desc, 'full_desc': 'updated'}),
+    Endpoint('topic_delete', 'topics/<uuid:topic_id>/', 'DELETE', kwargs=_topic),
+
+    Endpoint('folder_list', 'folders/'),
+    Endpoint('folder_list_by_topic', 'folders/', query='topic={s.topic.short_desc}&topic_mode=any'),
+    Endpoint('folder_list_stream', 'folders/', query='stream=ndjson'),
+    Endpoint('folder_create', 'folders/', 'POST', data=lambda s: {'name': 'bench', 'parent': str(s.root.uuid)}),
+    Endpoint('folder_bulk_update', 'folders/bulk/', 'PUT',
+             data=lambda s: [{'id': str(f.uuid), 'name': f.name, 'parent': f.parent and str(f.parent.uuid), 'topics': []}
+                             for f in s.folders]),
+    Endpoint('folder_detail', 'folders/<uuid:folder_id>/', kwargs=_folder),
+    Endpoint('folder_update', 'folders/<uuid:folder_id>/', 'PUT', kwargs=_folder,
+             data=lambda s: {'name': s.folder.name, 'parent': s.folder.parent and str(s.folder.parent.uuid)}),
+    Endpoint('folder_delete', 'folders/<uuid:folder_id>/', 'DELETE', kwargs=lambda s: {'folder_id': s.root.uuid}),
+    Endpoint('folder_tree', 'folders/<uuid:folder_id>/tree/', query='counts=1', kwargs=lambda s: {'folder_id': s.root.uuid}),
+    Endpoint('folder_move', 'folders/<uuid:folder_id>/move/', 'POST', kwargs=lambda s: {'folder_id': s.subfolder.uuid},
+             data=lambda s: {'parent': str(s.other_root.uuid)}),
+
+    Endpoint('document_list', 'documents/'),
+    Endpoint('document_list_all_fields', 'documents/', query='fields=id,path,name,folder,topics,size,contents'),
+    Endpoint('document_list_in_folder', 'documents/', query='folder_id={s.root.uuid}'),
+    Endpoint('document_list_by_topic', 'documents/', query='topic={s.topic.short_desc}'),
+    Endpoint('document_list_stream', 'documents/', query='stream=ndjson'),
+    Endpoint('document_create', 'documents/', 'POST',
+             data=lambda s: {'name': 'bench.txt', 'folder': str(s.folder.uuid), 'contents': 'benchmark'}),
+    Endpoint('document_search', 'documents/search/', query='q=budget+review'),
+    Endpoint('document_bulk_create', 'documents/bulk/', 'POST', data=_new_documents),
+    Endpoint('document_bulk_delete', 'documents/bulk/', 'DELETE', data=lambda s: [str(d.uuid) for d in s.documents]),
+    Endpoint('document_detail', 'documents/<uuid:doc_id>/', kwargs=_document),
+    Endpoint('document_update', 'documents/<uuid:doc_id>/', 'PUT', kwargs=_document,
+             data=lambda s: {'name': s.document.name, 'folder': str(s.document.folder.uuid), 'contents': 'updated'}),
+    Endpoint('document_delete', 'documents/<uuid:doc_id>/', 'DELETE', kwargs=_document),
+    Endpoint('document_contents', 'documents/<uuid:doc_id>/contents/', kwargs=_document),
+
+    Endpoint('upload_create', 'uploads/', 'POST', data=lambda s: {'document': str(s.document.uuid)}),
+    Endpoint('upload_detail', 'uploads/<uuid:upload_id>/', kwargs=_upload),
+    Endpoint('upload_chunk', 'uploads/<uuid:upload_id>/', 'PUT', kwargs=_upload,
+             data=lambda s: b'x' * 65536, headers=lambda s: {'HTTP_CONTENT_RANGE': 'bytes 0-65535/*'}),
+    Endpoint('upload_commit', 'uploads/<uuid:upload_id>/commit/', 'POST', kwargs=_upload,
+             data=lambda s: {'name': 'bench.txt', 'folder': str(s.folder.uuid)}),
+
+    Endpoint('job_detail', 'jobs/<uuid:job_id>/', kwargs=lambda s: {'job_id': s.job.pk}),
+    Endpoint('cache_stats', 'cache/stats/'),
+]
+
+
+def uncovered_routes(urlpatterns: List[URLPattern]) -> List[str]:
+    covered = {e.route for e in ENDPOINTS}
+    return [str(p.pattern) for p in urlpatterns if str(p.pattern) not in covered]
+
+
+def percentile(ordered: list, p: float) -> float:
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class Runner:
+    def __init__(self, iterations: int = 20, warmup: int = 2):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.client = Client(HTTP_HOST='localhost')
+
+    def request(self, endpoint: Endpoint, url: str, body, headers: dict):
+        content_type = 'application/octet-stream' if isinstance(body, bytes) else 'application/json'
+        start = time.perf_counter()
+        if endpoint.writes:
+            with transaction.atomic():
+                response = self.client.generic(endpoint.method, url, body or '', content_type, **headers)
+                transaction.set_rollback(True)
+        else:
+            response = self.client.generic(endpoint.method, url, body or '', content_type, **headers)
+        if response.streaming:
+            size = sum(len(chunk) for chunk in response.streaming_content)
+        else:
+            size = len(response.content)
+        return response.status_code, size, time.perf_counter() - start
+
+    def run(self, endpoint: Endpoint, samples: Samples) -> dict:
+        url = endpoint.url(samples)
+        body = endpoint.data(samples) if endpoint.data is not None else None
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body)
+        headers = endpoint.headers(samples)
+
+        with CaptureQueriesContext(connection) as ctx:
+            status, size, _ = self.request(endpoint, url, body, headers)
+        # the savepoint around each request is not one of the endpoint's own
+        queries = [q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+
+        for _ in range(self.warmup):
+            self.request(endpoint, url, body, headers)
+        latencies = sorted(self.request(endpoint, url, body, headers)[2] for _ in range(self.iterations))
+
+        return {
+            'method': endpoint.method,
+            'url': url,
+            'status': status,
+            'bytes': size,
+            'queries': len(queries),
+            'latency_ms': {
+                'mean': round(statistics.mean(latencies) * 1000, 2),
+                'p50': round(percentile(latencies, 50) * 1000, 2),
+                'p95': round(percentile(latencies, 95) * 1000, 2),
+                'p99': round(percentile(latencies, 99) * 1000, 2),
+                'max': round(latencies[-1] * 1000, 2),
+            },
+        }
+
+    def run_all(self, names: Optional[List[str]] = None) -> Dict[str, dict]:
+        # everything happens in one transaction that is rolled back at the end,
+        # which also removes the sample job and upload. The chunks written to the
+        # upload are not in the database, so they are removed by hand.
+        results = {}
+        with transaction.atomic():
+            samples = Samples()
+            for endpoint in ENDPOINTS:
+                if names and endpoint.name not in names:
+                    continue
+                results[endpoint.name] = self.run(endpoint, samples)
+            transaction.set_rollback(True)
+        uploads.discard(samples.upload.pk)
+        return results
+
+
+# each listing as a queryset for DRF's serializer, the serializer, and its fast
+# path, which reads the same rows with .values().
+SERIALIZER_CASES = {
+    'topic_listing': (lambda: Topic.objects.all(), TopicListingSerializer, FastTopicListingSerializer),
+    'folder_listing': (
+        lambda: with_related_ids(Folder.objects.all(), 'parent').prefetch_related(topic_ids()),
+        FolderListingSerializer, FastFolderListingSerializer,
+    ),
+    'document_listing': (
+        lambda: with_related_ids(Document.objects.all(), 'folder', exclude={'search_vector'}).prefetch_related(topic_ids()),
+        DocumentListingSerializer, FastDocumentListingSerializer,
+    ),
+}
+
+
+def serializer_throughput(rows: int = 1000, iterations: int = 5) -> Dict[str, dict]:
+    """
+    Time rendering a page of rows of each listing with DRF's serializer and
+    JSON renderer, and with the fast path and the orjson renderer. Both must
+    give the same JSON.
+    """
+    def drf(queryset, serializer_class):
+        return JSONRenderer().render(serializer_class(queryset.order_by('id')[:rows], many=True).data)
+
+    def fast(queryset, serializer_class):
+        page = serializer_class.select(queryset.model.objects.all()).order_by('id')[:rows]
+        return ORJSONRenderer().render(serializer_class(page, many=True).data)
+
+    results = {}
+    for name, (queryset, serializer_class, fast_class) in SERIALIZER_CASES.items():
+        expected = json.loads(drf(queryset(), serializer_class))
+        if json.loads(fast(queryset(), fast_class)) != expected:
+            raise AssertionError("the fast path's output for {:s} differs from DRF's".format(name))
+
+        result = {'rows': len(expected)}
+        for label, render, cls in (('drf', drf, serializer_class), ('fast', fast, fast_class)):
+            timings = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                render(queryset(), cls)
+                timings.append(time.perf_counter() - start)
+            result[label + '_rows_per_second'] = round(len(expected) / statistics.median(timings))
+        result['speedup'] = round(result['fast_rows_per_second'] / result['drf_rows_per_second'], 2)
+        results[name] = result
+    return results
@@ -0,0 +1,120 @@
+"""
+Read-through cache of the rendered detail output of topics and folders.
+
+These are large nested payloads that are read far more often than they change.
+Entries hold the JSON bytes, so hits are not even rendered again. Misses go
+through docstore.singleflight, so that a burst of requests for an object that
+is not cached builds it once. Entries are stored in the Django cache named by
+the DOCSTORE_RESPONSE_CACHE setting along with the ETag they were built for,
+and are only used while that ETag is still current, so a stale entry can never
+be served even if it was written by a request that raced with an update.
+Entries are also evicted as soon as the versions of their objects are bumped,
+so that they do not take up room in the cache until they expire.
+
+Set DOCSTORE_RESPONSE_CACHE to None to turn caching off.
+"""
+
+import threading
+from typing import Callable, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import singleflight
+from .models import Topic, Folder, versions_bumped
+
+
+class CacheStats:
+    """
+    Counts cache hits, misses and evictions in this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def record(self, hits: int = 0, misses: int = 0, evictions: int = 0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else None,
+            }
+
+
+stats = CacheStats()
+
+
+def get_response_cache() -> Optional[BaseCache]:
+    alias = settings.DOCSTORE_RESPONSE_CACHE
+    return caches[alias] if alias else None
+
+
+def cache_key(model, pk) -> str:
+    # entries used to hold the output before it was rendered; a different key
+    # keeps a shared cache from handing those to a newer process.
+    return 'docstore:rendered:{:s}:{}'.format(model._meta.model_name, pk)
+
+
+def cached_detail(model, pk, etag: str, build: Callable[[], bytes]) -> Tuple[bytes, bool]:
+    """
+    Give the rendered detail output of the object, from the cache if there is
+    an entry for its current ETag or else by calling build() and caching the
+    result. Returns the output and whether it came from the cache.
+    """
+    flight = singleflight.flight_key(model, pk, etag)
+    cache = get_response_cache()
+    if cache is None:
+        return singleflight.run(flight, build)[0], False
+
+    key = cache_key(model, pk)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == etag:
+        stats.record(hits=1)
+        return entry[1], True
+
+    stats.record(misses=1)
+    body, shared = singleflight.run(flight, build)
+    if not shared:
+        cache.set(key, (etag, body))
+    return body, False
+
+
+def evict(model, pks: Iterable):
+    cache = get_response_cache()
+    if cache is None:
+        return
+    keys = [cache_key(model, pk) for pk in pks]
+    cache.delete_many(keys)
+    stats.record(evictions=len(keys))
+
+
+# docstore.versions works out exactly which topics and folders include a
+# changed object and bumps them, so the cache only has to follow along.
+
+@receiver(versions_bumped, sender=Topic)
+@receiver(versions_bumped, sender=Folder)
+def _evict_bumped(sender, pks, **kwargs):
+    evict(sender, pks)
+
+
+@receiver(post_delete, sender=Topic)
+@receiver(post_delete, sender=Folder)
+def _evict_deleted(sender, instance, **kwargs):
+    evict(sender, [instance.pk])
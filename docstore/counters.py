@@ -0,0 +1,174 @@
+"""
+Denormalized document counts and sizes for folders and topics.
+
+Every folder keeps the number and total size of the documents directly in it,
+and of those anywhere in its subtree, and every topic keeps the same for the
+documents linked to it, so that listings can show them without counting
+anything. They are kept up to date incrementally: whatever creates, moves,
+resizes, links or deletes documents works out how much the documents it
+touches counted for before and after, and adds the difference to the stored
+counters in the same transaction. Document saves and deletes and topic links
+do this from signal handlers; bulk saves and subtree deletes, which send no
+signals, do it themselves.
+
+The counters of a folder near the top of the tree are written by every change
+beneath it, so those changes queue up behind each other on its row until
+their transactions commit.
+
+Should the counters drift anyway, such as after rows are changed by hand,
+rebuild() counts everything again; see the rebuild_counters command.
+"""
+
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from django.db.models import BigIntegerField, Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Topic, Folder, FolderClosure, Document
+
+# number of rows whose counters are updated per statement
+BATCH_SIZE = 500
+
+TopicLinks = Document.topics.through
+
+
+class Totals:
+    """
+    How many documents, and how many bytes of them, some set of documents
+    counts for in each folder and topic. Totals taken before and after a change
+    are subtracted from each other to give what the change did to the
+    counters, which apply() then adds to them.
+    """
+
+    def __init__(self):
+        self.folders: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
+        self.topics: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
+
+    @classmethod
+    def of_documents(cls, document_ids) -> 'Totals':
+        """
+        What the given documents count for as they are now. document_ids can be
+        a list or a subquery.
+        """
+        totals = cls()
+        documents = (Document.objects
+                     .filter(pk__in=document_ids, folder__isnull=False)
+                     .order_by()
+                     .values('folder_id')
+                     .annotate(n=Count('pk'), size=Sum('size')))
+        for row in documents:
+            totals.folders[row['folder_id']] = [row['n'], row['size']]
+        totals._add_links(TopicLinks.objects.filter(document_id__in=document_ids))
+        return totals
+
+    @classmethod
+    def of_links(cls, links) -> 'Totals':
+        """
+        What the given rows of the document-topic through table count for in
+        their topics.
+        """
+        totals = cls()
+        totals._add_links(links)
+        return totals
+
+    def _add_links(self, links):
+        links = links.order_by().values('topic_id').annotate(n=Count('pk'), size=Sum('document__size'))
+        for row in links:
+            self.topics[row['topic_id']] = [row['n'], row['size']]
+
+    def __sub__(self, other: 'Totals') -> 'Totals':
+        difference = Totals()
+        for mine, theirs, result in ((self.folders, other.folders, difference.folders),
+                                     (self.topics, other.topics, difference.topics)):
+            for pk in mine.keys() | theirs.keys():
+                result[pk] = [a - b for a, b in zip(mine.get(pk, (0, 0)), theirs.get(pk, (0, 0)))]
+        return difference
+
+    def apply(self, sign: int = 1):
+        """
+        Add the totals to the stored counters, or take them away with a sign
+        of -1. The subtree counters of every ancestor of each folder are
+        changed along with the folder's own.
+        """
+        folders = {pk: [sign * n for n in totals] for pk, totals in self.folders.items() if any(totals)}
+        topics = {pk: [sign * n for n in totals] for pk, totals in self.topics.items() if any(totals)}
+
+        # a folder is its own ancestor at depth 0, so it picks up the subtree
+        # counters for its own documents here too.
+        counters = defaultdict(lambda: [0, 0, 0, 0])
+        for pk, (count, size) in folders.items():
+            counters[pk][0:2] = [count, size]
+        for batch in _batches(list(folders)):
+            ancestry = FolderClosure.objects.filter(descendant_id__in=batch).values_list('descendant_id', 'ancestor_id')
+            for descendant_id, ancestor_id in ancestry:
+                count, size = folders[descendant_id]
+                counters[ancestor_id][2] += count
+                counters[ancestor_id][3] += size
+
+        _increment(Folder, Folder.counter_fields, counters)
+        _increment(Topic, Topic.counter_fields, topics)
+
+
+def _increment(model, fields, deltas: dict):
+    # one UPDATE per batch, adding a different amount to each row. A plain
+    # update() rather than touch(): the counters are only in the listings,
+    # which are not versioned, so the objects' versions stay as they are.
+    pks = sorted(pk for pk, values in deltas.items() if any(values))
+    for batch in _batches(pks):
+        values = {}
+        for index, field in enumerate(fields):
+            whens = [When(pk=pk, then=Value(deltas[pk][index])) for pk in batch if deltas[pk][index]]
+            if whens:
+                values[field] = F(field) + Case(*whens, default=Value(0), output_field=BigIntegerField())
+        model.objects.filter(pk__in=batch).update(**values)
+
+
+def _batches(items: list) -> Iterable[list]:
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start:start + BATCH_SIZE]
+
+
+def expected_counters() -> dict:
+    """
+    Give, for each model with counters, the expressions that count them from
+    scratch for the row they are annotated on.
+    """
+    def aggregate(queryset, group_by, size_field):
+        queryset = queryset.order_by().values(group_by)
+        count = queryset.annotate(n=Count('pk')).values('n')
+        size = queryset.annotate(size=Sum(size_field)).values('size')
+        return Coalesce(Subquery(count), 0), Coalesce(Subquery(size), 0)
+
+    direct = aggregate(Document.objects.filter(folder=OuterRef('pk')), 'folder', 'size')
+    subtree = aggregate(
+        Document.objects.filter(folder__ancestor_links__ancestor=OuterRef('pk')),
+        'folder__ancestor_links__ancestor', 'size',
+    )
+    linked = aggregate(TopicLinks.objects.filter(topic=OuterRef('pk')), 'topic', 'document__size')
+    return {
+        Folder: dict(zip(Folder.counter_fields, direct + subtree)),
+        Topic: dict(zip(Topic.counter_fields, linked)),
+    }
+
+
+def rebuild(dry_run: bool = False) -> Dict[type, int]:
+    """
+    Count every folder's and topic's documents again and store the counts
+    wherever they differ from the stored counters. Gives the number of rows of
+    each model that had drifted, which are left alone with dry_run.
+    """
+    drifted = {}
+    for model, expressions in expected_counters().items():
+        mismatched = Q()
+        for field in expressions:
+            mismatched |= ~Q(**{field: F('expected_' + field)})
+        pks = list(model.objects
+                   .annotate(**{'expected_' + field: expression for field, expression in expressions.items()})
+                   .filter(mismatched)
+                   .values_list('pk', flat=True))
+        drifted[model] = len(pks)
+        if not dry_run:
+            for batch in _batches(pks):
+                model.objects.filter(pk__in=batch).update(**expressions)
+    return drifted
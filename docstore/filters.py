@@ -0,0 +1,37 @@
+"""
+Query filters shared by the list views.
+"""
+
+from typing import List
+
+from django.db.models import Count, QuerySet
+
+TOPIC_MODES = ('any', 'all')
+
+
+def filter_by_topics(queryset: QuerySet, names: List[str], mode: str = 'all') -> QuerySet:
+    """
+    Filter a queryset of a model with a 'topics' relation down to the objects
+    that have any or all of the topics with the given short descriptions.
+
+    Both modes are a single subquery over the relation's through table, so the
+    outer query never joins against topics and can't return duplicate rows.
+    """
+    field = queryset.model._meta.get_field('topics')
+    through = field.remote_field.through
+    source = field.m2m_field_name() + '_id'
+    target = field.m2m_reverse_field_name()
+
+    names = set(names)
+    links = through.objects.filter(**{target + '__short_desc__in': names})
+
+    if mode == 'all':
+        # group the links by object and keep the objects that matched every one
+        # of the names. Counting distinct names rather than links means that
+        # topics sharing a short_desc can't be counted twice.
+        links = (links
+                 .values(source)
+                 .annotate(matched=Count(target + '__short_desc', distinct=True))
+                 .filter(matched=len(names)))
+
+    return queryset.filter(pk__in=links.values(source))
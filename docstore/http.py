@@ -0,0 +1,308 @@
+"""
+HTTP helpers for the docstore views that fall outside of what DRF provides.
+"""
+
+import datetime
+import io
+import mimetypes
+import re
+from typing import AsyncIterator, BinaryIO, Iterator, Optional, Tuple
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .storage import CHUNK_SIZE, get_blob_storage
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class Validators:
+    """
+    The ETag and Last-Modified time of a resource, used to answer conditional
+    requests.
+    """
+
+    def __init__(self, etag: str, last_modified: Optional[datetime.datetime] = None):
+        self.etag = quote_etag(etag)
+        self.last_modified = last_modified
+        # primary key of the object, when looked up with for_version()
+        self.pk = None
+
+    @classmethod
+    def for_version(cls, queryset, public_id) -> Optional['Validators']:
+        """
+        Look up the validators of the versioned object with the given public
+        ID, or None if there is no such object. This reads only the primary key
+        and version columns, which the model's covering index serves without
+        touching the table, and the primary key is kept in .pk for loading the
+        rest of the object.
+
+        Pass a select_for_update() queryset to keep the version from changing
+        until the end of the transaction.
+        """
+        row = queryset.filter(uuid=public_id).values_list('pk', 'version', 'updated_at').first()
+        if row is None:
+            return None
+        pk, version, updated_at = row
+        validators = cls('{}-{:d}'.format(public_id, version), updated_at)
+        validators.pk = pk
+        return validators
+
+    def precondition_response(self, request) -> Optional[HttpResponse]:
+        """
+        Evaluate the request's conditional headers. Gives the 304 or 412
+        response to send instead of handling the request, or None if the request
+        should go ahead.
+        """
+        last_modified = None
+        if self.last_modified is not None:
+            last_modified = int(self.last_modified.timestamp())
+        response = get_conditional_response(request, etag=self.etag, last_modified=last_modified)
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def range_applies(self, request) -> bool:
+        """
+        Whether a Range header in the request should be honoured. With an
+        If-Range header it only is if that gives the current ETag; a date, or
+        any other ETag, means the client's copy may be out of date, so the
+        whole representation is sent instead.
+        """
+        if_range = request.headers.get('If-Range')
+        return if_range is None or if_range.strip() == self.etag
+
+    def apply(self, response: HttpResponse) -> HttpResponse:
+        response['ETag'] = self.etag
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified.timestamp())
+        return response
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse the value of a Range header into the inclusive start and end offsets
+    of the requested bytes. None is returned when the whole entity should be
+    sent instead, which includes headers with multiple ranges; RFC 7233 allows
+    a server to ignore any Range header it does not want to handle.
+
+    Raises RangeNotSatisfiable if the range lies entirely outside of the
+    entity.
+    """
+    if not header or size == 0:
+        return None
+
+    m = _RANGE_RE.match(header.strip())
+    if not m:
+        return None
+
+    first, last = m.group(1), m.group(2)
+    if first == '' and last == '':
+        return None
+
+    if first == '':
+        # suffix range, the final N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = int(last) if last != '' else size - 1
+    if end < start:
+        # syntactically invalid, so it is ignored
+        return None
+    return start, min(end, size - 1)
+
+
+def parse_content_range(header: str) -> Optional[Tuple[int, int, Optional[int]]]:
+    """
+    Parse the value of a Content-Range header sent with a chunk of an upload
+    into the inclusive start and end offsets of the chunk, and the size of the
+    whole entity, which is None if the sender does not know it yet. None is
+    returned if the header is not valid.
+    """
+    m = _CONTENT_RANGE_RE.match(header.strip())
+    if not m:
+        return None
+    start, end = int(m.group(1)), int(m.group(2))
+    total = int(m.group(3)) if m.group(3) != '*' else None
+    if end < start or (total is not None and end >= total):
+        return None
+    return start, end, total
+
+
+def iter_range(f: BinaryIO, start: int, length: int) -> Iterator[bytes]:
+    """
+    Yield length bytes of f starting at start, in chunks, and close f once
+    done.
+    """
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+async def aiter_range(f: BinaryIO, start: int, length: int) -> AsyncIterator[bytes]:
+    """
+    Like iter_range(), but each read happens in a worker thread so that it does
+    not block the event loop.
+    """
+    read = sync_to_async(f.read, thread_sensitive=False)
+    try:
+        await sync_to_async(f.seek, thread_sensitive=False)(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(f.close, thread_sensitive=False)()
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    A streaming response whose body can be sent from an async iterator.
+
+    Django 3.2 always iterates response bodies synchronously, which under ASGI
+    means blocking the event loop for every chunk read. docstore.asgi.ASGIHandler
+    sends async_streaming_content instead; any other handler (WSGI, the test
+    client) falls back to the ordinary streaming_content.
+    """
+
+    def __init__(self, async_streaming_content: AsyncIterator[bytes], streaming_content=(), *args, **kwargs):
+        super().__init__(streaming_content, *args, **kwargs)
+        self.async_streaming_content = async_streaming_content
+
+
+def accepts_encoding(request, encoding: str) -> bool:
+    """
+    Whether the request's Accept-Encoding header allows a response in the
+    given content encoding.
+    """
+    qualities = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            qualities[coding.lower()] = q
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+
+def open_contents(request, doc) -> Tuple[BinaryIO, Optional[str], int]:
+    """
+    Open a document's contents for sending in response to request. If they are
+    stored compressed in an encoding that the client accepts, the compressed
+    bytes are sent as they are; otherwise the contents are decompressed as they
+    are read. Gives the stream, its content encoding or None, and its size.
+
+    Ranges are of the uncompressed contents, so requests for them always get
+    those.
+    """
+    if doc.content_hash and 'Range' not in request.headers:
+        encoded = get_blob_storage().open_encoded(doc.content_hash)
+        if encoded is not None:
+            if accepts_encoding(request, encoded[1]):
+                return encoded
+            encoded[0].close()
+    return doc.open_contents(), None, doc.size
+
+
+def contents_validators(doc, encoding: Optional[str]) -> Validators:
+    # contents are addressed by their hash, which makes it a strong ETag that
+    # does not change when only the document's metadata does. Compressed
+    # contents are a different representation, so they get their own.
+    etag = doc.content_hash if encoding is None else '{:s}-{:s}'.format(doc.content_hash, encoding)
+    return Validators(etag, doc.updated_at)
+
+
+def _content_disposition(filename: str) -> str:
+    # same as what FileResponse sends for an inline file
+    try:
+        filename.encode('ascii')
+        return 'inline; filename="{:s}"'.format(filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        return "inline; filename*=utf-8''{:s}".format(quote(filename))
+
+
+def contents_response(request, f: BinaryIO, size: int, filename: str, asynchronous: bool = False,
+                      encoding: Optional[str] = None, validators: Optional[Validators] = None) -> HttpResponse:
+    """
+    Build a response that streams the contents of f to the client, honoring
+    any Range header in the request, unless an If-Range header does not match
+    the given validators. If asynchronous is set, the body is read without
+    blocking when the response is sent by an ASGI server. encoding is the
+    content encoding of f as given by open_contents(); ranges are not served
+    from encoded contents.
+    """
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    honor_range = encoding is None and (validators is None or validators.range_applies(request))
+    try:
+        byte_range = parse_range(request.headers.get('Range'), size) if honor_range else None
+    except RangeNotSatisfiable:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{:d}'.format(size)
+        return response
+
+    if asynchronous:
+        start, end = byte_range if byte_range is not None else (0, size - 1)
+        length = end - start + 1
+        response = AsyncStreamingHttpResponse(
+            aiter_range(f, start, length), iter_range(f, start, length),
+            status=200 if byte_range is None else 206, content_type=content_type,
+        )
+        response['Content-Length'] = str(length)
+        if byte_range is None:
+            response['Content-Disposition'] = _content_disposition(filename)
+        else:
+            response['Content-Range'] = 'bytes {:d}-{:d}/{:d}'.format(start, end, size)
+    elif byte_range is None and isinstance(f, io.BufferedReader):
+        # a plain file, which the server may be able to send with sendfile()
+        response = FileResponse(f, content_type=content_type, filename=filename)
+        response['Content-Length'] = str(size)
+    elif byte_range is None:
+        # FileResponse would read all of a decompressing stream to find its
+        # length, so it is streamed instead.
+        response = StreamingHttpResponse(iter_range(f, 0, size), content_type=content_type)
+        response['Content-Length'] = str(size)
+        response['Content-Disposition'] = _content_disposition(filename)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(iter_range(f, start, length), status=206, content_type=content_type)
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = 'bytes {:d}-{:d}/{:d}'.format(start, end, size)
+
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    response['Accept-Ranges'] = 'bytes'
+    return response
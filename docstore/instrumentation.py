@@ -0,0 +1,107 @@
+"""
+Per-request measurements of database and serialization work, collected by
+docstore.middleware.InstrumentationMiddleware.
+
+The measurements of the request being handled live in a context variable.
+asgiref copies context variables into the threads that sync_to_async() runs
+code in, so work that the async views hand off to worker threads is still
+counted against the right request.
+
+Serialization is timed by the code that does it, docstore's serializers and
+ORJSONRenderer, which run their work in serializing().
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        # how many serialization timers are running, so that nested ones are
+        # not counted twice.
+        self._serializing = 0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar('docstore_request_metrics', default=None)
+
+
+@contextmanager
+def measure_request():
+    """
+    Record the queries and serialization in the block into a new
+    RequestMetrics, which is what it yields.
+    """
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - start
+        metrics.queries += 1
+
+
+def _add_query_recorder(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+@contextmanager
+def serializing():
+    """
+    Count the time spent in the block as serialization time.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+
+    metrics._serializing += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics._serializing -= 1
+        if metrics._serializing == 0:
+            metrics.serialize_time += time.perf_counter() - start
+
+
+_installed = False
+
+
+def install():
+    """
+    Start recording queries, on every database connection including ones
+    opened later on other threads. Safe to call more than once.
+    """
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    connection_created.connect(_add_query_recorder)
+    for connection in connections.all():
+        _add_query_recorder(connection)
@@ -0,0 +1,78 @@
+"""
+Background jobs.
+
+A job is a row in the Job table that clients can poll for its status and
+progress. Each kind of job is a function in JOB_KINDS, which is called with the
+job and the job's params as keyword arguments.
+
+When DOCSTORE_JOBS_IN_PROCESS is set, a job starts on a thread of the process
+that created it as soon as the creating transaction commits. Otherwise, or to
+pick up jobs that were interrupted when a process went away, the run_jobs
+management command runs them instead.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Job
+from .subtrees import DELETE_BATCH_SIZE, delete_subtree
+
+logger = logging.getLogger(__name__)
+
+
+def start(kind: str, total: int = 0, **params) -> Job:
+    """
+    Create a job of the given kind. params must be JSON-serializable.
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError("unknown job kind: {:s}".format(kind))
+
+    job = Job.objects.create(kind=kind, params=params, total=total)
+    if settings.DOCSTORE_JOBS_IN_PROCESS:
+        transaction.on_commit(lambda: threading.Thread(target=_run_in_thread, args=(job.pk,), daemon=True).start())
+    return job
+
+
+def run(job_id) -> bool:
+    """
+    Run a pending job to completion. Returns False if the job was not pending,
+    such as when another process has already claimed it.
+    """
+    claimed = Job.objects.filter(pk=job_id, status=Job.PENDING).update(status=Job.RUNNING, updated_at=timezone.now())
+    if not claimed:
+        return False
+
+    job = Job.objects.get(pk=job_id)
+    try:
+        JOB_KINDS[job.kind](job, **job.params)
+    except Exception as e:
+        logger.exception("job %s failed", job_id)
+        Job.objects.filter(pk=job_id).update(status=Job.FAILED, error=str(e), updated_at=timezone.now())
+    else:
+        Job.objects.filter(pk=job_id).update(status=Job.DONE, updated_at=timezone.now())
+    return True
+
+
+def report_progress(job: Job, completed: int):
+    job.completed = completed
+    Job.objects.filter(pk=job.pk).update(completed=completed, updated_at=timezone.now())
+
+
+def _run_in_thread(job_id):
+    try:
+        run(job_id)
+    finally:
+        connections.close_all()
+
+
+def _delete_subtree(job: Job, folder_id: int):
+    delete_subtree(folder_id, batch_size=DELETE_BATCH_SIZE, progress=lambda n: report_progress(job, n))
+
+
+JOB_KINDS = {
+    'delete_subtree': _delete_subtree,
+}
@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from docstore import benchmarks, urls
+from docstore.models import Topic, Folder, Document
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the latency and query count of every API endpoint against the current dataset (see "
+        "generate_dataset), and output the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help="Timed requests per endpoint.")
+        parser.add_argument('--warmup', type=int, default=2, help="Untimed requests per endpoint before timing.")
+        parser.add_argument('--only', action='append', metavar='NAME', help="Only run the named endpoint; may be repeated.")
+        parser.add_argument('--no-cache', action='store_true', help="Turn off the response cache while measuring.")
+        parser.add_argument('--output', help="Write the results to this file instead of standard output.")
+        parser.add_argument(
+            '--serializer-rows', type=int, default=1000, metavar='N',
+            help="Rows per listing when measuring serializer throughput; 0 skips it.",
+        )
+
+    def handle(self, *args, **options):
+        if not Folder.objects.filter(parent__parent__isnull=False).exists() or not Document.objects.exists():
+            raise CommandError("Not enough data to benchmark against; run generate_dataset first.")
+
+        names = {e.name for e in benchmarks.ENDPOINTS}
+        unknown = set(options['only'] or []) - names
+        if unknown:
+            raise CommandError("Unknown endpoint(s): {:s}".format(', '.join(sorted(unknown))))
+        for route in benchmarks.uncovered_routes(urls.urlpatterns):
+            self.stderr.write("warning: no benchmark for {:s}".format(route))
+
+        runner = benchmarks.Runner(iterations=options['iterations'], warmup=options['warmup'])
+        if options['no_cache']:
+            with override_settings(DOCSTORE_RESPONSE_CACHE=None):
+                results = runner.run_all(options['only'])
+        else:
+            results = runner.run_all(options['only'])
+
+        report = {
+            'dataset': {
+                'topics': Topic.objects.count(),
+                'folders': Folder.objects.count(),
+                'documents': Document.objects.count(),
+            },
+            'iterations': options['iterations'],
+            'cache': not options['no_cache'],
+            'endpoints': results,
+        }
+        if options['serializer_rows']:
+            report['serializers'] = benchmarks.serializer_throughput(options['serializer_rows'], options['iterations'])
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from docstore.models import Document
+from docstore.storage import get_blob_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert the stored contents of every document to the current DOCSTORE_BLOB_COMPRESSION setting, "
+        "compressing them if it is set and decompressing them if not. Documents are read in batches, and it can "
+        "be stopped and run again at any time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Content hashes to read at a time.")
+
+    def handle(self, *args, **options):
+        storage = get_blob_storage()
+        hashes = Document.objects.exclude(content_hash='').order_by('content_hash').values_list('content_hash', flat=True)
+
+        # walks the content hash index in order, a batch at a time, so that
+        # memory use does not grow with the number of documents.
+        last = ''
+        checked = converted = 0
+        while True:
+            batch = list(hashes.filter(content_hash__gt=last).distinct()[:options['batch_size']])
+            if not batch:
+                break
+            for blob_hash in batch:
+                if storage.rewrite(blob_hash):
+                    converted += 1
+            checked += len(batch)
+            last = batch[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write("{:d} blob(s) checked, {:d} converted".format(checked, converted))
+
+        self.stdout.write("Converted {:d} of {:d} blob(s)".format(converted, checked))
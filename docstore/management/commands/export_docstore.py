@@ -0,0 +1,43 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from docstore import archives
+
+
+def guess_format(path: str) -> str:
+    if path.endswith(('.tar', '.tar.gz', '.tgz')):
+        return 'tar'
+    return 'ndjson'
+
+
+class Command(BaseCommand):
+    help = (
+        "Write every topic, folder and document to a file, or to standard output, for import_docstore to read. "
+        "NDJSON holds just the rows; a tar archive also holds the document contents."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-', help="File to write to, or - for standard output.")
+        parser.add_argument(
+            '--format', choices=archives.FORMATS,
+            help="Defaults to tar for .tar, .tar.gz and .tgz files and to ndjson otherwise.",
+        )
+
+    def handle(self, *args, **options):
+        path = options['output']
+        fmt = options['format'] or guess_format(path)
+        out = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            records = archives.export_records()
+            if fmt == 'tar':
+                count = archives.write_tar(out, records, compression='gz' if path.endswith('gz') else '')
+            else:
+                count = archives.write_ndjson(out, records)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+
+        # the summary goes to standard error when the export itself is going
+        # to standard output.
+        (self.stderr if path == '-' else self.stdout).write("Exported {:d} record(s)".format(count))
@@ -0,0 +1,42 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from docstore.models import Document
+from docstore.storage import get_blob_storage
+
+
+class Command(BaseCommand):
+    help = "Delete stored document contents that no document refers to anymore."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-minutes', type=int, default=60,
+            help="Only delete blobs older than this, so that contents written by requests still in progress are kept.",
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be deleted without deleting it.")
+
+    def handle(self, *args, **options):
+        # blobs are shared between documents with the same contents, so they
+        # are not removed when a document is deleted; this cleans them up.
+        storage = get_blob_storage()
+        cutoff = timezone.now() - datetime.timedelta(minutes=options['grace_minutes'])
+
+        deleted = 0
+        for blob_hash, modified in storage.list():
+            if modified > cutoff:
+                continue
+            if Document.objects.filter(content_hash=blob_hash).exists():
+                continue
+            # a document that is being saved with these same contents may have
+            # stored them again since they were listed, which makes them new.
+            modified = storage.modified(blob_hash)
+            if modified is None or modified > cutoff:
+                continue
+            if not options['dry_run']:
+                storage.delete(blob_hash)
+            deleted += 1
+
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write("{:s} {:d} unreferenced blob(s)".format(verb, deleted))
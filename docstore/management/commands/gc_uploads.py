@@ -0,0 +1,49 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from docstore import uploads
+from docstore.models import Upload
+
+
+class Command(BaseCommand):
+    help = "Delete uploads that have not been written to for a while, along with their chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--expire-hours', type=int, default=24,
+            help="Delete uploads that have not been written to or committed for this long. Clients can no longer "
+                 "resume them.",
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be deleted without deleting it.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(hours=options['expire_hours'])
+
+        # committed uploads are only kept so that commits can be retried
+        expired = list(Upload.objects.filter(updated_at__lt=cutoff).values_list('pk', flat=True))
+        if not options['dry_run']:
+            for upload_id in expired:
+                # unless a chunk arrived for it in the meantime
+                deleted, _ = Upload.objects.filter(pk=upload_id, updated_at__lt=cutoff).delete()
+                if deleted:
+                    uploads.discard(upload_id)
+
+        # files left behind by uploads whose rows are gone, such as when their
+        # document was deleted part way through, and by chunks whose requests
+        # never finished.
+        strays = 0
+        root = uploads.upload_root()
+        if root.exists():
+            known = {str(pk) for pk in Upload.objects.values_list('pk', flat=True)}
+            for path in root.iterdir():
+                modified = datetime.datetime.fromtimestamp(path.stat().st_mtime, tz=timezone.utc)
+                if path.name in known or modified > cutoff:
+                    continue
+                if not options['dry_run']:
+                    path.unlink(missing_ok=True)
+                strays += 1
+
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write("{:s} {:d} expired upload(s) and {:d} stray file(s)".format(verb, len(expired), strays))
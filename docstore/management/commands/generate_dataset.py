@@ -0,0 +1,140 @@
+import io
+import math
+import random
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from docstore import counters
+from docstore.models import Topic, Folder, FolderClosure, Document
+from docstore.search import update_search_vectors
+from docstore.subtrees import delete_subtree
+
+# words that document names and contents are made of. Benchmarks search for
+# them, so they should not change.
+WORDS = (
+    'alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa quebec '
+    'romeo sierra tango uniform victor whiskey xray yankee zulu report budget policy onboarding release roadmap '
+    'customer contract invoice meeting notes design review incident summary quarterly planning training guide'
+).split()
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset of topics, folders and documents for benchmarking. The same options and "
+        "seed always give the same dataset, public IDs included."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topics', type=int, default=50, help="Number of topics.")
+        parser.add_argument('--roots', type=int, default=5, help="Number of top-level folders.")
+        parser.add_argument('--depth', type=int, default=4, help="Levels of folders beneath each top-level folder.")
+        parser.add_argument('--fanout', type=int, default=4, help="Subfolders of each folder.")
+        parser.add_argument('--documents', type=int, default=10000, help="Number of documents, spread over all folders.")
+        parser.add_argument(
+            '--median-size', type=int, default=4096,
+            help="Median document size in bytes. Sizes are log-normally distributed around it.",
+        )
+        parser.add_argument('--max-size', type=int, default=1024 * 1024, help="Largest document size in bytes.")
+        parser.add_argument('--topics-per-object', type=int, default=2, help="Most topics linked to each folder and document.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help="Delete all existing topics, folders and documents first.")
+
+    def handle(self, *args, **options):
+        if not options['clear'] and (Folder.objects.exists() or Document.objects.exists() or Topic.objects.exists()):
+            raise CommandError("The database already has data in it; use --clear to replace it.")
+        if options['topics'] < 1 or options['roots'] < 1:
+            raise CommandError("--topics and --roots must be at least 1")
+
+        self.rng = random.Random(options['seed'])
+        self.options = options
+
+        with transaction.atomic():
+            if options['clear']:
+                for root in Folder.objects.filter(parent=None).values_list('pk', flat=True):
+                    delete_subtree(root)
+                Document.objects.all().delete()
+                Topic.objects.all().delete()
+
+            topics = self.make_topics()
+            folders = self.make_folders(topics)
+            count = self.make_documents(folders, topics)
+            # everything was bulk inserted, which the counters do not follow,
+            # so they are counted in one go at the end.
+            counters.rebuild()
+
+        self.stdout.write("Generated {:d} topics, {:d} folders and {:d} documents".format(len(topics), len(folders), count))
+
+    def new_id(self) -> uuid.UUID:
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def phrase(self, n: int) -> str:
+        return ' '.join(self.rng.choice(WORDS) for _ in range(n))
+
+    def pick_topics(self, topics: list) -> list:
+        return self.rng.sample(topics, self.rng.randint(0, min(self.options['topics_per_object'], len(topics))))
+
+    def make_topics(self) -> list:
+        topics = [
+            Topic(uuid=self.new_id(), short_desc='{:s} {:d}'.format(self.phrase(2), i), full_desc=self.phrase(20))
+            for i in range(self.options['topics'])
+        ]
+        Topic.objects.bulk_create(topics, batch_size=BATCH_SIZE)
+        return topics
+
+    def make_folders(self, topics: list) -> list:
+        # built a level at a time, so that each level's parents and their
+        # closure rows already exist.
+        level = [None]
+        all_folders = []
+        for depth in range(self.options['depth'] + 1):
+            width = self.options['roots'] if depth == 0 else self.options['fanout']
+            folders = []
+            for parent in level:
+                for i in range(width):
+                    f = Folder(uuid=self.new_id(), name='{:s}-{:d}'.format(self.rng.choice(WORDS), i), parent=parent)
+                    f.path = f.compute_path()
+                    folders.append(f)
+            Folder.objects.bulk_create(folders, batch_size=BATCH_SIZE)
+            FolderClosure.objects.insert_leaves(folders)
+            self.link_topics(Folder.topics.through, 'folder_id', folders, topics)
+            all_folders += folders
+            level = folders
+        return all_folders
+
+    def make_documents(self, folders: list, topics: list) -> int:
+        total = self.options['documents']
+        for start in range(0, total, BATCH_SIZE):
+            docs = []
+            for i in range(start, min(start + BATCH_SIZE, total)):
+                folder = self.rng.choice(folders)
+                d = Document(uuid=self.new_id(), name='{:s}-{:d}.txt'.format(self.phrase(2).replace(' ', '-'), i), folder=folder)
+                d.path = d.compute_path()
+                d.set_contents(io.BytesIO(self.contents()))
+                docs.append(d)
+            Document.objects.bulk_create(docs)
+            update_search_vectors(docs)
+            self.link_topics(Document.topics.through, 'document_id', docs, topics)
+        return total
+
+    def contents(self) -> bytes:
+        median = self.options['median_size']
+        size = int(min(self.rng.lognormvariate(math.log(median), 1.0), self.options['max_size']))
+        words = []
+        length = 0
+        while length < size:
+            word = self.rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words).encode('utf-8')[:size]
+
+    def link_topics(self, through, source: str, objects: list, topics: list):
+        links = [
+            through(**{source: obj.pk, 'topic_id': t.pk})
+            for obj in objects
+            for t in self.pick_topics(topics)
+        ]
+        through.objects.bulk_create(links, batch_size=BATCH_SIZE)
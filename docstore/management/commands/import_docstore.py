@@ -0,0 +1,57 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from docstore import archives, counters
+from docstore.models import Topic, Folder, Document
+from docstore.storage import BlobNotFound
+from docstore.subtrees import delete_subtree
+
+from .export_docstore import guess_format
+
+
+class Command(BaseCommand):
+    help = (
+        "Read topics, folders and documents written by export_docstore into an empty database, all in one "
+        "transaction. Importing from NDJSON expects the document contents to be in the blob store already."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', nargs='?', default='-', help="File to read from, or - for standard input.")
+        parser.add_argument(
+            '--format', choices=archives.FORMATS,
+            help="Defaults to tar for .tar, .tar.gz and .tgz files and to ndjson otherwise.",
+        )
+        parser.add_argument('--batch-size', type=int, default=archives.BATCH_SIZE, help="Rows inserted at a time.")
+        parser.add_argument('--clear', action='store_true', help="Delete all existing topics, folders and documents first.")
+
+    def handle(self, *args, **options):
+        if not options['clear'] and (Folder.objects.exists() or Document.objects.exists() or Topic.objects.exists()):
+            raise CommandError("The database already has data in it; use --clear to replace it.")
+
+        path = options['input']
+        fmt = options['format'] or guess_format(path)
+        f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        try:
+            with transaction.atomic():
+                if options['clear']:
+                    for root in Folder.objects.filter(parent=None).values_list('pk', flat=True):
+                        delete_subtree(root)
+                    Document.objects.all().delete()
+                    Topic.objects.all().delete()
+
+                records = archives.read_tar(f) if fmt == 'tar' else archives.read_ndjson(f)
+                counts = archives.import_records(records, batch_size=options['batch_size'])
+                # rows were bulk inserted, which the counters do not follow
+                counters.rebuild()
+        except archives.ArchiveError as e:
+            raise CommandError(str(e))
+        except BlobNotFound as e:
+            raise CommandError("Missing document contents: {}. Import from a tar archive, or copy the blob store "
+                               "across first.".format(e))
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+        self.stdout.write("Imported {topic:d} topic(s), {folder:d} folder(s) and {document:d} document(s)".format(**counts))
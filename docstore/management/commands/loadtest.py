@@ -0,0 +1,119 @@
+import http.client
+import json
+import statistics
+import threading
+import time
+import urllib.parse
+
+from django.core.management.base import BaseCommand, CommandError
+
+from docstore.benchmarks import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running docstore server. Fast clients request --path back to back and their latency is "
+        "measured, while slow clients download --slow-path at a limited rate the way clients on poor connections "
+        "do. Run it against the WSGI and the ASGI deployment to compare the two."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help="Base URL of the server, such as http://127.0.0.1:8000.")
+        parser.add_argument('--path', required=True, help="Path that the fast clients request.")
+        parser.add_argument('--concurrency', type=int, default=10, help="Number of fast clients.")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run for.")
+        parser.add_argument('--slow-path', help="Path that the slow clients download, such as a document's contents.")
+        parser.add_argument('--slow-clients', type=int, default=0, help="Number of slow clients.")
+        parser.add_argument('--slow-rate', type=int, default=16 * 1024, help="Bytes per second each slow client reads.")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Seconds before a request counts as failed.")
+        parser.add_argument('--json', action='store_true', help="Output the results as JSON.")
+
+    def handle(self, *args, **options):
+        url = urllib.parse.urlsplit(options['base_url'])
+        if url.scheme != 'http' or not url.hostname:
+            raise CommandError("base_url must be an http:// URL")
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = options['timeout']
+
+        stop = threading.Event()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def fast_client():
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    self.request(options['path'])
+                except Exception as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        def slow_client():
+            while not stop.is_set():
+                try:
+                    self.request(options['slow_path'], rate=options['slow_rate'], stop=stop)
+                except Exception:
+                    pass
+
+        threads = [threading.Thread(target=slow_client, daemon=True) for _ in range(options['slow_clients'])]
+        threads += [threading.Thread(target=fast_client, daemon=True) for _ in range(options['concurrency'])]
+        for t in threads:
+            t.start()
+        time.sleep(options['duration'])
+        stop.set()
+        for t in threads:
+            t.join(self.timeout)
+
+        results = {
+            'path': options['path'],
+            'concurrency': options['concurrency'],
+            'slow_clients': options['slow_clients'],
+            'duration': options['duration'],
+            'requests': len(latencies),
+            'errors': len(errors),
+            'requests_per_second': len(latencies) / options['duration'],
+        }
+        if latencies:
+            latencies.sort()
+            results['latency_ms'] = {
+                'mean': statistics.mean(latencies) * 1000,
+                'p50': percentile(latencies, 50) * 1000,
+                'p95': percentile(latencies, 95) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': latencies[-1] * 1000,
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write("{:d} requests, {:d} errors, {:.1f} req/s".format(
+            results['requests'], results['errors'], results['requests_per_second'],
+        ))
+        if latencies:
+            self.stdout.write("latency (ms): " + ", ".join(
+                "{:s} {:.1f}".format(k, v) for k, v in results['latency_ms'].items()
+            ))
+
+    def request(self, path: str, rate: int = None, stop: threading.Event = None):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            if rate is None:
+                response.read()
+            else:
+                # read a tenth of a second's worth at a time
+                chunk = max(rate // 10, 1)
+                while not stop.is_set() and response.read(chunk):
+                    time.sleep(0.1)
+            if response.status >= 400:
+                raise RuntimeError("HTTP {:d}".format(response.status))
+        finally:
+            conn.close()
+
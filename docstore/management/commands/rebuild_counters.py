@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from docstore import counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the documents in every folder and linked to every topic again, and repair the stored document "
+        "counters of any that have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what has drifted without repairing it.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = counters.rebuild(dry_run=options['dry_run'])
+
+        verb = "Would repair" if options['dry_run'] else "Repaired"
+        for model, count in drifted.items():
+            self.stdout.write("{:s} the counters of {:d} {:s}".format(verb, count, str(model._meta.verbose_name_plural)))
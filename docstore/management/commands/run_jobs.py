@@ -0,0 +1,40 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from docstore import jobs
+from docstore.models import Job
+
+
+class Command(BaseCommand):
+    help = "Run pending background jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--watch', type=float, metavar='SECONDS',
+            help="Keep running, checking for new jobs this often.",
+        )
+        parser.add_argument(
+            '--requeue-after', type=int, default=30, metavar='MINUTES',
+            help="Run again jobs that have been running without making progress for this long, as the process "
+                 "running them is assumed to have gone away. Jobs must be safe to run again.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            stale = timezone.now() - datetime.timedelta(minutes=options['requeue_after'])
+            requeued = Job.objects.filter(status=Job.RUNNING, updated_at__lt=stale).update(status=Job.PENDING)
+            if requeued:
+                self.stdout.write("Requeued {:d} stalled job(s)".format(requeued))
+
+            pending = Job.objects.filter(status=Job.PENDING).order_by('created_at').values_list('pk', flat=True)
+            for job_id in pending:
+                if jobs.run(job_id):
+                    job = Job.objects.get(pk=job_id)
+                    self.stdout.write("{:s}: {:s}".format(str(job), job.status))
+
+            if options['watch'] is None:
+                return
+            time.sleep(options['watch'])
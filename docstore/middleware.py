@@ -0,0 +1,120 @@
+import asyncio
+import cProfile
+import json
+import logging
+import random
+import time
+import uuid
+from pathlib import Path
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+
+from . import instrumentation
+
+logger = logging.getLogger('docstore.requests')
+
+
+class InstrumentationMiddleware:
+    """
+    Records the number of queries, time spent in the database, time spent
+    serializing and total time of each request. They are sent back in a
+    Server-Timing header and logged as one JSON object per request, so query
+    count regressions show up without needing DEBUG.
+
+    If DOCSTORE_PROFILE_SAMPLE_RATE is above 0, that fraction of requests is
+    run under cProfile, and the stats of those taking longer than
+    DOCSTORE_SLOW_REQUEST_MS are written to DOCSTORE_PROFILE_DIR.
+
+    The bodies of streaming responses are sent after the middleware returns,
+    so the work of producing them is not included.
+
+    Under ASGI the middleware runs as a coroutine, so that it does not make
+    Django hand the async views back and forth between threads. A profiler
+    covers a whole thread, and the event loop's thread runs many requests at
+    once, so requests handled that way are never profiled.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_ms = settings.DOCSTORE_SLOW_REQUEST_MS
+        self.sample_rate = settings.DOCSTORE_PROFILE_SAMPLE_RATE
+        self.profile_dir = Path(settings.DOCSTORE_PROFILE_DIR)
+        instrumentation.install()
+
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        profiler = None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+
+        with instrumentation.measure_request() as metrics:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            total = metrics.elapsed()
+
+        self.record(request, response, metrics, total, profiler)
+        return response
+
+    async def __acall__(self, request):
+        with instrumentation.measure_request() as metrics:
+            response = await self.get_response(request)
+            total = metrics.elapsed()
+
+        self.record(request, response, metrics, total)
+        return response
+
+    def record(self, request, response, metrics, total: float, profiler: cProfile.Profile = None):
+        total_ms = total * 1000
+        db_ms = metrics.db_time * 1000
+        serialize_ms = metrics.serialize_time * 1000
+
+        response['Server-Timing'] = ', '.join([
+            'db;dur={:.1f};desc="{:d} queries"'.format(db_ms, metrics.queries),
+            'serialize;dur={:.1f}'.format(serialize_ms),
+            'total;dur={:.1f}'.format(total_ms),
+        ])
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': getattr(request.resolver_match, 'view_name', None),
+            'status': response.status_code,
+            'queries': metrics.queries,
+            'db_ms': round(db_ms, 1),
+            'serialize_ms': round(serialize_ms, 1),
+            'total_ms': round(total_ms, 1),
+        }
+        if profiler is not None and total_ms >= self.slow_ms:
+            record['profile'] = str(self.dump_profile(profiler, request))
+
+        if total_ms >= self.slow_ms:
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+
+    def dump_profile(self, profiler: cProfile.Profile, request) -> Path:
+        # named so that they sort by time and say what the request was; load
+        # them with pstats or a viewer such as snakeviz.
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        view = getattr(request.resolver_match, 'view_name', None) or 'unresolved'
+        name = '{:s}-{:s}-{:s}-{:s}.prof'.format(
+            time.strftime('%Y%m%dT%H%M%S'), request.method, view.rsplit('.', 1)[-1], uuid.uuid4().hex[:8],
+        )
+        path = self.profile_dir / name
+        profiler.dump_stats(path)
+        return path
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+
+def populate_paths(apps, schema_editor):
+    Folder = apps.get_model('docstore', 'Folder')
+    Document = apps.get_model('docstore', 'Document')
+
+    # walk the tree from the roots down so that every parent's path is known
+    # before its children are visited.
+    paths = {}
+    level = list(Folder.objects.filter(parent__isnull=True))
+    while level:
+        for f in level:
+            parent_path = paths[f.parent_id] if f.parent_id is not None else ''
+            f.path = parent_path + '/' + f.name
+            paths[f.pk] = f.path
+        Folder.objects.bulk_update(level, ['path'], batch_size=1000)
+        level = list(Folder.objects.filter(parent__in=[f.pk for f in level]))
+
+    docs = list(Document.objects.only('id', 'name', 'folder'))
+    for d in docs:
+        parent_path = paths[d.folder_id] if d.folder_id is not None else ''
+        d.path = parent_path + '/' + d.name
+    Document.objects.bulk_update(docs, ['path'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0003_auto_20210912_1911'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='contents',
+            field=models.TextField(),
+        ),
+        migrations.RunPython(populate_paths, migrations.RunPython.noop),
+    ]
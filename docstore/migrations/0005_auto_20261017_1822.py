@@ -0,0 +1,57 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_closure(apps, schema_editor):
+    Folder = apps.get_model('docstore', 'Folder')
+    FolderClosure = apps.get_model('docstore', 'FolderClosure')
+
+    # walk the tree from the roots down, giving each folder its parent's
+    # ancestors plus a link to itself.
+    ancestors = {}
+    level = list(Folder.objects.filter(parent__isnull=True).values_list('id', 'parent_id'))
+    while level:
+        links = []
+        for folder_id, parent_id in level:
+            chain = [(folder_id, 0)]
+            if parent_id is not None:
+                chain += [(a, d + 1) for a, d in ancestors[parent_id]]
+            ancestors[folder_id] = chain
+            links += [FolderClosure(ancestor_id=a, descendant_id=folder_id, depth=d) for a, d in chain]
+        FolderClosure.objects.bulk_create(links, batch_size=1000)
+        level = list(Folder.objects.filter(parent__in=[f for f, _ in level]).values_list('id', 'parent_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0004_auto_20261017_1820'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='folder',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.CreateModel(
+            name='FolderClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='docstore.folder')),
+                ('descendant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='docstore.folder')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='folderclosure',
+            index=models.Index(fields=['descendant', 'depth'], name='docstore_fo_descend_f1274e_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='folderclosure',
+            unique_together={('ancestor', 'descendant')},
+        ),
+        migrations.RunPython(populate_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:24
+
+import io
+
+from django.db import migrations, models
+
+
+def move_contents_to_blob_store(apps, schema_editor):
+    from docstore.storage import get_blob_storage
+
+    Document = apps.get_model('docstore', 'Document')
+    storage = get_blob_storage()
+
+    batch = []
+    for d in Document.objects.only('id', 'contents').iterator(chunk_size=500):
+        d.content_hash, d.size = storage.save(io.BytesIO(d.contents.encode('utf-8')))
+        batch.append(d)
+        if len(batch) >= 500:
+            Document.objects.bulk_update(batch, ['content_hash', 'size'])
+            batch = []
+    Document.objects.bulk_update(batch, ['content_hash', 'size'])
+
+
+def move_contents_to_database(apps, schema_editor):
+    from docstore.storage import get_blob_storage
+
+    Document = apps.get_model('docstore', 'Document')
+    storage = get_blob_storage()
+
+    batch = []
+    for d in Document.objects.only('id', 'content_hash').iterator(chunk_size=500):
+        d.contents = ''
+        if d.content_hash:
+            with storage.open(d.content_hash) as f:
+                d.contents = f.read().decode('utf-8', errors='replace')
+        batch.append(d)
+        if len(batch) >= 500:
+            Document.objects.bulk_update(batch, ['contents'])
+            batch = []
+    Document.objects.bulk_update(batch, ['contents'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0005_auto_20261017_1822'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='contents',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(move_contents_to_blob_store, move_contents_to_database),
+        migrations.RemoveField(
+            model_name='document',
+            name='contents',
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:31
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+INDEX_NAME = 'docstore_document_search_gin'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX {:s} ON docstore_document USING gin (search_vector)'.format(INDEX_NAME)
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS {:s}'.format(INDEX_NAME))
+
+
+def populate_search_vectors(apps, schema_editor):
+    from docstore.search import MAX_INDEXED_BYTES, search_vector_value
+    from docstore.storage import get_blob_storage
+
+    Document = apps.get_model('docstore', 'Document')
+    db = schema_editor.connection.alias
+    storage = get_blob_storage()
+
+    batch = []
+    for d in Document.objects.using(db).only('id', 'name', 'content_hash').iterator(chunk_size=500):
+        text = ''
+        if d.content_hash:
+            with storage.open(d.content_hash) as f:
+                text = f.read(MAX_INDEXED_BYTES).decode('utf-8', errors='ignore').replace('\x00', ' ')
+        d.search_vector = search_vector_value(d.name, text, db)
+        batch.append(d)
+        if len(batch) >= 500:
+            Document.objects.using(db).bulk_update(batch, ['search_vector'])
+            batch = []
+    Document.objects.using(db).bulk_update(batch, ['search_vector'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0006_auto_20261017_1824'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(populate_search_vectors, migrations.RunPython.noop),
+    ]
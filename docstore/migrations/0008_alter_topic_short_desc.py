@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0007_document_search_vector'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='topic',
+            name='short_desc',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.7 on 2026-10-17 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0008_alter_topic_short_desc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['id'], include=('version', 'updated_at'), name='docstore_document_version_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['id'], include=('version', 'updated_at'), name='docstore_folder_version_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=models.Index(fields=['id'], include=('version', 'updated_at'), name='docstore_topic_version_idx'),
+        ),
+    ]
@@ -0,0 +1,227 @@
+"""
+Switch topics, folders and documents from UUID primary keys to bigint serials,
+keeping the UUIDs as their public IDs.
+
+A primary key's type can't be changed in place while other tables refer to it,
+so each table is rebuilt: new tables are created alongside the old ones, every
+row is copied across with INSERT ... SELECT statements that translate the
+foreign keys from UUIDs to the new IDs, and the old tables are then dropped and
+the new ones renamed into their place. It all happens in the migration's
+transaction, so either everything is rewritten or nothing is.
+
+Rows are copied in path order, so that the documents in a folder get
+neighbouring IDs and are stored next to each other.
+
+The folder closure table is not copied but rebuilt from the new parent links
+at the end, one level of the tree per statement. Renaming a table that another
+table has two foreign keys to leaves one of them pointing at the old table on
+SQLite, so it is created once the folder table has its final name.
+"""
+
+import uuid
+
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+SEARCH_INDEX = 'docstore_document_search_gin'
+
+
+def copy_rows(apps, schema_editor):
+    connection = schema_editor.connection
+    qn = connection.ops.quote_name
+
+    def table(name):
+        return qn(apps.get_model('docstore', name)._meta.db_table)
+
+    def through(name):
+        field = apps.get_model('docstore', name)._meta.get_field('topics')
+        return qn(field.m2m_db_table()), qn(field.m2m_column_name()), qn(field.m2m_reverse_name())
+
+    names = {
+        'topic': table('Topic'), 'folder': table('Folder'), 'document': table('Document'),
+        'new_topic': table('NewTopic'), 'new_folder': table('NewFolder'), 'new_document': table('NewDocument'),
+    }
+    statements = [
+        'INSERT INTO {new_topic} (uuid, short_desc, full_desc, version, updated_at) '
+        'SELECT id, short_desc, full_desc, version, updated_at FROM {topic} ORDER BY updated_at, id',
+
+        # parents are filled in once every folder has its new ID
+        'INSERT INTO {new_folder} (uuid, name, path, version, updated_at) '
+        'SELECT id, name, path, version, updated_at FROM {folder} ORDER BY path, id',
+        'UPDATE {new_folder} SET parent_id = ('
+        ' SELECT p.id FROM {folder} o INNER JOIN {new_folder} p ON p.uuid = o.parent_id'
+        ' WHERE o.id = {new_folder}.uuid'
+        ')',
+
+        'INSERT INTO {new_document} (uuid, name, folder_id, content_hash, size, search_vector, path, version, updated_at) '
+        'SELECT o.id, o.name, f.id, o.content_hash, o.size, o.search_vector, o.path, o.version, o.updated_at '
+        'FROM {document} o LEFT OUTER JOIN {new_folder} f ON f.uuid = o.folder_id ORDER BY o.path, o.id',
+    ]
+    for model, new_model in (('Folder', 'NewFolder'), ('Document', 'NewDocument')):
+        old_table, old_source, old_target = through(model)
+        new_table, new_source, new_target = through(new_model)
+        statements.append(
+            'INSERT INTO {new_table} ({new_source}, {new_target}) '
+            'SELECT s.id, t.id FROM {old_table} l '
+            'INNER JOIN {new_objects} s ON s.uuid = l.{old_source} '
+            'INNER JOIN {{new_topic}} t ON t.uuid = l.{old_target}'.format(
+                new_table=new_table, new_source=new_source, new_target=new_target,
+                old_table=old_table, old_source=old_source, old_target=old_target,
+                new_objects=names['new_' + model.lower()],
+            )
+        )
+
+    for sql in statements:
+        schema_editor.execute(sql.format(**names))
+
+    if connection.vendor == 'postgresql':
+        # built after the copy, which is much faster than keeping it up to date
+        # row by row.
+        schema_editor.execute('DROP INDEX IF EXISTS {:s}'.format(SEARCH_INDEX))
+        schema_editor.execute('CREATE INDEX {:s} ON {:s} USING gin (search_vector)'.format(
+            SEARCH_INDEX, names['new_document'],
+        ))
+
+
+def rewrite_jobs(apps, schema_editor):
+    # background subtree deletes that have not finished yet refer to their
+    # folder by its old ID, which is now its public ID.
+    Job = apps.get_model('docstore', 'Job')
+    NewFolder = apps.get_model('docstore', 'NewFolder')
+    db = schema_editor.connection.alias
+
+    for job in Job.objects.using(db).filter(kind='delete_subtree', status__in=['pending', 'running']):
+        pk = NewFolder.objects.using(db).filter(uuid=job.params['folder_id']).values_list('pk', flat=True).first()
+        if pk is None:
+            # the folder is already gone, so there is nothing left to do
+            job.status = 'done'
+        else:
+            job.params['folder_id'] = pk
+        job.save(update_fields=['params', 'status'])
+
+
+def build_closure(apps, schema_editor):
+    Folder = apps.get_model('docstore', 'Folder')
+    FolderClosure = apps.get_model('docstore', 'FolderClosure')
+    qn = schema_editor.connection.ops.quote_name
+    names = {'folder': qn(Folder._meta.db_table), 'closure': qn(FolderClosure._meta.db_table)}
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {closure} (ancestor_id, descendant_id, depth) SELECT id, id, 0 FROM {folder}'.format(**names)
+        )
+        # every link of length n + 1 extends a link of length n by one child
+        depth = 0
+        while True:
+            cursor.execute(
+                'INSERT INTO {closure} (ancestor_id, descendant_id, depth) '
+                'SELECT c.ancestor_id, f.id, c.depth + 1 FROM {folder} f '
+                'INNER JOIN {closure} c ON c.descendant_id = f.parent_id '
+                'WHERE c.depth = %s'.format(**names),
+                [depth],
+            )
+            if cursor.rowcount == 0:
+                break
+            depth += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0010_job'),
+    ]
+
+    operations = [
+        # rebuilt at the end; see above
+        migrations.DeleteModel(name='FolderClosure'),
+        # the new tables' indexes take over these names
+        migrations.RemoveIndex(model_name='topic', name='docstore_topic_version_idx'),
+        migrations.RemoveIndex(model_name='folder', name='docstore_folder_version_idx'),
+        migrations.RemoveIndex(model_name='document', name='docstore_document_version_idx'),
+
+        migrations.CreateModel(
+            name='NewTopic',
+            fields=[
+                ('version', models.PositiveIntegerField(default=1, editable=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('short_desc', models.CharField(db_index=True, max_length=255)),
+                ('full_desc', models.TextField()),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['uuid'], include=('id', 'version', 'updated_at'), name='docstore_topic_version_idx'),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='NewFolder',
+            fields=[
+                ('version', models.PositiveIntegerField(default=1, editable=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('path', models.TextField(default='', editable=False)),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='docstore.newfolder')),
+                ('topics', models.ManyToManyField(blank=True, related_name='folders', to='docstore.NewTopic')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['uuid'], include=('id', 'version', 'updated_at'), name='docstore_folder_version_idx'),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='NewDocument',
+            fields=[
+                ('version', models.PositiveIntegerField(default=1, editable=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('content_hash', models.CharField(db_index=True, default='', editable=False, max_length=64)),
+                ('size', models.BigIntegerField(default=0, editable=False)),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(editable=False, null=True)),
+                ('path', models.TextField(default='', editable=False)),
+                ('folder', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='documents', to='docstore.newfolder')),
+                ('topics', models.ManyToManyField(blank=True, related_name='documents', to='docstore.NewTopic')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['uuid'], include=('id', 'version', 'updated_at'), name='docstore_document_version_idx'),
+                ],
+            },
+        ),
+        migrations.RunPython(copy_rows),
+        migrations.RunPython(rewrite_jobs),
+
+        migrations.DeleteModel(name='Document'),
+        migrations.DeleteModel(name='Folder'),
+        migrations.DeleteModel(name='Topic'),
+
+        # the join tables and their columns are renamed along with them
+        migrations.RenameModel(old_name='NewTopic', new_name='Topic'),
+        migrations.RenameModel(old_name='NewFolder', new_name='Folder'),
+        migrations.RenameModel(old_name='NewDocument', new_name='Document'),
+
+        migrations.CreateModel(
+            name='FolderClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='docstore.folder')),
+                ('descendant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='docstore.folder')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['descendant', 'depth'], name='docstore_fo_descend_f1274e_idx'),
+                ],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+
+        migrations.RunPython(build_closure),
+    ]
@@ -0,0 +1,75 @@
+"""
+Add the denormalized document counters to folders and topics, and count them
+for the existing rows.
+"""
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_documents(apps, schema_editor):
+    Topic = apps.get_model('docstore', 'Topic')
+    Folder = apps.get_model('docstore', 'Folder')
+    Document = apps.get_model('docstore', 'Document')
+    TopicLinks = Document._meta.get_field('topics').remote_field.through
+
+    def counters(queryset, group_by, size_field):
+        queryset = queryset.order_by().values(group_by)
+        count = queryset.annotate(n=Count('pk')).values('n')
+        size = queryset.annotate(size=Sum(size_field)).values('size')
+        return Coalesce(Subquery(count), 0), Coalesce(Subquery(size), 0)
+
+    direct_count, direct_size = counters(Document.objects.filter(folder=OuterRef('pk')), 'folder', 'size')
+    subtree_count, subtree_size = counters(
+        Document.objects.filter(folder__ancestor_links__ancestor=OuterRef('pk')),
+        'folder__ancestor_links__ancestor', 'size',
+    )
+    Folder.objects.update(
+        document_count=direct_count, document_size=direct_size,
+        subtree_document_count=subtree_count, subtree_document_size=subtree_size,
+    )
+
+    linked_count, linked_size = counters(TopicLinks.objects.filter(topic=OuterRef('pk')), 'topic', 'document__size')
+    Topic.objects.update(document_count=linked_count, document_size=linked_size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('docstore', '0012_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='document_count',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='document_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='subtree_document_count',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='subtree_document_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='document_count',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='document_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_documents, migrations.RunPython.noop),
+    ]
@@ -1,47 +1,326 @@
+import io
 import uuid
+from collections import defaultdict
+from typing import BinaryIO, List
 
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat, Substr
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .storage import get_blob_storage
 
 # Create your models here.
 
 """
-Note - To simplify the model design, these models use UUIDs as their IDs, and as
-their primary keys. UUIDs as primary keys may lead to poor performance on
-associated foreign key lookups in Postgres. In addition, it affects data
-locality on disk for neighboring records. This is probably not an issue for a
-rapid prototype, but if this is going to be used at
-scale, making the UUID its own property with a secondary index on it that is used
-solely for external identifiers and keeping the record ID (and PK) as type
-serial should be looked into.
+Note - Topics, folders and documents have two IDs. The primary key is a bigint
+serial, which keeps foreign keys, the topic join tables and the closure table
+small and makes neighbouring records neighbours on disk too. The UUID in
+'uuid' is the public ID: it is what the API calls 'id' and what clients refer
+to objects by, so the primary keys never leave the server. It has its own
+unique index for looking objects up by it.
 """
 
-class Topic(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    short_desc = models.CharField(max_length=255)
+# Sent with the model class and a list of PKs whenever the versions of those
+# objects are bumped, so that anything derived from their detail output can be
+# dropped.
+versions_bumped = Signal()
+
+
+class VersionedQuerySet(models.QuerySet):
+    def touch(self, **fields) -> int:
+        """
+        Mark the detail output of every object in the queryset as changed by
+        bumping its version. Any keyword arguments are further fields to update
+        in the same statement.
+        """
+        values = dict(fields, version=F('version') + 1, updated_at=timezone.now())
+        if not versions_bumped.has_listeners(self.model):
+            return self.update(**values)
+
+        pks = list(self.values_list('pk', flat=True))
+        if not pks:
+            return 0
+        count = self.model._default_manager.filter(pk__in=pks).update(**values)
+        versions_bumped.send(sender=self.model, pks=pks)
+        return count
+
+
+class PublicIdQuerySet(VersionedQuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        # not every database gives back the primary keys of the rows that a
+        # bulk insert created (SQLite does not with this version of Django), so
+        # any that are missing are looked up by their public IDs.
+        missing = {obj.uuid: obj for obj in objs if obj.pk is None}
+        uuids = list(missing)
+        for start in range(0, len(uuids), 500):
+            rows = self.filter(uuid__in=uuids[start:start + 500]).values_list('uuid', 'pk')
+            for public_id, pk in rows:
+                missing[public_id].pk = pk
+        return objs
+
+
+class VersionedModel(models.Model):
+    """
+    Base for models whose detail output is versioned, for ETags and conditional
+    requests. The version is bumped whenever anything in the object's detail
+    output changes, including the nested objects it contains; see
+    docstore.versions.
+    """
+
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = VersionedQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class PublicIdModel(VersionedModel):
+    """
+    Base for models with a bigint primary key and a separate public UUID; see
+    the note at the top of the module.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    objects = PublicIdQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class CountedModel(PublicIdModel):
+    """
+    Base for models that keep counters of the documents in or linked to them;
+    see docstore.counters. The counters are only ever changed by adding to
+    them in the database, so saving an object leaves them alone rather than
+    writing back whatever values it was loaded with.
+    """
+
+    counter_fields = ()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname not in deferred and f.name not in self.counter_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class Topic(CountedModel):
+    short_desc = models.CharField(max_length=255, db_index=True)
     full_desc = models.TextField()
 
+    # Number and total size of the documents linked to the topic, kept up to
+    # date as documents change; see docstore.counters.
+    document_count = models.BigIntegerField(default=0, editable=False)
+    document_size = models.BigIntegerField(default=0, editable=False)
+
+    counter_fields = ('document_count', 'document_size')
+
+    class Meta:
+        indexes = [
+            # lets conditional requests look up the primary key and version
+            # of an object by its public ID with an index-only scan on
+            # Postgres.
+            models.Index(fields=['uuid'], include=['id', 'version', 'updated_at'], name='docstore_topic_version_idx'),
+        ]
+
     def __str__(self):
         return self.short_desc
 
 
-class Folder(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    name = models.CharField(max_length=255)
+class Folder(CountedModel):
+    name = models.CharField(max_length=255, db_index=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True)
     topics = models.ManyToManyField(Topic, related_name='folders', blank=True)
 
+    # Materialized full path of the folder. Computed on save rather than on
+    # every read so that serializing a folder does not need to walk up the
+    # tree one query at a time.
+    path = models.TextField(editable=False, default='')
+
+    # Number and total size of the documents directly in the folder, and in the
+    # folder and all of its subfolders, kept up to date as documents change;
+    # see docstore.counters.
+    document_count = models.BigIntegerField(default=0, editable=False)
+    document_size = models.BigIntegerField(default=0, editable=False)
+    subtree_document_count = models.BigIntegerField(default=0, editable=False)
+    subtree_document_size = models.BigIntegerField(default=0, editable=False)
+
+    counter_fields = ('document_count', 'document_size', 'subtree_document_count', 'subtree_document_size')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['uuid'], include=['id', 'version', 'updated_at'], name='docstore_folder_version_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
-    @property
-    def path(self) -> str:
+    def compute_path(self) -> str:
         path = '/' + self.name
         if self.parent is not None:
             path = self.parent.path + path
         return path
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if not adding:
+            old_parent_id, old_path = Folder.objects.filter(pk=self.pk).values_list('parent_id', 'path').get()
+
+        self.path = self.compute_path()
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                FolderClosure.objects.insert_leaf(self)
+            else:
+                if old_parent_id != self.parent_id:
+                    FolderClosure.objects.move_subtree(self)
+                if old_path != self.path:
+                    self._rewrite_descendant_paths(old_path, self.path)
+
+    def _rewrite_descendant_paths(self, old_prefix: str, new_prefix: str):
+        # every descendant's path starts with old_prefix, so swapping the prefix
+        # in SQL is enough to fix up the entire subtree. The path is part of the
+        # output of everything in the subtree, so they are all given new
+        # versions too, along with every topic that includes any of them.
+        new_path = Concat(Value(new_prefix), Substr('path', len(old_prefix) + 1))
+        subtree = FolderClosure.objects.subtree(self.pk)
+
+        Folder.objects.filter(pk__in=subtree).exclude(pk=self.pk).touch(path=new_path)
+        Document.objects.filter(folder__in=subtree).touch(path=new_path)
+
+        folder_topics = Folder.topics.through.objects.filter(folder_id__in=subtree).values('topic_id')
+        document_topics = Document.topics.through.objects.filter(document__folder__in=subtree).values('topic_id')
+        Topic.objects.filter(Q(pk__in=folder_topics) | Q(pk__in=document_topics)).touch()
+
+
+class FolderClosureManager(models.Manager):
+    def subtree(self, folder_id) -> models.QuerySet:
+        """
+        Return the IDs of the given folder and all folders beneath it, for use
+        as a subquery.
+        """
+        return self.filter(ancestor_id=folder_id).values('descendant_id')
+
+    def insert_leaf(self, folder: Folder):
+        """
+        Add the ancestry rows for a newly-created folder, which cannot have any
+        descendants yet.
+        """
+        self.insert_leaves([folder])
+
+    def insert_leaves(self, folders: List[Folder]):
+        """
+        Add the ancestry rows for several newly-created folders at once. The
+        parents of the folders must already have their own rows.
+        """
+        self.bulk_create(self.leaf_links(folders))
+
+    def leaf_links(self, folders: List[Folder]) -> list:
+        """
+        Give the unsaved ancestry rows that insert_leaves() would add.
+        """
+        parent_ids = {f.parent_id for f in folders if f.parent_id is not None}
+        parent_links = defaultdict(list)
+        for desc, anc, depth in self.filter(descendant_id__in=parent_ids).values_list('descendant_id', 'ancestor_id', 'depth'):
+            parent_links[desc].append((anc, depth))
+
+        links = []
+        for f in folders:
+            links.append(self.model(ancestor_id=f.pk, descendant_id=f.pk, depth=0))
+            links += [self.model(ancestor_id=a, descendant_id=f.pk, depth=d + 1) for a, d in parent_links[f.parent_id]]
+        return links
 
-class Document(models.Model):
+    def move_subtree(self, folder: Folder):
+        """
+        Re-link the ancestry rows of a folder and all of its descendants after
+        the folder's parent has changed. This is two set-based statements no
+        matter how large the subtree is.
+        """
+        subtree = self.subtree(folder.pk)
+
+        # the documents in the subtree stop counting towards the subtree totals
+        # of the folders it was moved out of, and start counting towards the
+        # ones it was moved into.
+        totals = Folder.objects.filter(pk=folder.pk).values_list('subtree_document_count', 'subtree_document_size').get()
+        self._add_to_ancestors(folder, *(-n for n in totals))
+
+        # detach the subtree from all of its old ancestors, but keep the links
+        # that are within the subtree itself.
+        self.filter(descendant_id__in=subtree).exclude(ancestor_id__in=subtree).delete()
+
+        if folder.parent_id is None:
+            return
+
+        # link every ancestor of the new parent to every member of the subtree.
+        # The ORM cannot express INSERT ... SELECT, so it is done by hand.
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        ancestor_col = opts.get_field('ancestor').column
+        descendant_col = opts.get_field('descendant').column
+        folder_pk = Folder._meta.pk
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} ({anc}, {desc}, depth) '
+                'SELECT a.{anc}, s.{desc}, a.depth + s.depth + 1 '
+                'FROM {table} a CROSS JOIN {table} s '
+                'WHERE a.{desc} = %s AND s.{anc} = %s'.format(
+                    table=qn(opts.db_table), anc=qn(ancestor_col), desc=qn(descendant_col),
+                ),
+                [
+                    folder_pk.get_db_prep_value(folder.parent_id, connection),
+                    folder_pk.get_db_prep_value(folder.pk, connection),
+                ],
+            )
+
+        self._add_to_ancestors(folder, *totals)
+
+    def _add_to_ancestors(self, folder: Folder, count: int, size: int):
+        if count or size:
+            ancestors = self.filter(descendant_id=folder.pk, depth__gt=0).values('ancestor_id')
+            Folder.objects.filter(pk__in=ancestors).update(
+                subtree_document_count=F('subtree_document_count') + count,
+                subtree_document_size=F('subtree_document_size') + size,
+            )
+
+
+class FolderClosure(models.Model):
+    """
+    Ancestry table for folders. There is one row for every pair of a folder and
+    one of its ancestors, plus one row pairing each folder with itself at depth
+    0. This lets "everything under folder X" be answered with a single indexed
+    lookup instead of walking the tree.
+    """
+
+    # both foreign keys are already covered by the composite indexes below.
+    ancestor = models.ForeignKey(Folder, related_name='descendant_links', on_delete=models.CASCADE, db_index=False)
+    descendant = models.ForeignKey(Folder, related_name='ancestor_links', on_delete=models.CASCADE, db_index=False)
+    depth = models.PositiveIntegerField()
+
+    objects = FolderClosureManager()
+
+    class Meta:
+        unique_together = [('ancestor', 'descendant')]
+        indexes = [models.Index(fields=['descendant', 'depth'])]
+
+
+class Document(PublicIdModel):
     """
     Document looks very similar to Folder except that field 'parent' is replaced
     with field 'folder'. It is possible the two could be combined, but this
@@ -50,36 +329,141 @@ class Document(models.Model):
 
     THE 'contents' FIELD:
     ---------------------
-    This model implies storing document contents directly in the database as
-    text, perhaps as base64. This
-    is an extremely poor design in almost all cases, but as this is merely a
-    prototype, it will be allowed for this case. It will lead to abyssmal
-    database performance. For actual implementation, consider replacing this
-    field with perhaps a "filename_on_disk" field which would refer to where the
-    file is on disk. If further extensibility is needed, consider replacing
-    direct filesystem lookup with a file-retrieval service.
-
-    Alternatively, if the requirement that an RDBMS be used is flexible, it's
-    possible that a document-oriented NoSQL DB such as MongoDB may be better for
-    this system.
+    Document contents are not stored in the database. The bytes live in the
+    blob store configured with DOCSTORE_BLOB_STORAGE (see docstore.storage),
+    and the row only records the hash they are stored under and their size.
+    This keeps document rows small, and lets large contents be streamed to
+    clients straight from storage.
+
+    'contents' is kept as a text property so that the JSON API can keep
+    reading and writing document contents as a string. Binary contents should
+    be read from the document's contents endpoint instead.
     """
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
     folder = models.ForeignKey(Folder, related_name='documents', on_delete=models.CASCADE, null=True)
     topics = models.ManyToManyField(Topic, related_name='documents', blank=True)
-    
-    # See class comment for justification on use of large TextField
-    contents = models.TextField()
+
+    # See class comment for where the contents themselves are kept. An empty
+    # hash means the document has no contents.
+    content_hash = models.CharField(max_length=64, editable=False, default='', db_index=True)
+    size = models.BigIntegerField(editable=False, default=0)
+
+    # Full-text search data for the document's name and contents, rebuilt
+    # whenever the document is saved; see docstore.search. On Postgres this has
+    # a GIN index, which is created in the migrations as it cannot be declared
+    # here without breaking other databases.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Materialized full path of the document; see Folder.path.
+    path = models.TextField(editable=False, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['uuid'], include=['id', 'version', 'updated_at'], name='docstore_document_version_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
-    @property
-    def path(self) -> str:
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the folder the document was loaded in, so that the old
+        # folder can be told about it when the document is moved.
+        instance._loaded_folder_id = instance.__dict__.get('folder_id')
+        # and what it counted towards, so that saves which change neither do
+        # not have to work out what they took away from the counters.
+        instance._loaded_counted = (instance._loaded_folder_id, instance.__dict__.get('size'))
+        return instance
+
+    def compute_path(self) -> str:
         path = '/' + self.name
         if self.folder is not None:
             path = self.folder.path + path
         return path
 
-    
\ No newline at end of file
+    def save(self, *args, **kwargs):
+        self.path = self.compute_path()
+        # the signal handlers that update the folder and topic counters run in
+        # the same transaction as the save.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    @property
+    def contents(self) -> str:
+        with self.open_contents() as f:
+            return f.read().decode('utf-8', errors='replace')
+
+    @contents.setter
+    def contents(self, value: str):
+        self.set_contents(io.BytesIO(value.encode('utf-8')))
+
+    def open_contents(self) -> BinaryIO:
+        if not self.content_hash:
+            return io.BytesIO()
+        return get_blob_storage().open(self.content_hash)
+
+    def set_contents(self, stream: BinaryIO):
+        """
+        Write new contents for the document to the blob store. The document
+        must still be saved afterwards for it to refer to them.
+        """
+        self.content_hash, self.size = get_blob_storage().save(stream)
+
+
+class Job(models.Model):
+    """
+    A long-running operation, such as deleting a large folder subtree, that is
+    done in the background while clients poll it for progress. See
+    docstore.jobs.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(s, s) for s in (PENDING, RUNNING, DONE, FAILED)]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=64)
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING, db_index=True)
+
+    # units of work done out of the total, for reporting progress
+    total = models.PositiveBigIntegerField(default=0)
+    completed = models.PositiveBigIntegerField(default=0)
+
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{:s} {:s}'.format(self.kind, str(self.pk))
+
+
+class Upload(models.Model):
+    """
+    Contents being uploaded a chunk at a time, to be attached to a new or
+    existing document once they are all there. The chunks received so far are
+    kept in a file on disk rather than in the table; see docstore.uploads.
+    """
+
+    PENDING = 'pending'
+    COMMITTED = 'committed'
+    STATUSES = [(s, s) for s in (PENDING, COMMITTED)]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # the document whose contents are being replaced, or None for the contents
+    # of a new document.
+    document = models.ForeignKey(Document, related_name='uploads', on_delete=models.CASCADE, null=True)
+    # the size of the whole contents, if the client gave it
+    size = models.PositiveBigIntegerField(null=True)
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return 'upload {:s}'.format(str(self.pk))
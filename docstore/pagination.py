@@ -0,0 +1,46 @@
+from rest_framework import status
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+from .streaming import STREAM_FORMATS, streaming_response
+
+
+class DocstoreCursorPagination(CursorPagination):
+    """
+    Keyset pagination for the list endpoints. The cursor is an opaque encoding
+    of the last ID seen, so fetching any page is a single range scan on the
+    primary key index no matter how deep into the listing it is.
+
+    Ordering is by primary key alone, which is roughly the order the objects
+    were created in.
+    """
+
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class PaginatedListMixin:
+    """
+    Gives an APIView the same pagination hooks as DRF's generic views, without
+    needing to convert it to one.
+
+    Clients may instead ask for the whole listing in one streamed response with
+    a 'stream' query parameter of 'json' or 'ndjson'; see docstore.streaming.
+    """
+
+    pagination_class = DocstoreCursorPagination
+
+    def paginated_response(self, queryset, serializer_class, **serializer_kwargs):
+        fmt = self.request.query_params.get('stream')
+        if fmt:
+            if fmt not in STREAM_FORMATS:
+                msg = "Must be one of: {:s}.".format(', '.join(STREAM_FORMATS))
+                return Response({'stream': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+            return streaming_response(queryset, serializer_class, fmt, **serializer_kwargs)
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(queryset, self.request, view=self)
+        serializer = serializer_class(page, many=True, **serializer_kwargs)
+        return paginator.get_paginated_response(serializer.data)
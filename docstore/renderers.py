@@ -0,0 +1,70 @@
+"""
+JSON output through orjson, which encodes several times faster than the
+standard library's json module that DRF's JSONRenderer uses. It handles UUIDs,
+dicts and lists itself, which covers nearly everything the API outputs. The
+rest, and datetimes, which orjson would format differently, are passed to
+DRF's encoder, so the output is the same as DRF's.
+
+RenderedResponse carries output that was rendered ahead of time, such as a
+cached or shared detail response, so it is not rendered again for every
+request it is sent to.
+"""
+
+import orjson
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .instrumentation import serializing
+
+_fallback = JSONEncoder()
+
+_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data) -> bytes:
+    return orjson.dumps(data, default=_fallback.default, option=_OPTIONS)
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        if data is None:
+            return b''
+        with serializing():
+            return dumps(data)
+
+
+class RenderedResponse(Response):
+    """
+    A Response whose body is JSON that ORJSONRenderer has already rendered.
+    The body is sent as it is when the JSON renderer is picked, and only
+    decoded back into .data when something else needs it, such as the
+    browsable API.
+    """
+
+    def __init__(self, body: bytes, **kwargs):
+        self._rendered = body
+        self._data = None
+        super().__init__(**kwargs)
+
+    @property
+    def data(self):
+        if self._data is None and self._rendered is not None:
+            self._data = orjson.loads(self._rendered)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def rendered_content(self):
+        if not isinstance(getattr(self, 'accepted_renderer', None), ORJSONRenderer):
+            return super().rendered_content
+        if self.content_type is None:
+            self['Content-Type'] = ORJSONRenderer.media_type
+        return self._rendered
@@ -0,0 +1,80 @@
+"""
+Database routing for read replicas.
+
+Views that only read are decorated with read_from_replica, and the queries
+they run go to one of the databases listed in DOCSTORE_READ_REPLICAS, so that
+read traffic does not compete with writes and imports on the primary.
+Everything else, including every write, goes to the default database.
+
+Each request reads from a single replica for all of its queries. Replicas lag
+behind the primary, and two of them lag by different amounts, so an ETag read
+from one could otherwise be newer than a body read from another. Views that
+must see their own writes straight away, such as job progress, are left on the
+primary.
+"""
+
+import asyncio
+import functools
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_replica: ContextVar[Optional[str]] = ContextVar('docstore_replica', default=None)
+
+
+@contextmanager
+def replica_reads():
+    """
+    Send the reads in the block to one of the read replicas, picked at random.
+    Does nothing if there are none.
+    """
+    replicas = settings.DOCSTORE_READ_REPLICAS
+    token = _replica.set(random.choice(replicas) if replicas else None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def read_from_replica(func):
+    """
+    Decorate a view, or a view's handler method, to have its reads sent to a
+    read replica. Async views are supported; the worker threads they hand
+    database work to inherit the replica.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with replica_reads():
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # None leaves it to Django, which reads related objects from the
+        # database their parent came from and everything else from the default.
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        # always the primary, even for objects that were read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.DOCSTORE_READ_REPLICAS:
+            return False
+        return None
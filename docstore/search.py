@@ -0,0 +1,145 @@
+"""
+Full-text search over document names and contents.
+
+On Postgres every document has a stored tsvector built from its name and the
+start of its contents, with a GIN index over it, so searching never has to read
+the contents themselves. The vector is rebuilt whenever a document is saved.
+
+Other databases (SQLite, in tests) get a fallback: the same column holds the
+lowercased text instead, and is searched with a simple substring match.
+"""
+
+import html
+import re
+from typing import List
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import F, FloatField, TextField, Value
+from django.db.models.functions import Length
+
+# tsvectors are limited to 1MB in Postgres, so only the start of large documents
+# is indexed.
+MAX_INDEXED_BYTES = 256 * 1024
+
+SNIPPET_WORDS = 30
+
+# marks the start and end of matches in snippets from Postgres
+_START = '\x02'
+_STOP = '\x03'
+
+
+def _is_postgres(db: str) -> bool:
+    return connections[db].vendor == 'postgresql'
+
+
+def read_search_text(doc) -> str:
+    with doc.open_contents() as f:
+        text = f.read(MAX_INDEXED_BYTES).decode('utf-8', errors='ignore')
+    # Postgres text values cannot contain NUL characters
+    return text.replace('\x00', ' ')
+
+
+def search_vector_value(name: str, text: str, db: str = 'default'):
+    """
+    Give the value to store in a document's search_vector column, for use in an
+    update() or bulk_update().
+    """
+    if _is_postgres(db):
+        config = settings.DOCSTORE_SEARCH_CONFIG
+        return (
+            SearchVector(Value(name, output_field=TextField()), weight='A', config=config)
+            + SearchVector(Value(text, output_field=TextField()), weight='B', config=config)
+        )
+    return (name + '\n' + text).lower()
+
+
+def update_search_vectors(documents: list, db: str = 'default'):
+    """
+    Rebuild the search vectors of the given documents with one bulk update.
+    """
+    if not documents:
+        return
+    model = type(documents[0])
+    for d in documents:
+        d.search_vector = search_vector_value(d.name, read_search_text(d), db)
+    model.objects.using(db).bulk_update(documents, ['search_vector'], batch_size=500)
+
+
+def search_documents(queryset, q: str):
+    """
+    Filter a Document queryset down to the documents matching q and annotate
+    them with a 'rank', best matches first.
+    """
+    db = queryset.db
+    if _is_postgres(db):
+        query = SearchQuery(q, search_type='websearch', config=settings.DOCSTORE_SEARCH_CONFIG)
+        return (queryset
+                .filter(search_vector=query)
+                .annotate(rank=SearchRank(F('search_vector'), query))
+                .order_by('-rank', 'id'))
+
+    terms = _terms(q)
+    if not terms:
+        return queryset.none()
+    for term in terms:
+        queryset = queryset.filter(search_vector__contains=term)
+    # rank shorter documents, where the terms make up more of the text, higher
+    return (queryset
+            .annotate(rank=Value(1.0, output_field=FloatField()) / (Length('search_vector') + 1))
+            .order_by('-rank', 'id'))
+
+
+def snippets(documents: list, q: str, db: str = 'default') -> List[str]:
+    """
+    Build an HTML snippet of each document's contents with the terms matching q
+    wrapped in <b> tags. Only the documents being returned are read, so this
+    costs at most one query no matter how many documents matched.
+    """
+    texts = [read_search_text(d) for d in documents]
+    if not texts:
+        return []
+
+    if _is_postgres(db):
+        # ts_headline does not escape the text it returns, so matches are
+        # marked with control characters and the escaping and tagging are done
+        # here afterwards.
+        texts = [t.replace(_START, ' ').replace(_STOP, ' ') for t in texts]
+        options = 'MaxWords={:d}, MinWords={:d}, MaxFragments=2, StartSel="{:s}", StopSel="{:s}"'.format(
+            SNIPPET_WORDS, SNIPPET_WORDS // 2, _START, _STOP,
+        )
+        with connections[db].cursor() as cursor:
+            cursor.execute(
+                'SELECT ts_headline(%s::regconfig, t, websearch_to_tsquery(%s::regconfig, %s), %s) '
+                'FROM unnest(%s::text[]) WITH ORDINALITY AS x(t, n) ORDER BY n',
+                [settings.DOCSTORE_SEARCH_CONFIG, settings.DOCSTORE_SEARCH_CONFIG, q, options, texts],
+            )
+            return [
+                html.escape(row[0]).replace(_START, '<b>').replace(_STOP, '</b>')
+                for row in cursor.fetchall()
+            ]
+
+    return [_highlight(text, _terms(q)) for text in texts]
+
+
+def _terms(q: str) -> List[str]:
+    return [t for t in re.findall(r'\w+', q.lower()) if t]
+
+
+def _highlight(text: str, terms: List[str]) -> str:
+    words = text.split()
+    lowered = [w.lower() for w in words]
+
+    # start the snippet a few words before the first match
+    start = 0
+    for i, w in enumerate(lowered):
+        if any(t in w for t in terms):
+            start = max(i - 5, 0)
+            break
+
+    out = []
+    for w, lw in zip(words[start:start + SNIPPET_WORDS], lowered[start:start + SNIPPET_WORDS]):
+        escaped = html.escape(w)
+        out.append('<b>' + escaped + '</b>' if any(t in lw for t in terms) else escaped)
+    return ' '.join(out)
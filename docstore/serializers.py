@@ -1,21 +1,268 @@
+from django.core.exceptions import ObjectDoesNotExist, ValidationError as DjangoValidationError
 from rest_framework import serializers
-from .models import Topic, Folder, Document
+from .counters import Totals
+from .instrumentation import serializing
+from .models import Topic, Folder, FolderClosure, Document, Job, Upload
+from .search import update_search_vectors
+from .versions import documents_changed, folders_changed, topics_changed
 
 # TODO: look into serializers.ModelSerializer and whether it will default to
 # the validation settings given here
 
 
-class DocumentSerializer(serializers.ModelSerializer):
+class PublicIdRelatedField(serializers.RelatedField):
+    """
+    Refers to related objects by their public IDs. When BulkListSerializer has
+    prepared a lookup table of the related objects, they are resolved from it
+    instead of with one query per value.
+    """
+
+    default_error_messages = serializers.PrimaryKeyRelatedField.default_error_messages
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        try:
+            public_id = model._meta.get_field('uuid').to_python(data)
+        except (TypeError, ValueError, DjangoValidationError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        objects = self.context.get('related_objects', {}).get(model)
+        try:
+            if objects is None:
+                return self.get_queryset().get(uuid=public_id)
+            return objects[public_id]
+        except (KeyError, ObjectDoesNotExist):
+            self.fail('does_not_exist', pk_value=data)
+
+    def to_representation(self, value):
+        return value.uuid
+
+
+class TimedOutputMixin:
+    """
+    Counts the time spent building the serializer's output towards the
+    serialization time of the request (see docstore.instrumentation). Timing
+    to_representation() covers .data both with and without many=True, as a
+    ListSerializer calls its child's for each item.
+    """
+
+    def to_representation(self, instance):
+        with serializing():
+            return super().to_representation(instance)
+
+
+class PublicIdSerializer(TimedOutputMixin, serializers.ModelSerializer):
+    """
+    Base for the serializers of topics, folders and documents. Their public IDs
+    are what clients see as their 'id' and refer to them by; the primary keys
+    are never output.
+    """
+
+    id = serializers.UUIDField(source='uuid', read_only=True)
+
+    serializer_related_field = PublicIdRelatedField
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    ListSerializer for the bulk endpoints. Every related object referenced by
+    any of the items is looked up with one query per related model before the
+    items are validated, and saving is handed off to the child serializer's
+    bulk_create() and bulk_update() so that it can be done with bulk queries.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self._context['related_objects'] = self._lookup_related(data)
+        return super().to_internal_value(data)
+
+    def _lookup_related(self, data: list) -> dict:
+        wanted = {}
+        for name, field in self.child.fields.items():
+            if field.read_only:
+                continue
+            many = isinstance(field, serializers.ManyRelatedField)
+            relation = field.child_relation if many else field
+            if not isinstance(relation, PublicIdRelatedField):
+                continue
+
+            model = relation.get_queryset().model
+            public_ids = wanted.setdefault(model, set())
+            for item in data:
+                if not isinstance(item, dict) or item.get(name) is None:
+                    continue
+                values = item[name] if many and isinstance(item[name], list) else [item[name]]
+                for value in values:
+                    try:
+                        public_ids.add(model._meta.get_field('uuid').to_python(value))
+                    except (TypeError, ValueError, DjangoValidationError):
+                        # left for the field itself to report
+                        pass
+
+        return {model: model.objects.in_bulk(ids, field_name='uuid') for model, ids in wanted.items()}
+
+    def create(self, validated_data):
+        return self.child.bulk_create(validated_data)
+
+    def update(self, instances, validated_data):
+        return self.child.bulk_update(instances, validated_data)
+
+
+class BulkSaveMixin:
+    """
+    Implements saving many instances of the serializer's model at once with
+    bulk_create() and bulk_update(), and sets their many-to-many relations with
+    bulk inserts into the through tables. Model-specific fix-ups go in
+    prepare_bulk_save() and after_bulk_create(), and after_bulk_save() is where
+    the versions of everything affected are bumped, as bulk saves do not send
+    any signals.
+    """
+
     class Meta:
+        list_serializer_class = BulkListSerializer
+
+    def prepare_bulk_save(self, instances: list):
+        pass
+
+    def after_bulk_create(self, instances: list):
+        pass
+
+    def after_bulk_update(self, instances: list, changed: set):
+        pass
+
+    def after_bulk_save(self, instances: list, unlinked: dict):
+        """
+        Called once everything has been written. unlinked maps the name of each
+        many-to-many field to the PKs of the objects that the instances were
+        linked to before the save; they may no longer be.
+        """
+        pass
+
+    def bulk_update_fields(self, changed: set) -> set:
+        return changed
+
+    def bulk_create(self, validated_data: list) -> list:
+        model = self.Meta.model
+        m2m = [f.name for f in model._meta.many_to_many]
+
+        instances = []
+        relations = []
+        for attrs in validated_data:
+            attrs = dict(attrs)
+            relations.append({name: attrs.pop(name) for name in m2m if name in attrs})
+            instances.append(model(**attrs))
+
+        self.prepare_bulk_save(instances)
+        model.objects.bulk_create(instances)
+        self.after_bulk_create(instances)
+        unlinked = self._bulk_set_m2m(instances, relations, replace=False)
+        self.after_bulk_save(instances, unlinked)
+        return instances
+
+    def bulk_update(self, instances: list, validated_data: list) -> list:
+        model = self.Meta.model
+        m2m = [f.name for f in model._meta.many_to_many]
+
+        changed = set()
+        relations = []
+        for instance, attrs in zip(instances, validated_data):
+            attrs = dict(attrs)
+            relations.append({name: attrs.pop(name) for name in m2m if name in attrs})
+            for attr, value in attrs.items():
+                setattr(instance, attr, value)
+            changed |= set(attrs)
+
+        self.prepare_bulk_save(instances)
+        fields = self.bulk_update_fields(changed)
+        if fields:
+            model.objects.bulk_update(instances, fields)
+        self.after_bulk_update(instances, changed)
+        unlinked = self._bulk_set_m2m(instances, relations, replace=True)
+        self.after_bulk_save(instances, unlinked)
+        return instances
+
+    def _bulk_set_m2m(self, instances: list, relations: list, replace: bool) -> dict:
+        unlinked = {}
+        for field in self.Meta.model._meta.many_to_many:
+            through = field.remote_field.through
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_field_name() + '_id'
+
+            touched = [inst.pk for inst, rel in zip(instances, relations) if field.name in rel]
+            unlinked[field.name] = set()
+            if replace and touched:
+                old_links = through.objects.filter(**{source + '__in': touched})
+                unlinked[field.name] = set(old_links.values_list(target, flat=True))
+                old_links.delete()
+
+            rows = []
+            for inst, rel in zip(instances, relations):
+                for target_pk in {obj.pk for obj in rel.get(field.name, [])}:
+                    rows.append(through(**{source: inst.pk, target: target_pk}))
+            through.objects.bulk_create(rows)
+        return unlinked
+
+
+class SparseFieldsMixin:
+    """
+    Lets the caller narrow the fields a serializer outputs by passing a 'fields'
+    keyword argument, for sparse fieldset support on the list endpoints.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class DocumentSerializer(BulkSaveMixin, SparseFieldsMixin, PublicIdSerializer):
+    # contents is a property backed by the blob store rather than a model field,
+    # so it has to be declared explicitly to be writable.
+    contents = serializers.CharField(trim_whitespace=False)
+
+    class Meta(BulkSaveMixin.Meta):
         model = Document
-        fields = ['id', 'path', 'name', 'folder', 'topics', 'contents']
+        fields = ['id', 'path', 'name', 'folder', 'topics', 'size', 'contents']
         extra_kwargs = {'topics': {'required': False}}
 
+    def prepare_bulk_save(self, instances):
+        for d in instances:
+            d.path = d.compute_path()
+        # what the documents counted for in the folder and topic counters
+        # before the save; new documents count for nothing yet.
+        self._counted_before = Totals.of_documents([d.pk for d in instances if d.pk is not None])
+
+    def after_bulk_create(self, instances):
+        # bulk_create() sends no signals, so the search vectors that
+        # post_save would have built are built here.
+        update_search_vectors(instances)
+
+    def after_bulk_update(self, instances, changed):
+        if changed & {'name', 'contents'}:
+            update_search_vectors(instances)
+
+    def after_bulk_save(self, instances, unlinked):
+        # folders the documents were moved out of are bumped along with the
+        # ones they are in now.
+        documents_changed(
+            [d.pk for d in instances],
+            folder_ids=[getattr(d, '_loaded_folder_id', None) for d in instances],
+            topic_ids=unlinked.get('topics', ()),
+        )
+        (Totals.of_documents([d.pk for d in instances]) - self._counted_before).apply()
 
-class FolderSerializer(serializers.ModelSerializer):
+    def bulk_update_fields(self, changed):
+        fields = (changed - {'contents'}) | {'path'}
+        if 'contents' in changed:
+            fields |= {'content_hash', 'size'}
+        return fields
+
+
+class FolderSerializer(BulkSaveMixin, PublicIdSerializer):
     documents = DocumentSerializer(many=True, read_only=True)
 
-    class Meta:
+    class Meta(BulkSaveMixin.Meta):
         model = Folder
         fields = ['id', 'path', 'name', 'parent', 'topics', 'documents']
         extra_kwargs = {
@@ -23,12 +270,70 @@ class FolderSerializer(serializers.ModelSerializer):
             'documents': {'required': False},
         }
 
+    def validate_parent(self, value):
+        # a folder cannot be moved inside of itself, or the tree would become a
+        # cycle. Bulk updates are checked as they are saved instead, since
+        # moves earlier in the same batch can change the answer.
+        if isinstance(self.instance, Folder) and value is not None:
+            if FolderClosure.objects.filter(ancestor=self.instance, descendant=value).exists():
+                raise serializers.ValidationError("A folder cannot be moved into itself or one of its subfolders.")
+        return value
+
+    def prepare_bulk_save(self, instances):
+        for f in instances:
+            f.path = f.compute_path()
+
+    def after_bulk_create(self, instances):
+        FolderClosure.objects.insert_leaves(instances)
+
+    def after_bulk_save(self, instances, unlinked):
+        folders_changed([f.pk for f in instances], topic_ids=unlinked.get('topics', ()))
+
+    def bulk_update(self, instances, validated_data):
+        # renaming or moving a folder has to rewrite the subtree beneath it,
+        # which Folder.save() already does with a few set-based statements, so
+        # those folders are saved one at a time. The rest are bulk updated.
+        restructured = []
+        rest_instances, rest_data = [], []
+        for index, (instance, attrs) in enumerate(zip(instances, validated_data)):
+            parent = attrs.get('parent', instance.parent)
+            parent_id = parent.pk if parent is not None else None
+            if attrs.get('name', instance.name) != instance.name or parent_id != instance.parent_id:
+                restructured.append((index, instance, attrs))
+            else:
+                rest_instances.append(instance)
+                rest_data.append(attrs)
+
+        super().bulk_update(rest_instances, rest_data)
+
+        for index, instance, attrs in restructured:
+            attrs = dict(attrs)
+            topics = attrs.pop('topics', None)
+            for attr, value in attrs.items():
+                setattr(instance, attr, value)
+
+            # earlier moves in the same batch may have changed the parent's
+            # path or made this move into a cycle, so both are re-checked
+            # against the database rather than what was validated up front.
+            if instance.parent is not None:
+                if FolderClosure.objects.filter(ancestor=instance, descendant=instance.parent).exists():
+                    errors = [{} for _ in instances]
+                    errors[index] = {'parent': ["A folder cannot be moved into itself or one of its subfolders."]}
+                    raise serializers.ValidationError(errors)
+                instance.parent.refresh_from_db(fields=['path'])
+
+            instance.save()
+            if topics is not None:
+                instance.topics.set(topics)
 
-class TopicSerializer(serializers.ModelSerializer):
+        return instances
+
+
+class TopicSerializer(BulkSaveMixin, PublicIdSerializer):
     folders = FolderSerializer(many=True, read_only=True)
     documents = DocumentSerializer(many=True, read_only=True)
     
-    class Meta:
+    class Meta(BulkSaveMixin.Meta):
         model = Topic
         fields = ['id', 'short_desc', 'full_desc', 'folders', 'documents']
         extra_kwargs = {
@@ -36,14 +341,155 @@ class TopicSerializer(serializers.ModelSerializer):
             'documents': {'required': False}
         }
 
+    def after_bulk_save(self, instances, unlinked):
+        topics_changed([t.pk for t in instances])
+
 # Doesn't include the topic's subjects, only gives the listings.
-class TopicListingSerializer(serializers.ModelSerializer):
+class TopicListingSerializer(PublicIdSerializer):
     class Meta:
         model = Topic
-        fields = ['id', 'short_desc', 'full_desc']
+        fields = ['id', 'short_desc', 'full_desc', 'document_count', 'document_size']
 
 # Doesn't include the folder's contents, only gives the listings.
-class FolderListingSerializer(serializers.ModelSerializer):
+class FolderListingSerializer(PublicIdSerializer):
     class Meta:
         model = Folder
-        fields = ['id', 'path', 'name', 'parent', 'topics']
\ No newline at end of file
+        fields = [
+            'id', 'path', 'name', 'parent', 'topics',
+            'document_count', 'document_size', 'subtree_document_count', 'subtree_document_size',
+        ]
+
+# Doesn't include the document's contents, only gives the listings.
+class DocumentListingSerializer(SparseFieldsMixin, PublicIdSerializer):
+    class Meta:
+        model = Document
+        fields = ['id', 'path', 'name', 'folder', 'topics', 'size']
+
+class FastListingSerializer:
+    """
+    Read-only stand-in for one of the listing serializers, for the list
+    endpoints. It gives the same output, but builds it from the plain dicts of
+    a .values() queryset rather than from model instances, and copies columns
+    straight into the output instead of dispatching to a serializer field for
+    each one. Both steps are a large part of the cost of a listing with DRF's
+    serializers.
+
+    Querysets are prepared for it with select(), and it is used like a DRF
+    serializer: with many=True and .data for a page of rows, or with
+    to_representation() for one row at a time once attach_related() has been
+    called on the rows.
+    """
+
+    # the listing serializer whose output this gives
+    listing_serializer = None
+    # the values() lookup that each field other than 'id' and the
+    # many-to-many fields is read from
+    lookups = {}
+    many_to_many = ()
+
+    def __init__(self, instance=None, many=False, fields=None):
+        self.instance = instance
+        self.fields = self.field_names(fields)
+
+    @classmethod
+    def field_names(cls, fields=None) -> list:
+        return [f for f in cls.listing_serializer.Meta.fields if fields is None or f in fields]
+
+    @classmethod
+    def select(cls, queryset, fields=None):
+        # 'id' is always read, as pagination needs the primary key
+        lookups = ['id', 'uuid'] + [cls.lookups[f] for f in cls.field_names(fields) if f in cls.lookups]
+        return queryset.values(*lookups)
+
+    def attach_related(self, rows: list, using=None):
+        """
+        Add the public IDs of the objects each row's many-to-many fields link
+        to, with one query per field no matter how many rows there are.
+        """
+        model = self.listing_serializer.Meta.model
+        pks = [row['id'] for row in rows]
+        for name in self.many_to_many:
+            if name not in self.fields:
+                continue
+            field = model._meta.get_field(name)
+            source = field.m2m_field_name() + '_id'
+            links = {pk: [] for pk in pks}
+            if pks:
+                through = field.remote_field.through._default_manager.db_manager(using)
+                target = field.m2m_reverse_field_name() + '__uuid'
+                for pk, public_id in through.filter(**{source + '__in': pks}).values_list(source, target):
+                    links[pk].append(public_id)
+            for row in rows:
+                row[name] = links[row['id']]
+
+    def to_representation(self, row: dict) -> dict:
+        data = {}
+        for name in self.fields:
+            if name == 'id':
+                data[name] = str(row['uuid'])
+            elif name in self.lookups:
+                data[name] = row[self.lookups[name]]
+            else:
+                data[name] = row[name]
+        return data
+
+    @property
+    def data(self) -> list:
+        with serializing():
+            rows = list(self.instance)
+            self.attach_related(rows)
+            return [self.to_representation(row) for row in rows]
+
+
+class FastTopicListingSerializer(FastListingSerializer):
+    listing_serializer = TopicListingSerializer
+    lookups = {
+        'short_desc': 'short_desc', 'full_desc': 'full_desc',
+        'document_count': 'document_count', 'document_size': 'document_size',
+    }
+
+
+class FastFolderListingSerializer(FastListingSerializer):
+    listing_serializer = FolderListingSerializer
+    lookups = {
+        'path': 'path', 'name': 'name', 'parent': 'parent__uuid',
+        'document_count': 'document_count', 'document_size': 'document_size',
+        'subtree_document_count': 'subtree_document_count', 'subtree_document_size': 'subtree_document_size',
+    }
+    many_to_many = ('topics',)
+
+
+class FastDocumentListingSerializer(FastListingSerializer):
+    listing_serializer = DocumentListingSerializer
+    lookups = {'path': 'path', 'name': 'name', 'folder': 'folder__uuid', 'size': 'size'}
+    many_to_many = ('topics',)
+
+# A document listing plus how well it matched a search.
+class DocumentSearchResultSerializer(DocumentListingSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta(DocumentListingSerializer.Meta):
+        fields = DocumentListingSerializer.Meta.fields + ['rank', 'snippet']
+
+
+# Where to move a folder to; null moves it to the top level.
+class FolderMoveSerializer(serializers.Serializer):
+    parent = PublicIdRelatedField(queryset=Folder.objects.all(), allow_null=True)
+
+
+class JobSerializer(TimedOutputMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'status', 'total', 'completed', 'error', 'created_at', 'updated_at']
+
+
+class UploadSerializer(TimedOutputMixin, serializers.ModelSerializer):
+    # the offset that the next chunk has to start at
+    offset = serializers.IntegerField(source='received', read_only=True)
+    document = PublicIdRelatedField(queryset=Document.objects.all(), allow_null=True, required=False)
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'document', 'size', 'offset', 'status', 'created_at', 'updated_at']
+        read_only_fields = ['status']
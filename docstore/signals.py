@@ -0,0 +1,107 @@
+from django.db.models.signals import m2m_changed, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .counters import Totals
+from .models import Topic, Folder, Document
+from .search import update_search_vectors
+from .versions import documents_changed, folders_changed, topics_changed
+
+# m2m_changed actions after which the links have changed. Clears are handled
+# before they happen, while it is still possible to tell what is being unlinked.
+M2M_ACTIONS = ('post_add', 'post_remove', 'pre_clear')
+
+# m2m_changed actions that change the document counters of topics, and whether
+# they add to them or take away. Removals are counted before they happen, as
+# only then can the links that actually existed be told apart.
+COUNTED_ACTIONS = {'post_add': 1, 'pre_remove': -1, 'pre_clear': -1}
+
+
+@receiver(pre_save, sender=Document)
+def document_saving(sender, instance, update_fields, **kwargs):
+    # what the document counted for before the save, unless it is new or
+    # neither its folder nor its size can have changed.
+    instance._counted_before = None
+    if instance._state.adding:
+        return
+    if update_fields is not None and not {'folder', 'folder_id', 'size'} & set(update_fields):
+        return
+    counted = (instance.__dict__.get('folder_id'), instance.__dict__.get('size'))
+    if counted != getattr(instance, '_loaded_counted', None):
+        instance._counted_before = Totals.of_documents([instance.pk])
+
+
+@receiver(post_save, sender=Document)
+def document_saved(sender, instance, created, using, **kwargs):
+    update_search_vectors([instance], db=using)
+
+    documents_changed([instance.pk], folder_ids=[getattr(instance, '_loaded_folder_id', None)])
+    instance._loaded_folder_id = instance.folder_id
+
+    if created:
+        Totals.of_documents([instance.pk]).apply()
+    elif getattr(instance, '_counted_before', None) is not None:
+        (Totals.of_documents([instance.pk]) - instance._counted_before).apply()
+    instance._counted_before = None
+    instance._loaded_counted = (instance.folder_id, instance.size)
+
+
+@receiver(post_save, sender=Folder)
+def folder_saved(sender, instance, **kwargs):
+    folders_changed([instance.pk])
+
+
+@receiver(post_save, sender=Topic)
+def topic_saved(sender, instance, **kwargs):
+    topics_changed([instance.pk])
+
+
+@receiver(pre_delete, sender=Document)
+def document_deleting(sender, instance, **kwargs):
+    documents_changed([instance.pk])
+    Totals.of_documents([instance.pk]).apply(-1)
+
+
+@receiver(pre_delete, sender=Folder)
+def folder_deleting(sender, instance, **kwargs):
+    folders_changed([instance.pk])
+
+
+@receiver(pre_delete, sender=Topic)
+def topic_deleting(sender, instance, **kwargs):
+    # the topic's ID is part of the output of everything linked to it
+    folders_changed(instance.folders.values('pk'))
+    documents_changed(instance.documents.values('pk'))
+
+
+@receiver(m2m_changed, sender=Document.topics.through)
+def document_topics_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_ACTIONS:
+        return
+    if reverse:
+        topics_changed([instance.pk])
+        documents_changed(pk_set if pk_set is not None else instance.documents.values('pk'))
+    else:
+        documents_changed([instance.pk], topic_ids=pk_set if pk_set is not None else instance.topics.values('pk'))
+
+
+@receiver(m2m_changed, sender=Document.topics.through)
+def document_topics_counted(sender, instance, action, reverse, pk_set, **kwargs):
+    sign = COUNTED_ACTIONS.get(action)
+    if sign is None:
+        return
+    own, other = ('topic_id', 'document_id') if reverse else ('document_id', 'topic_id')
+    links = sender.objects.filter(**{own: instance.pk})
+    if pk_set is not None:
+        links = links.filter(**{other + '__in': pk_set})
+    Totals.of_links(links).apply(sign)
+
+
+@receiver(m2m_changed, sender=Folder.topics.through)
+def folder_topics_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_ACTIONS:
+        return
+    if reverse:
+        topics_changed([instance.pk])
+        folders_changed(pk_set if pk_set is not None else instance.folders.values('pk'))
+    else:
+        folders_changed([instance.pk], topic_ids=pk_set if pk_set is not None else instance.topics.values('pk'))
@@ -0,0 +1,251 @@
+"""
+Coalescing of identical concurrent reads, also known as single flight.
+
+When a popular document or topic is linked somewhere, hundreds of requests for
+its detail output can arrive at once, and each would run the same queries and
+serialize the same output. Instead, the first request for an object builds the
+output and the others wait for it and are sent the same bytes. Flights are
+keyed on the object and its version, so a request is never given output that
+was built for a different version than the one it looked up.
+
+Within a process, requests wait on the thread that is building the output.
+Between processes, they coordinate through the lock backend named by the
+DOCSTORE_SINGLE_FLIGHT_BACKEND setting: the process that takes a key's lock
+builds the output and publishes it, and the others poll for it. A waiter that
+has not been given the output within WAIT_TIMEOUT, or whose builder in another
+process gave up without publishing anything, builds the output itself. Waiters
+in the builder's own process are given its exception instead, as they would
+have run the same queries against the same database.
+
+Set DOCSTORE_SINGLE_FLIGHT_BACKEND to None to only coalesce within each
+process.
+"""
+
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# seconds a waiting request gives the builder before building the output
+# itself
+WAIT_TIMEOUT = 10.0
+
+# seconds a lock is held for at most, in case its process dies while holding
+# it
+LOCK_TIMEOUT = 30
+
+# seconds published output is kept for, which only has to cover the waiters
+# that were polling for it
+RESULT_TIMEOUT = 5
+
+# bounds of the interval at which waiters in other processes poll, which
+# starts small and doubles
+POLL_INTERVAL = (0.005, 0.1)
+
+
+class FlightStats:
+    """
+    Counts how many outputs this process built and how many requests it
+    answered with output that was built for another request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.built = 0
+            self.shared = 0
+
+    def record(self, built: int = 0, shared: int = 0):
+        with self._lock:
+            self.built += built
+            self.shared += shared
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {'built': self.built, 'shared': self.shared}
+
+
+stats = FlightStats()
+
+
+class LockBackend:
+    """
+    Interface for coordinating flights between processes. Every process that
+    serves the API must be configured with the same backend.
+    """
+
+    def acquire(self, key: str) -> bool:
+        """
+        Take the lock on the key without waiting for it, giving whether it was
+        taken. The lock must expire by itself after LOCK_TIMEOUT.
+        """
+        raise NotImplementedError
+
+    def release(self, key: str):
+        raise NotImplementedError
+
+    def is_locked(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def publish(self, key: str, value: bytes):
+        """
+        Make the output built for the key available to other processes for
+        RESULT_TIMEOUT seconds.
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Give the output published for the key, or None if there is none.
+        """
+        raise NotImplementedError
+
+
+class CacheLockBackend(LockBackend):
+    """
+    Keeps locks and output in the Django cache named by the
+    DOCSTORE_SINGLE_FLIGHT_CACHE setting, with the lock taken by cache.add().
+    This coordinates processes as long as that cache is shared between them
+    and its add() is atomic, which is the case for the memcached, Redis and
+    database backends. A local-memory cache only coordinates the threads of one
+    process, which they already are anyway.
+    """
+
+    def __init__(self, alias: Optional[str] = None):
+        self.cache = caches[alias or settings.DOCSTORE_SINGLE_FLIGHT_CACHE]
+        # identifies this backend's locks, so that one whose lock expired
+        # while it was building does not release another process's lock.
+        self.token = uuid.uuid4().hex
+
+    def acquire(self, key: str) -> bool:
+        return self.cache.add(key + ':lock', self.token, LOCK_TIMEOUT)
+
+    def release(self, key: str):
+        if self.cache.get(key + ':lock') == self.token:
+            self.cache.delete(key + ':lock')
+
+    def is_locked(self, key: str) -> bool:
+        return self.cache.get(key + ':lock') is not None
+
+    def publish(self, key: str, value: bytes):
+        self.cache.set(key + ':result', value, RESULT_TIMEOUT)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.cache.get(key + ':result')
+
+
+@lru_cache(maxsize=None)
+def get_lock_backend() -> Optional[LockBackend]:
+    path = settings.DOCSTORE_SINGLE_FLIGHT_BACKEND
+    return import_string(path)() if path else None
+
+
+@receiver(setting_changed)
+def _reset_lock_backend(*, setting, **kwargs):
+    if setting in ('DOCSTORE_SINGLE_FLIGHT_BACKEND', 'DOCSTORE_SINGLE_FLIGHT_CACHE'):
+        get_lock_backend.cache_clear()
+
+
+def flight_key(model, pk, etag: str) -> str:
+    # the ETag is made from the object's public ID and version
+    return 'docstore:flight:{:s}:{}:{:s}'.format(model._meta.model_name, pk, etag.strip('"'))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def run(key: str, build: Callable[[], bytes]) -> Tuple[bytes, bool]:
+    """
+    Give the output for the key, building it with build() unless another
+    request is already doing so, in which case its output is waited for.
+    Returns the output and whether it was built for another request. If
+    build() raises, so does every request that was waiting on it in this
+    process.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(WAIT_TIMEOUT):
+            stats.record(built=1)
+            return build(), False
+        if flight.error is not None:
+            raise flight.error
+        stats.record(shared=1)
+        return flight.value, True
+
+    try:
+        flight.value, shared = _run_between_processes(key, build)
+        return flight.value, shared
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _run_between_processes(key: str, build: Callable[[], bytes]) -> Tuple[bytes, bool]:
+    backend = get_lock_backend()
+    if backend is None:
+        stats.record(built=1)
+        return build(), False
+
+    # published output is only for the requests that were waiting for it.
+    # Later ones build it again, which keeps this from turning into a cache
+    # that the response cache's eviction knows nothing about.
+    if backend.acquire(key):
+        try:
+            value = build()
+            backend.publish(key, value)
+        finally:
+            backend.release(key)
+        stats.record(built=1)
+        return value, False
+
+    value = _wait(backend, key)
+    if value is None:
+        # the other process took too long or failed, so the output is built
+        # here after all.
+        stats.record(built=1)
+        return build(), False
+    stats.record(shared=1)
+    return value, True
+
+
+def _wait(backend: LockBackend, key: str) -> Optional[bytes]:
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    interval, max_interval = POLL_INTERVAL
+    while time.monotonic() < deadline:
+        time.sleep(interval)
+        value = backend.get(key)
+        if value is not None:
+            return value
+        if not backend.is_locked(key):
+            # released without publishing anything, which means the build
+            # failed; unless it was published in the meantime.
+            return backend.get(key)
+        interval = min(interval * 2, max_interval)
+    return None
@@ -0,0 +1,313 @@
+"""
+Storage backends for document contents.
+
+Document rows only hold metadata about their contents; the bytes themselves
+live in a blob store and are addressed by the SHA-256 hash of their contents.
+Identical contents are therefore only ever stored once, no matter how many
+documents refer to them.
+
+The backend in use is selected with the DOCSTORE_BLOB_STORAGE setting, which
+gives the dotted path of a BlobStorage subclass.
+"""
+
+import datetime
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+# size of the pieces that contents are read and written in, so that no backend
+# ever needs to hold a whole blob in memory.
+CHUNK_SIZE = 64 * 1024
+
+# compression level for gzipped blobs, which are written once and read many
+# times. Level 6 gets nearly all of the size of level 9 in half the time.
+GZIP_LEVEL = 6
+
+# blobs are only stored compressed if that makes them at most this fraction of
+# their size, since reading them back costs CPU time.
+MAX_COMPRESSED_RATIO = 0.9
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobStorage:
+    """
+    Interface for content-addressed blob storage backends.
+    """
+
+    def save(self, stream: BinaryIO) -> Tuple[str, int]:
+        """
+        Store the contents of a binary stream, reading it in chunks. Returns the
+        hash that the blob can be retrieved with, and its size in bytes.
+        """
+        raise NotImplementedError
+
+    def save_file(self, path: Path, blob_hash: str):
+        """
+        Store the contents of a file whose hash is already known, such as a
+        finished upload. The file is left where it is. Backends that can store
+        it without hashing it again should override this.
+        """
+        with open(path, 'rb') as f:
+            saved_hash, _ = self.save(f)
+        if saved_hash != blob_hash:
+            raise ValueError("{:s} does not have the hash {:s}".format(str(path), blob_hash))
+
+    def open(self, blob_hash: str) -> BinaryIO:
+        """
+        Open a stored blob for reading. Raises BlobNotFound if there is no blob
+        with the given hash.
+        """
+        raise NotImplementedError
+
+    def open_encoded(self, blob_hash: str) -> Optional[Tuple[BinaryIO, str, int]]:
+        """
+        Open a stored blob as it is stored, if it is stored compressed, so that
+        it can be sent to clients that accept the compression without
+        decompressing it. Gives the stream of compressed bytes, their HTTP
+        content encoding, and their size, or None if the blob is not stored
+        compressed.
+        """
+        return None
+
+    def exists(self, blob_hash: str) -> bool:
+        raise NotImplementedError
+
+    def modified(self, blob_hash: str) -> Optional[datetime.datetime]:
+        """
+        Give the last-modified time of a stored blob, or None if there is no
+        blob with the given hash. Saving contents that are already stored
+        counts as modifying them.
+        """
+        raise NotImplementedError
+
+    def delete(self, blob_hash: str):
+        """
+        Delete a stored blob. Deleting a blob that does not exist is not an
+        error.
+        """
+        raise NotImplementedError
+
+    def rewrite(self, blob_hash: str) -> bool:
+        """
+        Convert a stored blob to the way the backend would store it now, such
+        as after compression has been turned on or off. Returns whether it was
+        changed.
+        """
+        return False
+
+    def list(self) -> Iterator[Tuple[str, datetime.datetime]]:
+        """
+        Iterate over the hash and last-modified time of every stored blob.
+        """
+        raise NotImplementedError
+
+
+class LocalBlobStorage(BlobStorage):
+    """
+    Stores blobs as files in a directory on the local filesystem. Blobs are
+    spread over two levels of subdirectories named for the first characters of
+    their hash to keep any single directory from growing too large.
+
+    With compression set to 'gzip', blobs are stored gzipped, in files named
+    for their hash with a '.gz' suffix, unless that would not save much space,
+    as with contents that are already compressed. Blobs are still addressed by
+    the hash of their uncompressed contents, and open() decompresses them as
+    they are read. Either kind of file is read whatever the current setting,
+    so it can be changed at any time; the compress_blobs command converts the
+    blobs that are already stored.
+    """
+
+    def __init__(self, root=None, compression=None):
+        self.root = Path(root if root is not None else settings.DOCSTORE_BLOB_ROOT)
+        self.compression = compression if compression is not None else settings.DOCSTORE_BLOB_COMPRESSION
+        if self.compression not in (None, 'gzip'):
+            raise ImproperlyConfigured("Unsupported blob compression: {!r}".format(self.compression))
+
+    def _path(self, blob_hash: str) -> Path:
+        return self.root / blob_hash[:2] / blob_hash[2:4] / blob_hash
+
+    def _gzip_path(self, blob_hash: str) -> Path:
+        return self._path(blob_hash).with_suffix('.gz')
+
+    def save(self, stream: BinaryIO) -> Tuple[str, int]:
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        # the hash is not known until all of the stream has been read, so write
+        # to a temporary file first and move it into place afterwards.
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+
+            blob_hash = digest.hexdigest()
+            self._store(Path(tmp_path), blob_hash, move=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return blob_hash, size
+
+    def save_file(self, path: Path, blob_hash: str):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._store(Path(path), blob_hash, move=False)
+
+    def _store(self, path: Path, blob_hash: str, move: bool):
+        # puts the file at path into the store, moving it there if move is set.
+        if self._touch(blob_hash):
+            # already have these exact contents. They were just brought up to
+            # date, so that gc_blobs does not take them for unreferenced before
+            # the document that is about to refer to them has been saved.
+            return
+        dest = self._path(blob_hash)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+        if self.compression == 'gzip':
+            compressed = self._compress(path)
+            if compressed is not None:
+                os.replace(compressed, self._gzip_path(blob_hash))
+                return
+
+        if move:
+            os.replace(path, dest)
+            return
+        # copied rather than hard linked. A link would share the file with the
+        # caller, such as an upload that is written to again after the commit
+        # that stored it rolled back, and would keep the caller's modification
+        # time, which gc_blobs can take for the blob's.
+        self._copy(path, dest, shutil.copyfileobj)
+
+    def _compress(self, path: Path) -> Optional[Path]:
+        # gives a temporary file with the gzipped contents of path, or None if
+        # compressing them is not worth it.
+        def compress(src, dst):
+            with gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=GZIP_LEVEL, mtime=0) as out:
+                shutil.copyfileobj(src, out, CHUNK_SIZE)
+
+        tmp_path = self._copy(path, None, compress)
+        if os.path.getsize(tmp_path) > os.path.getsize(path) * MAX_COMPRESSED_RATIO:
+            os.remove(tmp_path)
+            return None
+        return tmp_path
+
+    def _copy(self, path: Path, dest: Optional[Path], copy) -> Path:
+        # copies path to a temporary file in the store with copy(src, dst), and
+        # moves that to dest if it is given.
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+        try:
+            with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                copy(src, dst)
+            if dest is not None:
+                os.replace(tmp_path, dest)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return Path(tmp_path)
+
+    def open(self, blob_hash: str) -> BinaryIO:
+        try:
+            return open(self._path(blob_hash), 'rb')
+        except FileNotFoundError:
+            pass
+        try:
+            return gzip.open(self._gzip_path(blob_hash), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(blob_hash)
+
+    def open_encoded(self, blob_hash: str) -> Optional[Tuple[BinaryIO, str, int]]:
+        try:
+            f = open(self._gzip_path(blob_hash), 'rb')
+        except FileNotFoundError:
+            return None
+        return f, 'gzip', os.fstat(f.fileno()).st_size
+
+    def exists(self, blob_hash: str) -> bool:
+        return self._path(blob_hash).exists() or self._gzip_path(blob_hash).exists()
+
+    def modified(self, blob_hash: str) -> Optional[datetime.datetime]:
+        for path in (self._path(blob_hash), self._gzip_path(blob_hash)):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            return datetime.datetime.fromtimestamp(mtime, tz=timezone.utc)
+        return None
+
+    def _touch(self, blob_hash: str) -> bool:
+        # sets the modification time of a stored blob to now, giving whether
+        # there is one.
+        for path in (self._path(blob_hash), self._gzip_path(blob_hash)):
+            try:
+                os.utime(path)
+                return True
+            except FileNotFoundError:
+                pass
+        return False
+
+    def delete(self, blob_hash: str):
+        for path in (self._path(blob_hash), self._gzip_path(blob_hash)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def rewrite(self, blob_hash: str) -> bool:
+        path, gzip_path = self._path(blob_hash), self._gzip_path(blob_hash)
+        if self.compression == 'gzip':
+            if not path.exists() or gzip_path.exists():
+                return False
+            compressed = self._compress(path)
+            if compressed is None:
+                return False
+            os.replace(compressed, gzip_path)
+            os.remove(path)
+            return True
+
+        if not gzip_path.exists() or path.exists():
+            return False
+
+        def decompress(src, dst):
+            with gzip.GzipFile(fileobj=src, mode='rb') as f:
+                shutil.copyfileobj(f, dst, CHUNK_SIZE)
+
+        self._copy(gzip_path, path, decompress)
+        os.remove(gzip_path)
+        return True
+
+    def list(self) -> Iterator[Tuple[str, datetime.datetime]]:
+        if not self.root.exists():
+            return
+        for path in self.root.glob('*/*/*'):
+            mtime = path.stat().st_mtime
+            yield path.name.split('.')[0], datetime.datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+
+@lru_cache(maxsize=None)
+def get_blob_storage() -> BlobStorage:
+    return import_string(settings.DOCSTORE_BLOB_STORAGE)()
+
+
+@receiver(setting_changed)
+def _reset_blob_storage(*, setting, **kwargs):
+    if setting in ('DOCSTORE_BLOB_STORAGE', 'DOCSTORE_BLOB_ROOT', 'DOCSTORE_BLOB_COMPRESSION'):
+        get_blob_storage.cache_clear()
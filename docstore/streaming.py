@@ -0,0 +1,99 @@
+"""
+Streaming output for the list endpoints.
+
+Paginated listings are built in memory one page at a time. A streamed listing
+instead returns every matching row in a single response, as either one JSON
+array or newline-delimited JSON with an object per line. Rows are read from the
+database in chunks and serialized one at a time as the response is sent, so
+memory use stays flat however many rows there are, and the first bytes go out
+as soon as the first chunk has been read.
+"""
+
+import functools
+from itertools import islice
+from typing import Callable, Iterator, Optional
+
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+
+from .renderers import dumps
+from .serializers import FastListingSerializer
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# rows read from the database at a time
+CHUNK_SIZE = 500
+
+# bytes of output collected before they are handed to the server, so that
+# rows are not written out one tiny piece at a time.
+BUFFER_SIZE = 64 * 1024
+
+
+def iterate(queryset, chunk_size: int = CHUNK_SIZE, prefetch: Optional[Callable[[list], None]] = None) -> Iterator:
+    """
+    Iterate over a queryset without caching its results, including any
+    prefetches on it. QuerySet.iterator() drops prefetch_related() lookups, so
+    they are done here for each chunk instead, which still costs a fixed number
+    of queries per chunk. prefetch, if given, is called with each chunk to do
+    the same for rows that are not model instances.
+    """
+    lookups = queryset._prefetch_related_lookups
+    rows = queryset.prefetch_related(None).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        if lookups:
+            prefetch_related_objects(chunk, *lookups)
+        if prefetch is not None:
+            prefetch(chunk)
+        yield from chunk
+
+
+def encode(rows: Iterator, serializer, fmt: str) -> Iterator[bytes]:
+    buf = []
+    size = 0
+    if fmt == 'json':
+        buf.append(b'[')
+
+    first = True
+    for row in rows:
+        text = dumps(serializer.to_representation(row))
+        if fmt == 'ndjson':
+            text += b'\n'
+        elif not first:
+            text = b',' + text
+        first = False
+
+        buf.append(text)
+        size += len(text)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+
+    if fmt == 'json':
+        buf.append(b']')
+    if buf:
+        yield b''.join(buf)
+
+
+def streaming_response(queryset, serializer_class, fmt: str, chunk_size: int = CHUNK_SIZE, **serializer_kwargs):
+    """
+    Stream every row of queryset in the given format, ordered by ID like the
+    paginated listings.
+    """
+    # one serializer is reused for every row; building one per row would copy
+    # all of its fields each time.
+    serializer = serializer_class(**serializer_kwargs)
+    # the rows are read after the view has returned, so the database they are
+    # read from is picked now, while the view's routing still applies.
+    queryset = queryset.using(queryset.db)
+    prefetch = None
+    if isinstance(serializer, FastListingSerializer):
+        prefetch = functools.partial(serializer.attach_related, using=queryset.db)
+    rows = iterate(queryset.order_by('id'), chunk_size, prefetch)
+    return StreamingHttpResponse(encode(rows, serializer, fmt), content_type=STREAM_FORMATS[fmt])
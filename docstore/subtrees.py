@@ -0,0 +1,166 @@
+"""
+Reading, moving and deleting whole folder subtrees.
+
+All of these work on the subtree with a handful of set-based statements driven
+by the folder closure table, rather than one object at a time. In particular,
+deletes do not go through Django's cascade collector, which would load every
+folder and document beneath the folder into memory first.
+"""
+
+import functools
+from typing import Callable, Optional
+
+from django.db import transaction
+from django.db.models import F
+
+from . import uploads
+from .counters import Totals
+from .models import Topic, Folder, FolderClosure, Document, Upload
+from .versions import folders_changed
+
+# number of documents deleted per statement when deleting in batches
+DELETE_BATCH_SIZE = 1000
+
+
+class MoveError(Exception):
+    pass
+
+
+def move_folder(folder_id, parent_id) -> Folder:
+    """
+    Move a folder and everything beneath it under a new parent, or to the top
+    level if parent_id is None. Raises Folder.DoesNotExist if either folder does
+    not exist, and MoveError if the move would put the folder inside itself.
+    """
+    with transaction.atomic():
+        folder = Folder.objects.select_for_update().get(pk=folder_id)
+        parent = None
+        if parent_id is not None:
+            parent = Folder.objects.get(pk=parent_id)
+            if FolderClosure.objects.filter(ancestor_id=folder_id, descendant_id=parent_id).exists():
+                raise MoveError("A folder cannot be moved into itself or one of its subfolders.")
+
+        # Folder.save() re-links the closure table and rewrites the paths of
+        # the subtree with set-based statements.
+        folder.parent = parent
+        folder.save()
+    return folder
+
+
+def count_subtree(folder_id) -> int:
+    """
+    Give the number of folders and documents in the subtree, which is the
+    amount of work that deleting it involves.
+    """
+    subtree = FolderClosure.objects.subtree(folder_id)
+    return Folder.objects.filter(pk__in=subtree).count() + Document.objects.filter(folder__in=subtree).count()
+
+
+def delete_subtree(folder_id, batch_size: Optional[int] = None, progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Delete a folder and everything beneath it, returning how many folders and
+    documents were deleted.
+
+    Without a batch_size everything is deleted in one transaction. With one,
+    documents are deleted batch_size at a time, each batch in its own
+    transaction, and progress is called with the number deleted so far after
+    each one; the folders themselves, and any documents added in the meantime,
+    go in a final transaction.
+    """
+    subtree = FolderClosure.objects.subtree(folder_id)
+    deleted = 0
+
+    if batch_size is not None:
+        while True:
+            with transaction.atomic():
+                batch = list(Document.objects.filter(folder__in=subtree).values_list('pk', flat=True)[:batch_size])
+                if not batch:
+                    break
+                _delete_documents(batch)
+            deleted += len(batch)
+            if progress is not None:
+                progress(deleted)
+
+    with transaction.atomic():
+        folder_ids = list(Folder.objects.select_for_update().filter(pk__in=subtree).values_list('pk', flat=True))
+        if not folder_ids:
+            return deleted
+
+        documents = Document.objects.filter(folder__in=folder_ids).values('pk')
+        deleted += _delete_documents(documents)
+
+        # bumps the topics that include the folders, and evicts any cached
+        # output of the folders.
+        folders_changed(folder_ids)
+
+        _raw_delete(Folder.topics.through.objects.filter(folder_id__in=folder_ids))
+        _raw_delete(FolderClosure.objects.filter(descendant_id__in=folder_ids))
+        deleted += _raw_delete(Folder.objects.filter(pk__in=folder_ids))
+
+    if progress is not None:
+        progress(deleted)
+    return deleted
+
+
+def _delete_documents(document_ids) -> int:
+    # the documents stop counting towards their folders, the folders' ancestors
+    # and their topics.
+    Totals.of_documents(document_ids).apply(-1)
+
+    # topics include their documents, so they change along with them.
+    links = Document.topics.through.objects.filter(document_id__in=document_ids)
+    Topic.objects.filter(pk__in=links.values('topic_id')).touch()
+
+    _raw_delete(links)
+
+    # uploads to the documents go with them, as they would through the
+    # collector's cascade, and so do their chunks once that is committed.
+    upload_ids = list(Upload.objects.filter(document_id__in=document_ids).values_list('pk', flat=True))
+    if upload_ids:
+        _raw_delete(Upload.objects.filter(pk__in=upload_ids))
+        for upload_id in upload_ids:
+            transaction.on_commit(functools.partial(uploads.discard, upload_id))
+
+    return _raw_delete(Document.objects.filter(pk__in=document_ids))
+
+
+def _raw_delete(queryset) -> int:
+    # a plain DELETE ... WHERE, without the collector. Only ever used once
+    # everything that refers to the rows has been deleted already.
+    return queryset._raw_delete(queryset.db)
+
+
+def folder_tree(public_id, depth: Optional[int] = None, with_counts: bool = False) -> Optional[dict]:
+    """
+    Give the folder with the given public ID and its subfolders down to the
+    given depth (0 being just the folder itself, None being all of them) as
+    nested dicts with a 'children' list each, ordered by name. with_counts adds
+    the number of documents directly in each folder.
+
+    The whole subtree comes from the closure table in one query, ordered so
+    that every folder comes after its parent, which lets the nesting be put
+    together in a single pass. Returns None if there is no such folder.
+    """
+    # one filter() call, so that both conditions apply to the same closure row
+    links = {'ancestor_links__ancestor__uuid': public_id}
+    if depth is not None:
+        links['ancestor_links__depth__lte'] = depth
+    folders = Folder.objects.filter(**links).annotate(depth=F('ancestor_links__depth'))
+
+    fields = ['id', 'parent_id', 'uuid', 'name', 'path']
+    if with_counts:
+        # the stored counter; see docstore.counters
+        fields.append('document_count')
+
+    root = None
+    nodes = {}
+    for row in folders.order_by('depth', 'name', 'id').values(*fields):
+        pk = row.pop('id')
+        parent_id = row.pop('parent_id')
+        node = dict(id=row.pop('uuid'), **row, children=[])
+        nodes[pk] = node
+        if root is None:
+            root = node
+        else:
+            nodes[parent_id]['children'].append(node)
+    return root
@@ -1,3 +1,1174 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django import db
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+
+from . import async_views, benchmarks, counters, jobs, routers, search, singleflight, uploads, urls, views
+from .middleware import InstrumentationMiddleware
+from .models import Topic, Folder, FolderClosure, Document, Job, Upload
+from .serializers import FastDocumentListingSerializer
+from .storage import get_blob_storage
+
+
+class BlobStorageMixin:
+    """
+    Keeps any document contents written during a test in a temporary directory
+    that is removed afterwards.
+
+    Reads are never sent to replicas, as those would not see the data of the
+    test's transaction.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._blob_root = tempfile.mkdtemp()
+        cls._blob_settings = override_settings(DOCSTORE_BLOB_ROOT=cls._blob_root, DOCSTORE_READ_REPLICAS=[])
+        cls._blob_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._blob_settings.disable()
+        shutil.rmtree(cls._blob_root, ignore_errors=True)
+
+
+class BlobStorageTestCase(BlobStorageMixin, APITestCase):
+    pass
+
+
+class QueryBudgetTests(BlobStorageTestCase):
+    """
+    Every endpoint must run the same number of queries no matter how many
+    objects it returns. Each test measures an endpoint against a small data set,
+    grows the data set, and checks that the query count did not grow with it.
+    """
+
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.root = Folder.objects.create(name='root')
+        self.add_data(1)
+
+    def add_data(self, n: int):
+        for i in range(n):
+            parent = Folder.objects.create(name='parent', parent=self.root)
+            parent.topics.add(self.topic)
+            f = Folder.objects.create(name='folder', parent=parent)
+            f.topics.add(self.topic)
+            for j in range(3):
+                d = Document.objects.create(name='doc-{:d}'.format(j), folder=f, contents='contents')
+                d.topics.add(self.topic)
+            d = Document.objects.create(name='top-level', folder=self.root, contents='contents')
+            d.topics.add(self.topic)
+            Topic.objects.create(short_desc='other', full_desc='another topic')
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assertQueryBudget(self, url_fn, budget: int):
+        small = self.count_queries(url_fn())
+        self.add_data(20)
+        large = self.count_queries(url_fn())
+
+        self.assertLessEqual(small, budget)
+        self.assertEqual(small, large, "query count grew with the number of objects returned")
+
+    def test_topic_list(self):
+        self.assertQueryBudget(lambda: '/api/v1/topics/', 1)
+
+    def test_topic_detail(self):
+        self.assertQueryBudget(lambda: '/api/v1/topics/{}/'.format(self.topic.uuid), 8)
+
+    def test_folder_list(self):
+        self.assertQueryBudget(lambda: '/api/v1/folders/', 2)
+
+    def test_folder_detail(self):
+        self.assertQueryBudget(lambda: '/api/v1/folders/{}/'.format(self.root.uuid), 5)
+
+    def test_document_list(self):
+        self.assertQueryBudget(lambda: '/api/v1/documents/', 2)
+
+    def test_document_list_all_fields(self):
+        self.assertQueryBudget(lambda: '/api/v1/documents/?fields=id,path,name,folder,topics,size,contents', 2)
+
+    def test_folder_tree(self):
+        self.assertQueryBudget(lambda: '/api/v1/folders/{}/tree/?counts=1'.format(self.root.uuid), 1)
+
+    def test_document_list_streamed(self):
+        self.assertQueryBudget(lambda: '/api/v1/documents/?stream=ndjson', 2)
+
+    def test_folder_list_streamed(self):
+        self.assertQueryBudget(lambda: '/api/v1/folders/?stream=json', 2)
+
+    def test_document_detail(self):
+        doc = Document.objects.first()
+        self.assertQueryBudget(lambda: '/api/v1/documents/{}/'.format(doc.uuid), 3)
+
+
+class PathTests(BlobStorageTestCase):
+    def setUp(self):
+        self.root = Folder.objects.create(name='root')
+        self.other = Folder.objects.create(name='other')
+        self.sub = Folder.objects.create(name='sub', parent=self.root)
+        self.leaf = Folder.objects.create(name='leaf', parent=self.sub)
+        self.doc = Document.objects.create(name='doc', folder=self.leaf, contents='contents')
+
+    def assertPaths(self, expected: dict):
+        paths = {obj.name: type(obj).objects.get(pk=obj.pk).path for obj in (self.root, self.sub, self.leaf, self.doc)}
+        self.assertEqual(paths, expected)
+
+    def test_paths_are_stored(self):
+        self.assertPaths({'root': '/root', 'sub': '/root/sub', 'leaf': '/root/sub/leaf', 'doc': '/root/sub/leaf/doc'})
+
+    def test_rename_rewrites_subtree(self):
+        response = self.client.put('/api/v1/folders/{}/'.format(self.root.uuid), {'name': 'renamed', 'parent': None}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.root.name = 'renamed'
+        self.assertPaths({
+            'renamed': '/renamed', 'sub': '/renamed/sub', 'leaf': '/renamed/sub/leaf', 'doc': '/renamed/sub/leaf/doc',
+        })
+
+    def test_move_rewrites_subtree(self):
+        response = self.client.put('/api/v1/folders/{}/'.format(self.sub.uuid),
+                                   {'name': 'sub', 'parent': str(self.other.uuid)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertPaths({'root': '/root', 'sub': '/other/sub', 'leaf': '/other/sub/leaf', 'doc': '/other/sub/leaf/doc'})
+
+        # a document moved on its own only changes its own path
+        self.doc.folder = self.root
+        self.doc.save()
+        self.assertPaths({'root': '/root', 'sub': '/other/sub', 'leaf': '/other/sub/leaf', 'doc': '/root/doc'})
+
+
+class FolderFilterTests(BlobStorageTestCase):
+    def setUp(self):
+        self.root = Folder.objects.create(name='root')
+        self.a = Folder.objects.create(name='a', parent=self.root)
+        self.b = Folder.objects.create(name='b', parent=self.a)
+        self.sibling = Folder.objects.create(name='sibling', parent=self.root)
+        for f in (self.root, self.a, self.b, self.sibling):
+            Document.objects.create(name='in-' + f.name, folder=f, contents='')
+        Document.objects.create(name='loose', contents='')
+
+    def names(self, query: str) -> set:
+        response = self.client.get('/api/v1/documents/?fields=name&' + query)
+        self.assertEqual(response.status_code, 200)
+        return {d['name'] for d in response.json()['results']}
+
+    def test_subtree_is_matched(self):
+        self.assertEqual(self.names('folder=a'), {'in-a', 'in-b'})
+        self.assertEqual(self.names('folder_id={}'.format(self.a.uuid)), {'in-a', 'in-b'})
+        self.assertEqual(self.names('folder=root'), {'in-root', 'in-a', 'in-b', 'in-sibling'})
+        self.assertEqual(self.names('folder='), {'loose'})
+
+    def test_subtree_is_matched_after_move(self):
+        response = self.client.post('/api/v1/folders/{}/move/'.format(self.b.uuid), {'parent': str(self.sibling.uuid)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names('folder=a'), {'in-a'})
+        self.assertEqual(self.names('folder_id={}'.format(self.sibling.uuid)), {'in-sibling', 'in-b'})
+        self.assertEqual(self.names('folder=root'), {'in-root', 'in-a', 'in-b', 'in-sibling'})
+
+
+class PaginationTests(BlobStorageTestCase):
+    def test_pages_have_no_duplicates_or_gaps(self):
+        for i in range(25):
+            Topic.objects.create(short_desc='topic-{:d}'.format(i), full_desc='')
+
+        seen = []
+        url = '/api/v1/topics/?page_size=10'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            seen += [t['id'] for t in data['results']]
+            url = data['next']
+            # rows inserted while the listing is being walked are picked up
+            # once, on a later page, without shifting the rows around them.
+            Topic.objects.create(short_desc='added', full_desc='')
+            self.assertLess(len(seen), 100)
+
+        self.assertEqual(len(seen), len(set(seen)))
+        expected = [str(u) for u in Topic.objects.order_by('pk').values_list('uuid', flat=True)]
+        # the last insert came after the final page was fetched
+        self.assertEqual(seen, expected[:-1])
+
+
+class FieldSelectionTests(BlobStorageTestCase):
+    def setUp(self):
+        self.folder = Folder.objects.create(name='folder')
+        self.doc = Document.objects.create(name='doc', folder=self.folder, contents='contents')
+
+    def test_subset(self):
+        response = self.client.get('/api/v1/documents/?fields=id,name')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [{'id': str(self.doc.uuid), 'name': 'doc'}])
+
+        # contents are only output when asked for
+        response = self.client.get('/api/v1/documents/?fields=name,contents')
+        self.assertEqual(response.json()['results'], [{'name': 'doc', 'contents': 'contents'}])
+        response = self.client.get('/api/v1/documents/')
+        self.assertNotIn('contents', response.json()['results'][0])
+
+    def test_unknown_field(self):
+        response = self.client.get('/api/v1/documents/?fields=name,secret,owner')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'fields': ["Unknown field(s): owner, secret"]})
+
+
+class BulkTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.a = Folder.objects.create(name='a')
+        self.b = Folder.objects.create(name='b')
+
+    def test_create_update_delete(self):
+        response = self.client.post('/api/v1/documents/bulk/', [
+            {'name': 'one', 'folder': str(self.a.uuid), 'topics': [str(self.topic.uuid)], 'contents': 'first'},
+            {'name': 'two', 'folder': None, 'topics': [], 'contents': 'second'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([d['path'] for d in response.data], ['/a/one', '/two'])
+        one, two = (Document.objects.get(uuid=d['id']) for d in response.data)
+        self.assertEqual(two.contents, 'second')
+        self.assertEqual(list(self.topic.documents.all()), [one])
+
+        response = self.client.put('/api/v1/documents/bulk/', [
+            {'id': str(one.uuid), 'name': 'one', 'folder': str(self.b.uuid), 'topics': [], 'contents': 'first'},
+            {'id': str(two.uuid), 'name': 'renamed', 'folder': None, 'topics': [str(self.topic.uuid)], 'contents': 'changed'},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([d['path'] for d in response.data], ['/b/one', '/renamed'])
+        self.assertEqual(Document.objects.get(pk=two.pk).contents, 'changed')
+        self.assertEqual(list(self.topic.documents.all()), [two])
+
+        missing = uuid.uuid4()
+        response = self.client.delete('/api/v1/documents/bulk/', [str(one.uuid), str(missing)], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [{'id': str(one.uuid), 'deleted': True}, {'id': str(missing), 'deleted': False}])
+        self.assertEqual(list(Document.objects.all()), [two])
+
+    def test_invalid_item_writes_nothing(self):
+        response = self.client.post('/api/v1/topics/bulk/', [
+            {'short_desc': 'valid', 'full_desc': 'valid'}, {'short_desc': 'no full_desc'},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('full_desc', response.data[1])
+        self.assertEqual(Topic.objects.count(), 1)
+
+        # both moves are valid on their own, but the second makes a cycle
+        # once the first has been saved, which rolls back the first too.
+        response = self.client.put('/api/v1/folders/bulk/', [
+            {'id': str(self.a.uuid), 'name': 'a', 'parent': str(self.b.uuid)},
+            {'id': str(self.b.uuid), 'name': 'b', 'parent': str(self.a.uuid)},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('parent', response.data[1])
+        self.assertEqual(list(Folder.objects.order_by('name').values_list('parent', 'path')), [(None, '/a'), (None, '/b')])
+        self.assertFalse(FolderClosure.objects.filter(depth__gt=0).exists())
+
+    def test_duplicate_ids(self):
+        response = self.client.put('/api/v1/topics/bulk/', [
+            {'id': str(self.topic.uuid), 'short_desc': 'first', 'full_desc': 'first'},
+            {'id': str(self.topic.uuid), 'short_desc': 'second', 'full_desc': 'second'},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, [{'id': ["Given more than once."]}] * 2)
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).short_desc, 'topic')
+
+
+class SearchTests(BlobStorageTestCase):
+    """
+    Searches on the fallback used by databases other than Postgres.
+    """
+
+    def setUp(self):
+        Document.objects.create(name='short.txt', contents='the quick brown fox')
+        Document.objects.create(name='long.txt', contents='a quick fox ' + 'and much more besides ' * 20)
+        Document.objects.create(name='other.txt', contents='the quick <brown> dog')
+
+    def search(self, q: str, **params):
+        response = self.client.get('/api/v1/documents/search/', dict(params, q=q))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_ranking(self):
+        results = self.search('Quick FOX')
+        self.assertEqual([r['name'] for r in results], ['short.txt', 'long.txt'])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+
+        self.assertEqual([r['name'] for r in self.search('quick', limit=2)], ['short.txt', 'other.txt'])
+        # terms are matched against names too
+        self.assertEqual([r['name'] for r in self.search('other')], ['other.txt'])
+        self.assertEqual(self.search('missing'), [])
+
+    def test_snippets(self):
+        [result] = self.search('dog')
+        self.assertEqual(result['snippet'], 'the quick &lt;brown&gt; <b>dog</b>')
+        [result] = self.search('brown fox')
+        self.assertEqual(result['snippet'], 'the quick <b>brown</b> <b>fox</b>')
+
+        # long contents are cut down to the words around the first match
+        [result] = self.search('besides')
+        self.assertTrue(result['snippet'].startswith('quick fox and much more <b>besides</b> and'))
+        self.assertEqual(len(result['snippet'].split()), search.SNIPPET_WORDS)
+
+    def test_snippets_read_from_search_database(self):
+        searched = []
+
+        def search_documents(queryset, q):
+            results = search.search_documents(queryset, q)
+            searched.append(results.db)
+            return results
+
+        with mock.patch('docstore.views.search_documents', search_documents), \
+                mock.patch('docstore.views.snippets', wraps=search.snippets) as snippets:
+            self.search('fox')
+        self.assertEqual(snippets.call_args.kwargs.get('db'), searched[0])
+
+
+class TopicFilterTests(BlobStorageTestCase):
+    def setUp(self):
+        red = Topic.objects.create(short_desc='red', full_desc='')
+        blue = Topic.objects.create(short_desc='blue', full_desc='')
+        # a second topic with the same short_desc, which must not count twice
+        other_red = Topic.objects.create(short_desc='red', full_desc='another')
+        for name, topics in (('red', [red]), ('blue', [blue]), ('both', [red, blue]), ('reds', [red, other_red]), ('none', [])):
+            Document.objects.create(name=name, contents='').topics.set(topics)
+            Folder.objects.create(name=name).topics.set(topics)
+
+    def names(self, url: str) -> set:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return {o['name'] for o in response.json()['results']}
+
+    def test_all(self):
+        for listing in ('documents', 'folders'):
+            url = '/api/v1/{:s}/?topic=red&topic=blue'.format(listing)
+            self.assertEqual(self.names(url), {'both'})
+            self.assertEqual(self.names(url + '&topic_mode=all'), {'both'})
+            self.assertEqual(self.names('/api/v1/{:s}/?topic=red'.format(listing)), {'red', 'both', 'reds'})
+
+    def test_any(self):
+        for listing in ('documents', 'folders'):
+            url = '/api/v1/{:s}/?topic=red&topic=blue&topic_mode=any'.format(listing)
+            self.assertEqual(self.names(url), {'red', 'blue', 'both', 'reds'})
+            self.assertEqual(self.names(url.replace('topic=red&', '')), {'blue', 'both'})
+
+    def test_unknown_mode(self):
+        response = self.client.get('/api/v1/documents/?topic=red&topic_mode=some')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('topic_mode', response.data)
+
+
+class PublicIdTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.root = Folder.objects.create(name='root')
+
+    def test_objects_are_referred_to_by_public_id(self):
+        response = self.client.post('/api/v1/documents/', {
+            'name': 'doc', 'folder': str(self.root.uuid), 'topics': [str(self.topic.uuid)], 'contents': 'x',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        doc = Document.objects.get()
+        self.assertEqual(response.data['id'], str(doc.uuid))
+        self.assertEqual(response.data['folder'], self.root.uuid)
+        self.assertEqual(response.data['topics'], [self.topic.uuid])
+
+        # the primary key is not a valid ID
+        response = self.client.post('/api/v1/folders/', {'name': 'sub', 'parent': self.root.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create_sets_primary_keys(self):
+        response = self.client.post('/api/v1/folders/bulk/', [
+            {'name': 'a', 'parent': str(self.root.uuid)}, {'name': 'b', 'parent': None},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        a = Folder.objects.get(name='a')
+        self.assertEqual(response.data[0]['id'], str(a.uuid))
+        self.assertTrue(FolderClosure.objects.filter(ancestor=self.root, descendant=a).exists())
+
+
+class ConditionalRequestTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.folder = Folder.objects.create(name='folder')
+        self.folder.topics.add(self.topic)
+        self.doc = Document.objects.create(name='doc', folder=self.folder, contents='contents')
+
+    def etag(self, url: str) -> str:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_not_modified_is_one_query(self):
+        url = '/api/v1/documents/{}/'.format(self.doc.uuid)
+        etag = self.etag(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_nested_change_changes_etag(self):
+        folder_url = '/api/v1/folders/{}/'.format(self.folder.uuid)
+        topic_url = '/api/v1/topics/{}/'.format(self.topic.uuid)
+        folder_etag, topic_etag = self.etag(folder_url), self.etag(topic_url)
+
+        self.doc.contents = 'new contents'
+        self.doc.save()
+
+        self.assertNotEqual(self.etag(folder_url), folder_etag)
+        self.assertNotEqual(self.etag(topic_url), topic_etag)
+
+    def test_put_if_match(self):
+        url = '/api/v1/topics/{}/'.format(self.topic.uuid)
+        etag = self.etag(url)
+        data = {'short_desc': 'renamed', 'full_desc': 'a topic'}
+
+        response = self.client.put(url, data, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.put(url, data, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+
+
+class ResponseCacheTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.folder = Folder.objects.create(name='folder')
+        self.other = Folder.objects.create(name='other')
+        self.doc = Document.objects.create(name='doc', folder=self.folder, contents='contents')
+        self.doc.topics.add(self.topic)
+
+    def get(self, url: str):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_hit_is_one_query(self):
+        url = '/api/v1/folders/{}/'.format(self.folder.uuid)
+        self.assertEqual(self.get(url)['X-Cache'], 'MISS')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.get(url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_change_evicts_affected_entries(self):
+        urls = {
+            'folder': '/api/v1/folders/{}/'.format(self.folder.uuid),
+            'other': '/api/v1/folders/{}/'.format(self.other.uuid),
+            'topic': '/api/v1/topics/{}/'.format(self.topic.uuid),
+        }
+        for url in urls.values():
+            self.get(url)
+
+        self.doc.name = 'renamed'
+        self.doc.save()
+
+        self.assertEqual(self.get(urls['folder'])['X-Cache'], 'MISS')
+        self.assertEqual(self.get(urls['topic'])['X-Cache'], 'MISS')
+        self.assertEqual(self.get(urls['other'])['X-Cache'], 'HIT')
+        self.assertEqual(self.get(urls['folder']).data['documents'][0]['name'], 'renamed')
+
+
+class AsyncUrls:
+    # the async document endpoints, whatever DOCSTORE_ASYNC_VIEWS is set to
+    urlpatterns = [
+        path('api/v1/documents/', async_views.document_list),
+        path('api/v1/documents/<uuid:doc_id>/', async_views.document_detail),
+        path('api/v1/documents/<uuid:doc_id>/contents/', async_views.document_contents),
+    ]
+
+
+@override_settings(ROOT_URLCONF=AsyncUrls)
+class AsyncViewTests(BlobStorageMixin, APITransactionTestCase):
+    """
+    The async views do their database work in worker threads, each with its own
+    connection, which is why the data has to be committed.
+    """
+
+    def setUp(self):
+        self.folder = Folder.objects.create(name='folder')
+        self.doc = Document.objects.create(name='doc.txt', folder=self.folder, contents='some contents')
+
+    async def test_list(self):
+        response = await self.async_client.get('/api/v1/documents/?fields=id,path')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'], [{'id': str(self.doc.uuid), 'path': '/folder/doc.txt'}])
+
+    async def test_detail(self):
+        url = '/api/v1/documents/{}/'.format(self.doc.uuid)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['contents'], 'some contents')
+
+        # unlike Client, AsyncClient takes headers without the HTTP_ prefix
+        response = await self.async_client.get(url, IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = await self.async_client.get('/api/v1/documents/{}/'.format(uuid.uuid4()))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_contents(self):
+        url = '/api/v1/documents/{}/contents/'.format(self.doc.uuid)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join([chunk async for chunk in response.async_streaming_content]), b'some contents')
+
+        response = await self.async_client.get(url, RANGE='bytes=5-12')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in response.async_streaming_content]), b'contents')
+        response = await self.async_client.get(url, RANGE='bytes=5-12', IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join([chunk async for chunk in response.async_streaming_content]), b'some contents')
+
+        response = await self.async_client.post(url)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_instrumented(self):
+        # the queries that the view runs in worker threads count too
+        with self.settings(MIDDLEWARE=['docstore.middleware.InstrumentationMiddleware'] + settings.MIDDLEWARE), \
+                self.assertLogs('docstore.requests', level='INFO') as logs:
+            response = await self.async_client.get('/api/v1/documents/{}/'.format(self.doc.uuid))
+
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries", serialize;dur=[0-9.]+, total;dur=[0-9.]+$')
+        self.assertEqual(json.loads(logs.records[0].getMessage())['status'], 200)
+
+
+class SingleFlightTests(BlobStorageMixin, APITransactionTestCase):
+    """
+    Stampedes of concurrent requests, each from its own thread and database
+    connection, which is why the data has to be committed.
+    """
+
+    CLIENTS = 20
+
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.doc = Document.objects.create(name='doc', contents='contents')
+        self.doc.topics.add(self.topic)
+        singleflight.stats.reset()
+
+    def stampede(self, url: str, build_target: str) -> list:
+        # the output takes long enough to build that every client asks for it
+        # in the meantime.
+        builds = []
+        original = getattr(views, build_target)
+
+        def slow_build():
+            builds.append(1)
+            time.sleep(0.3)
+            return original()
+
+        ready = threading.Barrier(self.CLIENTS)
+        responses = [None] * self.CLIENTS
+
+        def request(index):
+            try:
+                ready.wait()
+                responses[index] = APIClient().get(url)
+            finally:
+                db.connections.close_all()
+
+        with mock.patch.object(views, build_target, slow_build):
+            threads = [threading.Thread(target=request, args=(i,)) for i in range(self.CLIENTS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(len(builds), 1)
+        self.assertEqual({r.status_code for r in responses}, {200})
+        self.assertEqual(len({r.content for r in responses}), 1)
+        self.assertEqual(singleflight.stats.as_dict(), {'built': 1, 'shared': self.CLIENTS - 1})
+        return responses
+
+    def test_document_stampede(self):
+        responses = self.stampede('/api/v1/documents/{}/'.format(self.doc.uuid), 'documents_with_related')
+        self.assertEqual(responses[0].json()['name'], 'doc')
+
+    def test_topic_stampede(self):
+        responses = self.stampede('/api/v1/topics/{}/'.format(self.topic.uuid), 'topics_with_related')
+        self.assertEqual({r['X-Cache'] for r in responses}, {'MISS'})
+
+    def test_new_version_is_not_shared(self):
+        url = '/api/v1/documents/{}/'.format(self.doc.uuid)
+        self.client.get(url)
+        self.doc.name = 'renamed'
+        self.doc.save()
+        self.assertEqual(self.client.get(url).json()['name'], 'renamed')
+
+    def test_waits_for_other_process(self):
+        # a flight in another process holds the lock, so this one waits for
+        # what it publishes instead of building the output.
+        key = singleflight.flight_key(Document, self.doc.pk, 'etag')
+        other = singleflight.CacheLockBackend()
+        self.assertTrue(other.acquire(key))
+        threading.Timer(0.1, other.publish, (key, b'built elsewhere')).start()
+
+        build = mock.Mock(return_value=b'built here')
+        self.assertEqual(singleflight.run(key, build), (b'built elsewhere', True))
+        build.assert_not_called()
+        other.release(key)
+
+    def test_builds_when_other_process_fails(self):
+        key = singleflight.flight_key(Document, self.doc.pk, 'etag')
+        other = singleflight.CacheLockBackend()
+        self.assertTrue(other.acquire(key))
+        threading.Timer(0.1, other.release, (key,)).start()
+
+        self.assertEqual(singleflight.run(key, lambda: b'built here'), (b'built here', False))
+
+
+class CompressionTests(BlobStorageTestCase):
+    def setUp(self):
+        # different for every test, as the blob store is shared by all of them
+        self.contents = '{:s} compressible '.format(self._testMethodName) * 1000
+
+    def is_compressed(self, d) -> bool:
+        encoded = get_blob_storage().open_encoded(d.content_hash)
+        if encoded is not None:
+            encoded[0].close()
+        return encoded is not None
+
+    def get_contents(self, d, **headers) -> tuple:
+        response = self.client.get('/api/v1/documents/{}/contents/'.format(d.uuid), **headers)
+        return response, b''.join(response.streaming_content)
+
+    def test_contents_are_compressed_at_rest(self):
+        with override_settings(DOCSTORE_BLOB_COMPRESSION='gzip'):
+            d = Document.objects.create(name='doc.txt', contents=self.contents)
+            self.assertEqual(d.contents, self.contents)
+            self.assertTrue(self.is_compressed(d))
+
+            response, body = self.get_contents(d, HTTP_ACCEPT_ENCODING='br, gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(int(response['Content-Length']), len(body))
+            self.assertEqual(gzip.decompress(body).decode(), self.contents)
+            response = self.client.get('/api/v1/documents/{}/contents/'.format(d.uuid),
+                                       HTTP_IF_NONE_MATCH=response['ETag'], HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 304)
+
+            # clients that don't accept it, and ranges, get the contents decompressed
+            for headers in ({'HTTP_ACCEPT_ENCODING': 'gzip;q=0'}, {'HTTP_RANGE': 'bytes=0-11', 'HTTP_ACCEPT_ENCODING': 'gzip'}):
+                response, body = self.get_contents(d, **headers)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertTrue(self.contents.encode().startswith(body))
+
+    def test_if_range(self):
+        d = Document.objects.create(name='doc.txt', contents=self.contents)
+        etag = self.get_contents(d)[0]['ETag']
+        response, body = self.get_contents(d, HTTP_RANGE='bytes=0-11', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.contents.encode()[:12])
+
+        # the client's copy is of other contents, so it gets all of the current ones
+        for if_range in ('"{}"'.format(hashlib.sha256(b'other').hexdigest()), 'W/' + etag, response['Last-Modified']):
+            response, body = self.get_contents(d, HTTP_RANGE='bytes=0-11', HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, self.contents.encode())
+
+    def test_compress_blobs(self):
+        d = Document.objects.create(name='doc.txt', contents=self.contents)
+        self.assertFalse(self.is_compressed(d))
+
+        with override_settings(DOCSTORE_BLOB_COMPRESSION='gzip'):
+            call_command('compress_blobs', stdout=io.StringIO())
+            self.assertTrue(self.is_compressed(d))
+        self.assertEqual(Document.objects.get(pk=d.pk).contents, self.contents)
+
+        call_command('compress_blobs', stdout=io.StringIO())
+        self.assertFalse(self.is_compressed(d))
+        self.assertEqual(Document.objects.get(pk=d.pk).contents, self.contents)
+
+
+class BlobGcTests(BlobStorageTestCase):
+    def gc(self, *args) -> str:
+        out = io.StringIO()
+        call_command('gc_blobs', *args, stdout=out)
+        return out.getvalue()
+
+    def test_contents_saved_again_are_kept(self):
+        for compression in (None, 'gzip'):
+            contents = '{} reused '.format(compression) * 1000
+            with self.subTest(compression=compression), override_settings(DOCSTORE_BLOB_COMPRESSION=compression):
+                storage = get_blob_storage()
+                d = Document.objects.create(name='old', contents=contents)
+                d.delete()
+                # as if written long before the grace period
+                long_ago = time.time() - 2 * 3600
+                for path in (storage._path(d.content_hash), storage._gzip_path(d.content_hash)):
+                    if path.exists():
+                        os.utime(path, (long_ago, long_ago))
+                listed = list(storage.list())
+                self.assertIn('Would delete 1 unreferenced blob(s)', self.gc('--dry-run'))
+
+                # the same contents are saved for a document that is not
+                # committed yet, after gc_blobs has listed the blobs.
+                storage.save(io.BytesIO(contents.encode()))
+                with mock.patch.object(type(storage), 'list', lambda storage: iter(listed)):
+                    self.assertIn('Deleted 0 unreferenced blob(s)', self.gc())
+                self.assertTrue(storage.exists(d.content_hash))
+
+    def test_saved_file_is_kept(self):
+        # such as an upload that was written long ago, and is stored just
+        # before gc_blobs runs, but committed after.
+        path = uploads.upload_root() / 'old'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'old upload')
+        long_ago = time.time() - 2 * 3600
+        os.utime(path, (long_ago, long_ago))
+        content_hash = hashlib.sha256(b'old upload').hexdigest()
+        get_blob_storage().save_file(path, content_hash)
+
+        self.assertIn('Deleted 0 unreferenced blob(s)', self.gc())
+        self.assertTrue(get_blob_storage().exists(content_hash))
+
+class StreamingListTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.folder = Folder.objects.create(name='folder')
+        for i in range(5):
+            d = Document.objects.create(name='doc-{:d}'.format(i), folder=self.folder, contents='contents')
+            d.topics.add(self.topic)
+
+    def get_streamed(self, url: str) -> bytes:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_formats_match_paginated_listing(self):
+        expected = self.client.get('/api/v1/documents/').json()['results']
+
+        as_json = json.loads(self.get_streamed('/api/v1/documents/?stream=json'))
+        lines = self.get_streamed('/api/v1/documents/?stream=ndjson').decode().splitlines()
+        as_ndjson = [json.loads(line) for line in lines]
+
+        self.assertEqual(as_json, expected)
+        self.assertEqual(as_ndjson, expected)
+
+    def test_empty(self):
+        self.assertEqual(json.loads(self.get_streamed('/api/v1/documents/?stream=json&folder=none')), [])
+
+    def test_unknown_format(self):
+        response = self.client.get('/api/v1/documents/?stream=xml')
+        self.assertEqual(response.status_code, 400)
+
+
+class SubtreeTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.root = Folder.objects.create(name='root')
+        self.keep = Folder.objects.create(name='keep', parent=self.root)
+        self.gone = Folder.objects.create(name='gone', parent=self.root)
+        self.gone.topics.add(self.topic)
+        parent = self.gone
+        for i in range(3):
+            parent = Folder.objects.create(name='sub-{:d}'.format(i), parent=parent)
+            for j in range(4):
+                d = Document.objects.create(name='doc-{:d}'.format(j), folder=parent, contents='contents')
+                d.topics.add(self.topic)
+        self.kept_doc = Document.objects.create(name='kept', folder=self.keep, contents='contents')
+        self.kept_doc.topics.add(self.topic)
+
+    def assertDeleted(self):
+        self.assertEqual(set(Folder.objects.values_list('name', flat=True)), {'root', 'keep'})
+        self.assertEqual(list(Document.objects.all()), [self.kept_doc])
+        self.assertEqual(list(self.topic.documents.all()), [self.kept_doc])
+        self.assertFalse(FolderClosure.objects.exclude(descendant__in=[self.root, self.keep]).exists())
+
+    def test_delete(self):
+        version = Topic.objects.get(pk=self.topic.pk).version
+        response = self.client.delete('/api/v1/folders/{}/'.format(self.gone.uuid))
+        self.assertEqual(response.status_code, 204)
+        self.assertDeleted()
+        self.assertGreater(Topic.objects.get(pk=self.topic.pk).version, version)
+
+    @override_settings(DOCSTORE_JOBS_IN_PROCESS=False)
+    def test_background_delete(self):
+        response = self.client.delete('/api/v1/folders/{}/?background=1'.format(self.gone.uuid))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], Job.PENDING)
+        self.assertEqual(response.data['total'], 16)
+
+        with mock.patch('docstore.jobs.DELETE_BATCH_SIZE', 5):
+            self.assertTrue(jobs.run(response.data['id']))
+
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.data['status'], Job.DONE)
+        self.assertEqual(response.data['completed'], 16)
+        self.assertDeleted()
+
+    def test_move(self):
+        sub = Folder.objects.get(name='sub-0')
+        response = self.client.post('/api/v1/folders/{}/move/'.format(sub.uuid), {'parent': str(self.keep.uuid)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['path'], '/root/keep/sub-0')
+        self.assertEqual(Document.objects.get(name='doc-0', folder__name='sub-2').path, '/root/keep/sub-0/sub-1/sub-2/doc-0')
+        self.assertTrue(FolderClosure.objects.filter(ancestor=self.keep, descendant__name='sub-2').exists())
+        self.assertFalse(FolderClosure.objects.filter(ancestor=self.gone, descendant__name='sub-2').exists())
+
+    def test_tree(self):
+        response = self.client.get('/api/v1/folders/{}/tree/?depth=2&counts=1'.format(self.root.uuid))
+        self.assertEqual(response.status_code, 200)
+        tree = response.data
+        self.assertEqual([c['name'] for c in tree['children']], ['gone', 'keep'])
+        gone, keep = tree['children']
+        self.assertEqual(keep['document_count'], 1)
+        self.assertEqual([c['name'] for c in gone['children']], ['sub-0'])
+        self.assertEqual(gone['children'][0]['children'], [])
+
+    def test_move_into_self(self):
+        sub = Folder.objects.get(name='sub-2')
+        response = self.client.post('/api/v1/folders/{}/move/'.format(self.gone.uuid), {'parent': str(sub.uuid)}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CounterTests(BlobStorageTestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        self.root = Folder.objects.create(name='root')
+        self.a = Folder.objects.create(name='a', parent=self.root)
+        self.b = Folder.objects.create(name='b', parent=self.a)
+        self.other = Folder.objects.create(name='other', parent=self.root)
+
+    def assertCounted(self):
+        # the incrementally kept counters match counting from scratch
+        self.assertEqual(counters.rebuild(dry_run=True), {Folder: 0, Topic: 0})
+
+    def test_counters_follow_changes(self):
+        response = self.client.post('/api/v1/documents/', {
+            'name': 'doc', 'folder': str(self.b.uuid), 'topics': [str(self.topic.uuid)], 'contents': 'xxxx',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        doc = Document.objects.get(name='doc')
+        self.assertCounted()
+
+        response = self.client.get('/api/v1/folders/')
+        root = next(f for f in response.json()['results'] if f['name'] == 'root')
+        self.assertEqual((root['document_count'], root['subtree_document_count'], root['subtree_document_size']), (0, 1, 4))
+        response = self.client.get('/api/v1/topics/')
+        self.assertEqual(response.json()['results'][0]['document_size'], 4)
+
+        # resized and moved in one bulk update, then unlinked
+        response = self.client.put('/api/v1/documents/bulk/', [
+            {'id': str(doc.uuid), 'name': 'doc', 'folder': str(self.other.uuid), 'topics': [], 'contents': 'xx'},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertCounted()
+        self.assertEqual(Topic.objects.get(pk=self.topic.pk).document_count, 0)
+
+        doc = Document.objects.get(pk=doc.pk)
+        self.topic.documents.add(doc)
+        doc.folder = self.b
+        doc.contents = 'xxxxxxxx'
+        doc.save()
+        self.assertCounted()
+
+        # the whole subtree moves under another folder
+        response = self.client.post('/api/v1/folders/{}/move/'.format(self.a.uuid), {'parent': str(self.other.uuid)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertCounted()
+        self.assertEqual(Folder.objects.get(pk=self.other.pk).subtree_document_size, 8)
+
+        # saving a folder leaves its counters alone
+        stale = Folder.objects.get(pk=self.b.pk)
+        Document.objects.create(name='new', folder=self.b, contents='x')
+        stale.name = 'renamed'
+        stale.save()
+        self.assertCounted()
+
+        self.client.delete('/api/v1/documents/{}/'.format(doc.uuid))
+        self.assertCounted()
+        self.client.delete('/api/v1/folders/{}/'.format(self.a.uuid))
+        self.assertCounted()
+        self.assertEqual(Folder.objects.get(pk=self.root.pk).subtree_document_count, 0)
+
+    def test_rebuild_counters(self):
+        Document.objects.create(name='doc', folder=self.b, contents='xxxx').topics.add(self.topic)
+        Folder.objects.filter(pk=self.a.pk).update(subtree_document_count=5)
+        Topic.objects.update(document_size=0)
+
+        out = io.StringIO()
+        call_command('rebuild_counters', stdout=out)
+        self.assertIn('Repaired the counters of 1 folders', out.getvalue())
+        self.assertCounted()
+
+
+class ArchiveTests(BlobStorageTestCase):
+    def setUp(self):
+        topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        root = Folder.objects.create(name='root')
+        root.topics.add(topic)
+        sub = Folder.objects.create(name='sub', parent=root)
+        Folder.objects.create(name='other')
+        d = Document.objects.create(name='doc', folder=sub, contents='the contents')
+        d.topics.add(topic)
+        Document.objects.create(name='loose', contents='')
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def snapshot(self):
+        return (
+            sorted(Topic.objects.values_list('uuid', 'short_desc', 'full_desc', 'document_count')),
+            sorted(Folder.objects.values_list('uuid', 'path', 'parent__uuid', 'topics__uuid', 'subtree_document_size')),
+            sorted(Document.objects.values_list('uuid', 'path', 'content_hash', 'size', 'topics__uuid', 'search_vector')),
+            FolderClosure.objects.count(),
+        )
+
+    def roundtrip(self, name: str, blob_root: str):
+        before = self.snapshot()
+        path = '{}/{}'.format(self.dir, name)
+        call_command('export_docstore', path, stdout=io.StringIO())
+
+        out = io.StringIO()
+        with override_settings(DOCSTORE_BLOB_ROOT=blob_root):
+            # one row per batch, so that every folder's parent is in an
+            # earlier one.
+            call_command('import_docstore', path, '--clear', '--batch-size', '1', stdout=out)
+            self.assertIn('Imported 1 topic(s), 3 folder(s) and 2 document(s)', out.getvalue())
+            self.assertEqual(self.snapshot(), before)
+            self.assertEqual(Document.objects.get(name='doc').contents, 'the contents')
+
+    def test_ndjson(self):
+        self.roundtrip('export.ndjson', self._blob_root)
+
+    def test_tar(self):
+        # the contents come from the archive, into an empty blob store
+        self.roundtrip('export.tar.gz', self.dir + '/blobs')
+
+    def test_import_refuses_existing_data(self):
+        with self.assertRaises(CommandError):
+            call_command('import_docstore', self.dir + '/missing.ndjson', stdout=io.StringIO())
+
+
+class UploadTests(BlobStorageTestCase):
+    def put_chunk(self, upload_id, data: bytes, start: int, total='*'):
+        content_range = 'bytes {:d}-{:d}/{}'.format(start, start + len(data) - 1, total)
+        return self.client.put('/api/v1/uploads/{}/'.format(upload_id), data,
+                               content_type='application/octet-stream', HTTP_CONTENT_RANGE=content_range)
+
+    def test_chunked_upload(self):
+        folder = Folder.objects.create(name='folder')
+        response = self.client.post('/api/v1/uploads/', {}, format='json')
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.data['id']
+
+        self.assertEqual(self.put_chunk(upload_id, b'hello ', 0).data['offset'], 6)
+        # a chunk that was already sent, such as after a lost response
+        response = self.put_chunk(upload_id, b'hello ', 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get('/api/v1/uploads/{}/'.format(upload_id)).data['offset'], 6)
+        self.assertEqual(self.put_chunk(upload_id, b'world', 6, total=11).data['size'], 11)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/uploads/{}/commit/'.format(upload_id),
+                                        {'name': 'upload.txt', 'folder': str(folder.uuid)}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['size'], 11)
+        d = Document.objects.get(uuid=response.data['id'])
+        self.assertEqual(d.contents, 'hello world')
+        self.assertFalse(uploads.upload_path(upload_id).exists())
+
+        # committing again gives the same document instead of another one
+        response = self.client.post('/api/v1/uploads/{}/commit/'.format(upload_id), {}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], str(d.uuid))
+        self.assertEqual(Document.objects.count(), 1)
+
+    def test_upload_to_existing_document(self):
+        d = Document.objects.create(name='doc.txt', contents='old')
+        upload = Upload.objects.create(document=d, size=8)
+        self.put_chunk(upload.pk, b'new ', 0)
+        # the next chunk is handled as if by another process, without the hash so far
+        uploads._hashes.clear()
+        self.put_chunk(upload.pk, b'text', 4)
+
+        response = self.client.post('/api/v1/uploads/{}/commit/'.format(upload.pk), HTTP_IF_MATCH='"{}-1"'.format(d.uuid))
+        self.assertEqual(response.status_code, 412)
+
+        etag = self.client.get('/api/v1/documents/{}/'.format(d.uuid))['ETag']
+        response = self.client.post('/api/v1/uploads/{}/commit/'.format(upload.pk), HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        d.refresh_from_db()
+        self.assertEqual(d.contents, 'new text')
+        self.assertEqual(d.content_hash, hashlib.sha256(b'new text').hexdigest())
+
+    def test_chunk_without_content_length(self):
+        url = '/api/v1/uploads/{}/'.format(Upload.objects.create().pk)
+        # as with chunked transfer-encoding, which Django can't read under WSGI
+        response = self.client.put(url, HTTP_CONTENT_RANGE='bytes 0-4/*')
+        self.assertEqual(response.status_code, 411)
+
+        def put_asgi(body: bytes):
+            return async_to_sync(self.async_client.request)(
+                method='PUT', path=url, headers=[(b'content-range', b'bytes 0-4/*')], _body_file=io.BytesIO(body))
+
+        self.assertEqual(put_asgi(b'hello!').status_code, 400)
+        self.assertEqual(put_asgi(b'hell').status_code, 400)
+        response = put_asgi(b'hello')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['offset'], 5)
+
+    def test_chunk_beaten_to_its_offset(self):
+        upload_id = self.client.post('/api/v1/uploads/', {}, format='json').data['id']
+        receive_chunk = uploads.receive_chunk
+
+        def receive_slowly(*args):
+            # another chunk for the same offset arrives in the meantime
+            with mock.patch.object(uploads, 'receive_chunk', receive_chunk):
+                self.assertEqual(self.put_chunk(upload_id, b'faster', 0).status_code, 200)
+            return receive_chunk(*args)
+
+        with mock.patch.object(uploads, 'receive_chunk', receive_slowly):
+            response = self.put_chunk(upload_id, b'slower', 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(uploads.upload_path(upload_id).read_bytes(), b'faster')
+        self.assertEqual(sorted(p.name for p in uploads.upload_root().iterdir()), [upload_id])
+
+    def test_upload_written_after_failed_commit(self):
+        upload_id = self.client.post('/api/v1/uploads/', {}, format='json').data['id']
+        self.put_chunk(upload_id, b'hello', 0)
+        with mock.patch.object(views.DocumentSerializer, 'save', side_effect=db.DatabaseError):
+            with self.assertRaises(db.DatabaseError):
+                self.client.post('/api/v1/uploads/{}/commit/'.format(upload_id), {'name': 'upload.txt'}, format='json')
+
+        # the rolled back commit stored the contents so far, which must not
+        # change as the upload goes on.
+        self.assertEqual(self.put_chunk(upload_id, b' world', 5).data['offset'], 11)
+        with get_blob_storage().open(hashlib.sha256(b'hello').hexdigest()) as f:
+            self.assertEqual(f.read(), b'hello')
+
+    def test_delete_folder_of_uploaded_documents(self):
+        folder = Folder.objects.create(name='folder')
+        upload_id = self.client.post('/api/v1/uploads/', {}, format='json').data['id']
+        self.put_chunk(upload_id, b'uploaded', 0, total=8)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/uploads/{}/commit/'.format(upload_id),
+                                        {'name': 'upload.txt', 'folder': str(folder.uuid)}, format='json')
+        d = Document.objects.get(uuid=response.data['id'])
+        # and another upload to the same document, still in progress
+        pending = Upload.objects.create(document=d)
+        self.put_chunk(pending.pk, b'more', 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/v1/folders/{}/'.format(folder.uuid))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Document.objects.exists())
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(uploads.upload_path(pending.pk).exists())
+
+
+@override_settings(MIDDLEWARE=['docstore.middleware.InstrumentationMiddleware'] + settings.MIDDLEWARE)
+class InstrumentationTests(BlobStorageTestCase):
+    def test_server_timing(self):
+        Topic.objects.create(short_desc='topic', full_desc='a topic')
+        with self.assertLogs('docstore.requests', level='INFO') as logs:
+            response = self.client.get('/api/v1/topics/')
+
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="1 queries", serialize;dur=[0-9.]+, total;dur=[0-9.]+$')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'docstore.views.TopicListView')
+        self.assertEqual(record['queries'], 1)
+
+    def test_listing_serialization_is_timed(self):
+        Document.objects.create(name='doc', contents='')
+        to_representation = FastDocumentListingSerializer.to_representation
+
+        def slow_to_representation(serializer, row):
+            time.sleep(0.05)
+            return to_representation(serializer, row)
+
+        with mock.patch.object(FastDocumentListingSerializer, 'to_representation', slow_to_representation), \
+                self.assertLogs('docstore.requests', level='INFO') as logs:
+            response = self.client.get('/api/v1/documents/')
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertGreaterEqual(json.loads(logs.records[0].getMessage())['serialize_ms'], 50)
+
+    def test_async_capable(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(asyncio.iscoroutinefunction(InstrumentationMiddleware(get_response)))
+        self.assertFalse(asyncio.iscoroutinefunction(InstrumentationMiddleware(lambda request: None)))
+
+
+class BenchmarkTests(BlobStorageTestCase):
+    def test_every_endpoint_succeeds(self):
+        call_command('generate_dataset', topics=3, roots=2, depth=2, fanout=2, documents=20, stdout=io.StringIO())
+        self.assertEqual(benchmarks.uncovered_routes(urls.urlpatterns), [])
+
+        results = benchmarks.Runner(iterations=1, warmup=0).run_all()
+        self.assertEqual(set(results), {e.name for e in benchmarks.ENDPOINTS})
+        for name, result in results.items():
+            self.assertLess(result['status'], 300, name)
+        # the writes were all rolled back
+        self.assertEqual(Document.objects.count(), 20)
+
+    def test_fast_serializers_match(self):
+        call_command('generate_dataset', topics=3, roots=2, depth=2, fanout=2, documents=20, stdout=io.StringIO())
+        # raises if any listing's fast path gives different output
+        results = benchmarks.serializer_throughput(rows=100, iterations=1)
+        self.assertEqual(results['document_listing']['rows'], 20)
+
+        response = self.client.get('/api/v1/documents/?fields=id,topics')
+        d = Document.objects.order_by('id').first()
+        self.assertEqual(response.json()['results'][0], {
+            'id': str(d.uuid), 'topics': [str(t.uuid) for t in d.topics.all()],
+        })
+
+
+@override_settings(DOCSTORE_READ_REPLICAS=['replica'])
+class ReplicaRoutingTests(BlobStorageTestCase):
+    def test_router(self):
+        router = routers.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Topic))
+        with routers.replica_reads():
+            self.assertEqual(router.db_for_read(Topic), 'replica')
+            self.assertEqual(router.db_for_write(Topic), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'docstore'))
+
+    def test_read_only_views_use_replica(self):
+        topic = Topic.objects.create(short_desc='topic', full_desc='a topic')
+        picked = []
+
+        def db_for_read(router, model, **hints):
+            picked.append(routers._replica.get())
+            return None
+
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', db_for_read):
+            self.client.get('/api/v1/topics/{}/'.format(topic.uuid))
+            self.assertEqual(set(picked), {'replica'})
+
+            picked.clear()
+            self.client.put('/api/v1/topics/{}/'.format(topic.uuid), {'short_desc': 'x', 'full_desc': 'y'}, format='json')
+            self.assertEqual(set(picked), {None})
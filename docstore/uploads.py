@@ -0,0 +1,207 @@
+"""
+Chunked, resumable uploads of document contents.
+
+Contents too large to send in one request are uploaded in pieces. The client
+creates an upload, PUTs the contents to it a chunk at a time with each chunk
+starting where the one before it ended, and then commits it. Committing
+attaches the contents to a new or existing document in one transaction.
+
+Each chunk's body is read a piece at a time into a file of its own in the
+upload directory, so no request holds more than CHUNK_SIZE bytes of it in
+memory however large the chunk. That happens outside any transaction, and the
+upload is only locked to check the chunk's offset before its body is read, and
+again to append the chunk to the upload's file afterwards, if nothing else was
+appended at that offset in the meantime. If a chunk is cut off part way
+through it is dropped, and the client sends it again from the offset that the
+upload reports.
+
+The contents are hashed as they are written. A running hash can't be kept in
+the database, so each process keeps the hashes of the uploads it has written
+to recently. A chunk that is handled by another process, or after a restart,
+first catches that process up by hashing what is already in the file.
+
+The upload directory is DOCSTORE_UPLOAD_ROOT, or a directory in the blob root
+if that is not set. Every process that handles uploads must see the same
+directory. A finished upload is copied into the blob store, so that its file
+can still be written to, and committed again, if the commit that stored it is
+rolled back.
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Tuple
+
+from django.conf import settings
+
+from .models import Upload
+from .storage import CHUNK_SIZE, get_blob_storage
+
+# how many uploads' running hashes each process keeps
+MAX_HASHES = 256
+
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    def __init__(self, expected: int):
+        super().__init__("Must be {:d}, the number of bytes received so far.".format(expected))
+        self.expected = expected
+
+
+def upload_root() -> Path:
+    if settings.DOCSTORE_UPLOAD_ROOT is not None:
+        return Path(settings.DOCSTORE_UPLOAD_ROOT)
+    return Path(settings.DOCSTORE_BLOB_ROOT) / '.uploads'
+
+
+def upload_path(upload_id) -> Path:
+    return upload_root() / str(upload_id)
+
+
+def check_chunk(upload: Upload, offset: int, length: int):
+    """
+    Check that a chunk of length bytes can be appended to the upload, which
+    must be locked for update. offset is where the client says the chunk
+    starts, and must be the number of bytes received so far.
+    """
+    if upload.status != Upload.PENDING:
+        raise UploadError("The upload has already been committed.")
+    _resume(upload)
+    if offset != upload.received:
+        raise OffsetMismatch(upload.received)
+    if upload.size is not None and offset + length > upload.size:
+        raise UploadError("The chunk goes past the end of the upload's {:d} bytes.".format(upload.size))
+
+
+def receive_chunk(upload_id, stream: BinaryIO, length: int) -> Path:
+    """
+    Read a chunk of length bytes from stream into a file of its own, and give
+    its path for append_chunk(). This is meant to be called outside of any
+    transaction, so that a slow client does not keep the upload locked.
+    """
+    path = upload_root() / '{}.{}'.format(upload_id, uuid.uuid4().hex)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    try:
+        with open(path, 'xb') as f:
+            while written < length:
+                chunk = stream.read(min(CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+        if written < length:
+            raise UploadError("The request body ended after {:d} of {:d} bytes.".format(written, length))
+        # only possible without a Content-Length, which would have been checked
+        if stream.read(1):
+            raise UploadError("The request body is longer than the chunk's {:d} bytes.".format(length))
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def append_chunk(upload: Upload, chunk_path: Path, offset: int):
+    """
+    Append a chunk read by receive_chunk() to the upload, which must be locked
+    for update. The chunk is checked again first, as another one may have been
+    appended at the same offset while it was being read. Its file is removed
+    either way.
+    """
+    try:
+        length = chunk_path.stat().st_size
+        check_chunk(upload, offset, length)
+        path = upload_path(upload.pk)
+        digest = _take_hash(upload, path)
+        with open(path, 'r+b') as f, open(chunk_path, 'rb') as src:
+            # drops anything left over from an append that did not finish
+            f.seek(offset)
+            f.truncate()
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                digest.update(chunk)
+    finally:
+        chunk_path.unlink(missing_ok=True)
+
+    upload.received += length
+    upload.save(update_fields=['received', 'updated_at'])
+    _keep_hash(upload.pk, upload.received, digest)
+
+
+def finish(upload: Upload) -> Tuple[str, int]:
+    """
+    Store the contents of a completely received upload in the blob store, and
+    give their hash and size. The upload's file is left for discard() to remove
+    once the document has been saved.
+    """
+    path = _resume(upload)
+    if upload.size is not None and upload.received != upload.size:
+        raise UploadError("Only {:d} of the upload's {:d} bytes have been received.".format(upload.received, upload.size))
+
+    digest = _take_hash(upload, path)
+    with open(path, 'r+b') as f:
+        f.truncate(upload.received)
+    blob_hash = digest.hexdigest()
+    get_blob_storage().save_file(path, blob_hash)
+    return blob_hash, upload.received
+
+
+def discard(upload_id):
+    with _hashes_lock:
+        _hashes.pop(upload_id, None)
+    try:
+        os.remove(upload_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def _resume(upload: Upload) -> Path:
+    path = upload_path(upload.pk)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab'):
+        pass
+
+    # the file can be shorter than the upload says if it was lost, or a crash
+    # kept the end of it from reaching the disk. The client has to send the
+    # rest again, from the end of what is left.
+    on_disk = path.stat().st_size
+    if on_disk < upload.received:
+        upload.received = on_disk
+        upload.save(update_fields=['received', 'updated_at'])
+    return path
+
+
+def _take_hash(upload: Upload, path: Path):
+    with _hashes_lock:
+        entry = _hashes.pop(upload.pk, None)
+    if entry is not None and entry[0] == upload.received:
+        return entry[1]
+
+    # not hashed by this process, or hashed past a chunk that was then rolled
+    # back, so start over from what is in the file.
+    digest = hashlib.sha256()
+    remaining = upload.received
+    with open(path, 'rb') as f:
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise UploadError("The upload's file was cut short while it was being read.")
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+def _keep_hash(upload_id, offset: int, digest):
+    with _hashes_lock:
+        _hashes[upload_id] = (offset, digest)
+        while len(_hashes) > MAX_HASHES:
+            _hashes.popitem(last=False)
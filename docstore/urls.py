@@ -1,12 +1,35 @@
+from django.conf import settings
 from django.urls import path
 
+from . import async_views
 from .views import *
 
+if settings.DOCSTORE_ASYNC_VIEWS:
+    document_list = async_views.document_list
+    document_detail = async_views.document_detail
+    document_contents = async_views.document_contents
+else:
+    document_list = DocumentListView.as_view()
+    document_detail = DocumentDetailView.as_view()
+    document_contents = DocumentContentsView.as_view()
+
 urlpatterns = [
     path('topics/', TopicListView.as_view()),
+    path('topics/bulk/', TopicBulkView.as_view()),
     path('topics/<uuid:topic_id>/', TopicDetailView.as_view()),
     path('folders/', FolderListView.as_view()),
+    path('folders/bulk/', FolderBulkView.as_view()),
     path('folders/<uuid:folder_id>/', FolderDetailView.as_view()),
-    path('documents/', DocumentListView.as_view()),
-    path('documents/<uuid:doc_id>/', DocumentDetailView.as_view()),
+    path('folders/<uuid:folder_id>/tree/', FolderTreeView.as_view()),
+    path('folders/<uuid:folder_id>/move/', FolderMoveView.as_view()),
+    path('documents/', document_list),
+    path('documents/search/', DocumentSearchView.as_view()),
+    path('documents/bulk/', DocumentBulkView.as_view()),
+    path('documents/<uuid:doc_id>/', document_detail),
+    path('documents/<uuid:doc_id>/contents/', document_contents),
+    path('uploads/', UploadListView.as_view()),
+    path('uploads/<uuid:upload_id>/', UploadDetailView.as_view()),
+    path('uploads/<uuid:upload_id>/commit/', UploadCommitView.as_view()),
+    path('jobs/<uuid:job_id>/', JobDetailView.as_view()),
+    path('cache/stats/', CacheStatsView.as_view()),
 ]
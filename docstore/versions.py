@@ -0,0 +1,46 @@
+"""
+Keeps the versions of topics, folders and documents current.
+
+An object's version has to change whenever anything in its detail output
+changes. Those outputs nest each other: a folder includes its documents, and a
+topic includes its folders (with their documents) and its documents. So a
+change to one object also has to bump every object whose output includes it.
+These functions work out who those are and bump them all with set-based
+updates. The ID arguments may be lists or subqueries.
+"""
+
+from django.db.models import Q
+
+from .models import Topic, Folder, Document
+
+
+def topics_changed(topic_ids):
+    Topic.objects.filter(pk__in=topic_ids).touch()
+
+
+def folders_changed(folder_ids, topic_ids=()):
+    """
+    Bump the given folders and every topic that includes them. topic_ids gives
+    any extra topics to bump, such as ones the folders were just unlinked from.
+    """
+    Folder.objects.filter(pk__in=folder_ids).touch()
+
+    linked = Folder.topics.through.objects.filter(folder_id__in=folder_ids).values('topic_id')
+    Topic.objects.filter(Q(pk__in=linked) | Q(pk__in=topic_ids)).touch()
+
+
+def documents_changed(document_ids, folder_ids=(), topic_ids=()):
+    """
+    Bump the given documents, the folders they are in, and every topic that
+    includes either. folder_ids and topic_ids give any extra folders and topics
+    to bump, such as a folder the documents were just moved out of.
+    """
+    Document.objects.filter(pk__in=document_ids).touch()
+
+    containing = Document.objects.filter(pk__in=document_ids).values('folder_id')
+    extra_folders = [f for f in folder_ids if f is not None]
+    folders = Folder.objects.filter(Q(pk__in=containing) | Q(pk__in=extra_folders)).values('pk')
+    folders_changed(folders, topic_ids=topic_ids)
+
+    linked = Document.topics.through.objects.filter(document_id__in=document_ids).values('topic_id')
+    Topic.objects.filter(pk__in=linked).touch()
@@ -1,22 +1,82 @@
+import collections
+import functools
 import uuid
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views import View
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Topic, Folder, Document
+from . import cache, jobs, singleflight, uploads
+from .filters import TOPIC_MODES, filter_by_topics
+from .http import Validators, contents_response, contents_validators, open_contents, parse_content_range
+from .models import Topic, Folder, FolderClosure, Document, Job, Upload
+from .pagination import PaginatedListMixin
+from .renderers import RenderedResponse, dumps
+from .routers import read_from_replica
+from .search import search_documents, snippets
+from .subtrees import MoveError, count_subtree, delete_subtree, folder_tree, move_folder
 from .serializers import *
 
 # Since we are using the rest framework, may want to see if we can use the mixins
 # and APIView generics from DRF instead of manually typing these things out.
 # TODO: check on use of Django REST Framework for view mixins.
 
-class TopicListView(APIView):
+
+# Querysets that prefetch everything their serializers output, so that each
+# endpoint runs a fixed number of queries no matter how many objects it
+# returns. Related objects that are only output as IDs are fetched with only
+# their IDs.
+
+def topic_ids() -> Prefetch:
+    return Prefetch('topics', queryset=Topic.objects.only('id', 'uuid'))
+
+
+def with_related_ids(queryset, *relations, exclude=()):
+    # joins in the objects that the given foreign keys point to, reading only
+    # their IDs, along with every column of the queryset's own model that is
+    # not excluded.
+    fields = [f.name for f in queryset.model._meta.concrete_fields if f.name not in exclude]
+    fields += ['{:s}__uuid'.format(r) for r in relations]
+    return queryset.select_related(*relations).only(*fields)
+
+
+def documents_with_related():
+    return with_related_ids(Document.objects.all(), 'folder', exclude={'search_vector'}).prefetch_related(topic_ids())
+
+
+def folders_with_related():
+    return with_related_ids(Folder.objects.all(), 'parent').prefetch_related(
+        topic_ids(),
+        Prefetch('documents', queryset=documents_with_related()),
+    )
+
+
+def public_id_lookup(model, public_id):
+    """
+    Give the primary key of the object with the given public ID, or None.
+    """
+    return model.objects.filter(uuid=public_id).values_list('pk', flat=True).first()
+
+
+def topics_with_related():
+    return Topic.objects.prefetch_related(
+        Prefetch('folders', queryset=folders_with_related()),
+        Prefetch('documents', queryset=documents_with_related()),
+    )
+
+
+class TopicListView(PaginatedListMixin, APIView):
+    @read_from_replica
     def get(self, request):
-        topics = Topic.objects.values()
-        serializer = TopicListingSerializer(topics, many=True)
-        return Response(serializer.data)
+        topics = FastTopicListingSerializer.select(Topic.objects.all())
+        return self.paginated_response(topics, FastTopicListingSerializer)
 
     def post(self, request):
         serializer = TopicSerializer(data=request.data)
@@ -27,30 +87,51 @@ class TopicListView(APIView):
 
 
 class TopicDetailView(APIView):
+    @read_from_replica
     def get(self, request, topic_id: uuid.UUID):
-        try:
-            t = Topic.objects.get(pk=topic_id)
-        except ObjectDoesNotExist:
+        # the version is read before the rest, so a concurrent write can only
+        # make the ETag older than the body and never newer.
+        validators = Validators.for_version(Topic.objects, topic_id)
+        if validators is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        not_modified = validators.precondition_response(request)
+        if not_modified is not None:
+            return not_modified
 
-        serializer = TopicSerializer(t)
-        return Response(serializer.data)
+        def build():
+            return dumps(TopicSerializer(topics_with_related().get(pk=validators.pk)).data)
 
-    def put(self, request, topic_id: uuid.UUID):
         try:
-            t = Topic.objects.get(pk=topic_id)
+            body, hit = cache.cached_detail(Topic, validators.pk, validators.etag, build)
         except ObjectDoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        
-        serializer = TopicSerializer(t, data=request.data)
-        if serializer.is_valid():
+
+        response = RenderedResponse(body, headers={'X-Cache': 'HIT' if hit else 'MISS'})
+        return validators.apply(response)
+
+    def put(self, request, topic_id: uuid.UUID):
+        with transaction.atomic():
+            # the version stays locked until the update commits, so nothing
+            # can change in between the If-Match check and the write.
+            validators = Validators.for_version(Topic.objects.select_for_update(), topic_id)
+            if validators is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            failed = validators.precondition_response(request)
+            if failed is not None:
+                return failed
+
+            t = topics_with_related().get(pk=validators.pk)
+            serializer = TopicSerializer(t, data=request.data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        validators = Validators.for_version(Topic.objects, topic_id)
+        return validators.apply(Response(serializer.data))
 
     def delete(self, request, topic_id: uuid.UUID):
         try:
-            t = Topic.objects.get(pk=topic_id)
+            t = Topic.objects.get(uuid=topic_id)
         except ObjectDoesNotExist:
             # this isn't actually a problem, DELETE is idempotent and the
             # operation requested by the user has the result as the user would
@@ -61,20 +142,24 @@ class TopicDetailView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class FolderListView(APIView):
+class FolderListView(PaginatedListMixin, APIView):
+    @read_from_replica
     def get(self, request):
         folders = Folder.objects.all()
 
         # TOOD: To simplify, might want to pull out folder search into its own
         # view
-        by_topic = request.query_params.get('topic')
+        by_topics = request.query_params.getlist('topic')
+        topic_mode = request.query_params.get('topic_mode', 'all')
 
-        # TODO: allow multiple topic filters
-        if by_topic:
-            folders = folders.filter(topics__short_desc=by_topic)
+        if topic_mode not in TOPIC_MODES:
+            return Response({'topic_mode': ["Must be one of: {:s}.".format(', '.join(TOPIC_MODES))]}, status=status.HTTP_400_BAD_REQUEST)
+        by_topics = [t for t in by_topics if t]
+        if by_topics:
+            folders = filter_by_topics(folders, by_topics, topic_mode)
 
-        serializer = FolderListingSerializer(folders, many=True)
-        return Response(serializer.data)
+        folders = FastFolderListingSerializer.select(folders)
+        return self.paginated_response(folders, FastFolderListingSerializer)
 
     def post(self, request):
         serializer = FolderSerializer(data=request.data)
@@ -85,63 +170,171 @@ class FolderListView(APIView):
 
 
 class FolderDetailView(APIView):
+    @read_from_replica
     def get(self, request, folder_id: uuid.UUID):
-        try:
-            f = Folder.objects.get(pk=folder_id)
-        except ObjectDoesNotExist:
+        validators = Validators.for_version(Folder.objects, folder_id)
+        if validators is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        not_modified = validators.precondition_response(request)
+        if not_modified is not None:
+            return not_modified
 
-        serializer = FolderSerializer(f)
-        return Response(serializer.data)
+        def build():
+            return dumps(FolderSerializer(folders_with_related().get(pk=validators.pk)).data)
 
-    def put(self, request, folder_id: uuid.UUID):
         try:
-            f = Folder.objects.get(pk=folder_id)
+            body, hit = cache.cached_detail(Folder, validators.pk, validators.etag, build)
         except ObjectDoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        
-        serializer = FolderSerializer(f, data=request.data)
-        if serializer.is_valid():
+
+        response = RenderedResponse(body, headers={'X-Cache': 'HIT' if hit else 'MISS'})
+        return validators.apply(response)
+
+    def put(self, request, folder_id: uuid.UUID):
+        with transaction.atomic():
+            validators = Validators.for_version(Folder.objects.select_for_update(), folder_id)
+            if validators is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            failed = validators.precondition_response(request)
+            if failed is not None:
+                return failed
+
+            f = folders_with_related().get(pk=validators.pk)
+            serializer = FolderSerializer(f, data=request.data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        validators = Validators.for_version(Folder.objects, folder_id)
+        return validators.apply(Response(serializer.data))
 
     def delete(self, request, folder_id: uuid.UUID):
-        try:
-            f = Folder.objects.get(pk=folder_id)
-        except ObjectDoesNotExist:
+        pk = public_id_lookup(Folder, folder_id)
+        if pk is None:
             # this isn't actually a problem, DELETE is idempotent and the
             # operation requested by the user has the result as the user would
             # expect, so just return 204.
             return Response(status=status.HTTP_204_NO_CONTENT)
-        
-        f.delete()
+
+        # large subtrees can take longer to delete than a request should, so
+        # clients may ask for it to be done in the background and poll the job
+        # for progress instead.
+        if request.query_params.get('background'):
+            job = jobs.start('delete_subtree', total=count_subtree(pk), folder_id=pk)
+            location = '/api/v1/jobs/{}/'.format(job.pk)
+            return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+
+        delete_subtree(pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class DocumentListView(APIView):
+class FolderTreeView(APIView):
+    # the folder and all of its subfolders, nested, in one query. Documents
+    # are left out, though their number in each folder can be asked for.
+    @read_from_replica
+    def get(self, request, folder_id: uuid.UUID):
+        depth = request.query_params.get('depth')
+        if depth is not None:
+            try:
+                depth = int(depth)
+            except ValueError:
+                depth = -1
+            if depth < 0:
+                return Response({'depth': ["Must be a non-negative integer."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        tree = folder_tree(folder_id, depth=depth, with_counts=bool(request.query_params.get('counts')))
+        if tree is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(tree)
+
+
+class FolderMoveView(APIView):
+    # moves a folder without reading or writing anything but the folder and
+    # the ancestry and paths of its subtree, unlike a PUT of the whole folder.
+    def post(self, request, folder_id: uuid.UUID):
+        serializer = FolderMoveSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        parent = serializer.validated_data['parent']
+
+        pk = public_id_lookup(Folder, folder_id)
+        if pk is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        try:
+            move_folder(pk, parent.pk if parent is not None else None)
+        except ObjectDoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        except MoveError as e:
+            return Response({'parent': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+
+        f = with_related_ids(Folder.objects.all(), 'parent').prefetch_related(topic_ids()).get(pk=pk)
+        return Response(FolderListingSerializer(f).data)
+
+
+class DocumentListView(PaginatedListMixin, APIView):
+    @read_from_replica
     def get(self, request):
         docs = Document.objects.all()
 
         # TODO: To simplify, might want to pull out doc search into its own
         # view
         by_folder = request.query_params.get('folder')
-        by_topic = request.query_params.get('topic')
+        by_folder_id = request.query_params.get('folder_id')
+        by_topics = request.query_params.getlist('topic')
+        topic_mode = request.query_params.get('topic_mode', 'all')
 
-        # TODO: make folder filter match on ANY folder in the full path
+        # folder filters match documents anywhere beneath the folder, not just
+        # its direct children. Both are a single lookup on the ancestry table.
         # TODO: allow folder filter to give a full path, or glob
         if by_folder is not None:
             if by_folder == '':
                 docs = docs.filter(folder__isnull=True)
             else:
-                docs = docs.filter(folder__name=by_folder)
-
-        # TODO: allow multiple topic filters
-        if by_topic:
-            docs = docs.filter(topics__short_desc=by_topic)
-
-        serializer = DocumentSerializer(docs, many=True)
-        return Response(serializer.data)
+                subtrees = FolderClosure.objects.filter(ancestor__name=by_folder).values('descendant_id')
+                docs = docs.filter(folder__in=subtrees)
+
+        if by_folder_id:
+            try:
+                folder_id = uuid.UUID(by_folder_id)
+            except ValueError:
+                return Response({'folder_id': ["Must be a valid UUID."]}, status=status.HTTP_400_BAD_REQUEST)
+            subtree = FolderClosure.objects.filter(ancestor__uuid=folder_id).values('descendant_id')
+            docs = docs.filter(folder__in=subtree)
+
+        if topic_mode not in TOPIC_MODES:
+            return Response({'topic_mode': ["Must be one of: {:s}.".format(', '.join(TOPIC_MODES))]}, status=status.HTTP_400_BAD_REQUEST)
+        by_topics = [t for t in by_topics if t]
+        if by_topics:
+            docs = filter_by_topics(docs, by_topics, topic_mode)
+
+        # listings leave out contents unless they are explicitly asked for, and
+        # only the columns that will actually be output are read from the db.
+        fields = None
+        by_fields = request.query_params.get('fields')
+        if by_fields:
+            fields = [f.strip() for f in by_fields.split(',') if f.strip()]
+            unknown = set(fields) - set(DocumentSerializer.Meta.fields)
+            if unknown:
+                msg = "Unknown field(s): {:s}".format(', '.join(sorted(unknown)))
+                return Response({'fields': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+
+        if fields is None or 'contents' not in fields:
+            docs = FastDocumentListingSerializer.select(docs, fields)
+            return self.paginated_response(docs, FastDocumentListingSerializer, fields=fields)
+
+        # contents come from the blob store through the model, so listings
+        # with them go through DRF's serializer.
+        columns = {'id', 'content_hash'} | {f for f in fields if f not in ('id', 'topics', 'contents')}
+        if 'id' in fields:
+            columns.add('uuid')
+        if 'folder' in fields:
+            docs = docs.select_related('folder')
+            columns.add('folder__uuid')
+        docs = docs.only(*columns)
+        if 'topics' in fields:
+            docs = docs.prefetch_related(topic_ids())
+
+        return self.paginated_response(docs, DocumentSerializer, fields=fields)
 
     def post(self, request):
         serializer = DocumentSerializer(data=request.data)
@@ -152,30 +345,48 @@ class DocumentListView(APIView):
 
 
 class DocumentDetailView(APIView):
+    @read_from_replica
     def get(self, request, doc_id: uuid.UUID):
-        try:
-            d = Document.objects.get(pk=doc_id)
-        except ObjectDoesNotExist:
+        validators = Validators.for_version(Document.objects, doc_id)
+        if validators is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        not_modified = validators.precondition_response(request)
+        if not_modified is not None:
+            return not_modified
 
-        serializer = DocumentSerializer(d)
-        return Response(serializer.data)
+        # a burst of requests for the same version of a popular document
+        # builds its output once; see docstore.singleflight.
+        def build():
+            return dumps(DocumentSerializer(documents_with_related().get(pk=validators.pk)).data)
 
-    def put(self, request, doc_id: uuid.UUID):
         try:
-            d = Document.objects.get(pk=doc_id)
+            body, _ = singleflight.run(singleflight.flight_key(Document, validators.pk, validators.etag), build)
         except ObjectDoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        
-        serializer = DocumentSerializer(d, data=request.data)
-        if serializer.is_valid():
+
+        return validators.apply(RenderedResponse(body))
+
+    def put(self, request, doc_id: uuid.UUID):
+        with transaction.atomic():
+            validators = Validators.for_version(Document.objects.select_for_update(), doc_id)
+            if validators is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            failed = validators.precondition_response(request)
+            if failed is not None:
+                return failed
+
+            d = documents_with_related().get(pk=validators.pk)
+            serializer = DocumentSerializer(d, data=request.data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             serializer.save()
-            return Response(serializer.data)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        validators = Validators.for_version(Document.objects, doc_id)
+        return validators.apply(Response(serializer.data))
 
     def delete(self, request, doc_id: uuid.UUID):
         try:
-            d = Document.objects.get(pk=doc_id)
+            d = Document.objects.get(uuid=doc_id)
         except ObjectDoesNotExist:
             # this isn't actually a problem, DELETE is idempotent and the
             # operation requested by the user has the result as the user would
@@ -184,3 +395,360 @@ class DocumentDetailView(APIView):
         
         d.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class DocumentSearchView(APIView):
+    default_limit = 20
+    max_limit = 100
+
+    @read_from_replica
+    def get(self, request):
+        q = request.query_params.get('q', '').strip()
+        if not q:
+            return Response({'q': ["This parameter is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            return Response({'limit': ["A valid integer is required."]}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), self.max_limit)
+
+        # results are ranked rather than paginated, so only the best matches up
+        # to the limit are returned.
+        results = search_documents(documents_with_related(), q)
+        docs = list(results[:limit])
+        # read from the same database as the results, which may be a replica
+        for d, snippet in zip(docs, snippets(docs, q, db=results.db)):
+            d.snippet = snippet
+
+        serializer = DocumentSearchResultSerializer(docs, many=True)
+        return Response(serializer.data)
+
+
+# Contents are served by a plain Django view rather than an APIView, as they are
+# raw bytes and not something for DRF's renderers and content negotiation to
+# handle.
+class DocumentContentsView(View):
+    @read_from_replica
+    def get(self, request, doc_id: uuid.UUID):
+        try:
+            d = Document.objects.only('id', 'name', 'content_hash', 'size', 'updated_at').get(uuid=doc_id)
+        except ObjectDoesNotExist:
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+        f, encoding, size = open_contents(request, d)
+        validators = contents_validators(d, encoding)
+        not_modified = validators.precondition_response(request)
+        if not_modified is not None:
+            f.close()
+            patch_vary_headers(not_modified, ['Accept-Encoding'])
+            return not_modified
+
+        response = contents_response(request, f, size, d.name, encoding=encoding, validators=validators)
+        return validators.apply(response)
+
+
+class JobDetailView(APIView):
+    def get(self, request, job_id: uuid.UUID):
+        try:
+            job = Job.objects.get(pk=job_id)
+        except ObjectDoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(JobSerializer(job).data)
+
+
+class UploadListView(APIView):
+    def post(self, request):
+        serializer = UploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        upload = serializer.save()
+        location = '/api/v1/uploads/{}/'.format(upload.pk)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers={'Location': location})
+
+
+class UploadDetailView(APIView):
+    """
+    GET gives the offset that the next chunk must start at, which is where a
+    client resumes an interrupted upload from. PUT appends a chunk: the body is
+    the chunk's raw bytes, and its Content-Range header gives where in the
+    contents they go, such as 'bytes 0-1048575/*'. The size at the end may be
+    given instead of the '*' once it is known. A chunk that does not start at
+    the offset gets a 409 response, and is not written, as does one that is
+    beaten to the offset by another chunk while its body is being received.
+
+    Content-Length can be left out, as with chunked transfer-encoding, and
+    the body is then read until it has the bytes that Content-Range covers.
+    That only works under ASGI, as Django can't read a WSGI request's body
+    without a Content-Length, so under WSGI such a chunk gets a 411 response.
+    """
+
+    def get(self, request, upload_id: uuid.UUID):
+        try:
+            upload = Upload.objects.get(pk=upload_id)
+        except ObjectDoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return Response(UploadSerializer(upload).data)
+
+    def put(self, request, upload_id: uuid.UUID):
+        content_range = parse_content_range(request.headers.get('Content-Range', ''))
+        if content_range is None:
+            msg = "Must be given as 'bytes <first>-<last>/<size>', where the size may be '*'."
+            return Response({'Content-Range': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+        start, end, total = content_range
+        length = end - start + 1
+        content_length = request.headers.get('Content-Length')
+        if content_length is None:
+            # Django reads no more of a WSGI request's body than its
+            # Content-Length says, so without one the body would seem empty.
+            if isinstance(request._request, WSGIRequest):
+                msg = "Must be given, unless the server runs under ASGI."
+                return Response({'Content-Length': [msg]}, status=status.HTTP_411_LENGTH_REQUIRED)
+        elif content_length != str(length):
+            msg = "Must cover exactly the bytes of the request body."
+            return Response({'Content-Range': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+
+        # the upload is only locked to check the chunk before its body is read,
+        # and to append it afterwards, not while a slow client sends it.
+        try:
+            with transaction.atomic():
+                upload = Upload.objects.select_for_update().filter(pk=upload_id).first()
+                if upload is None:
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+                if total is not None and total != upload.size:
+                    if upload.size is not None:
+                        msg = "The upload's size is {:d} bytes.".format(upload.size)
+                        return Response({'Content-Range': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+                    upload.size = total
+                    upload.save(update_fields=['size', 'updated_at'])
+                uploads.check_chunk(upload, start, length)
+
+            # the body is read from Django's request a piece at a time. It never
+            # goes through DRF's parsers, or DRF's stream, which is None when
+            # there is no Content-Length.
+            chunk_path = uploads.receive_chunk(upload_id, request._request, length)
+
+            with transaction.atomic():
+                upload = Upload.objects.select_for_update().filter(pk=upload_id).first()
+                if upload is None:
+                    chunk_path.unlink(missing_ok=True)
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+                uploads.append_chunk(upload, chunk_path, start)
+        except uploads.OffsetMismatch as e:
+            return Response({'offset': [str(e)]}, status=status.HTTP_409_CONFLICT)
+        except uploads.UploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(UploadSerializer(upload).data)
+
+    def delete(self, request, upload_id: uuid.UUID):
+        with transaction.atomic():
+            Upload.objects.filter(pk=upload_id).delete()
+            transaction.on_commit(functools.partial(uploads.discard, upload_id))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadCommitView(APIView):
+    """
+    Attaches the contents of a finished upload to its document. An upload
+    created without a document makes a new one, and the request body gives
+    its name, folder and topics the same as when creating a document, but
+    without its contents. Committing an upload that has already been committed
+    gives its document again, so that a client that never saw the response can
+    safely retry.
+    """
+
+    def post(self, request, upload_id: uuid.UUID):
+        with transaction.atomic():
+            upload = Upload.objects.select_for_update().filter(pk=upload_id).first()
+            if upload is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            if upload.status == Upload.COMMITTED:
+                d = documents_with_related().get(pk=upload.document_id)
+                return Response(DocumentListingSerializer(d).data)
+
+            serializer = None
+            if upload.document_id is not None:
+                doc_id = Document.objects.filter(pk=upload.document_id).values_list('uuid', flat=True).get()
+                validators = Validators.for_version(Document.objects.select_for_update(), doc_id)
+                failed = validators.precondition_response(request)
+                if failed is not None:
+                    return failed
+            else:
+                serializer = DocumentSerializer(data=request.data, fields=DocumentListingSerializer.Meta.fields)
+                if not serializer.is_valid():
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                content_hash, size = uploads.finish(upload)
+            except uploads.UploadError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            if serializer is None:
+                d = Document.objects.get(pk=upload.document_id)
+                d.content_hash, d.size = content_hash, size
+                d.save()
+            else:
+                d = serializer.save(content_hash=content_hash, size=size)
+
+            upload.document = d
+            upload.status = Upload.COMMITTED
+            upload.save(update_fields=['document', 'status', 'updated_at'])
+            transaction.on_commit(functools.partial(uploads.discard, upload.pk))
+
+        d = documents_with_related().get(pk=d.pk)
+        response = Response(DocumentListingSerializer(d).data)
+        if serializer is not None:
+            response.status_code = status.HTTP_201_CREATED
+            return response
+        return Validators.for_version(Document.objects, d.uuid).apply(response)
+
+
+class CacheStatsView(APIView):
+    # hit/miss counts of the detail response cache, and how many detail
+    # outputs were built or shared by single flight, for the process that
+    # handles the request.
+    def get(self, request):
+        return Response(dict(cache.stats.as_dict(), single_flight=singleflight.stats.as_dict()))
+
+
+class BulkView(APIView):
+    """
+    Base for the bulk endpoints. Each takes a JSON array and applies all of it
+    in a single transaction: POST creates every item, PUT updates every item
+    (each must include its 'id', and no ID may be given twice), and DELETE
+    deletes every ID in the array.
+
+    If any item is invalid nothing is written, and the 400 response has one
+    entry per item in the request, which is empty for the items that were
+    valid.
+    """
+
+    serializer_class = None
+    listing_serializer_class = None
+    max_items = 1000
+
+    def get_update_queryset(self):
+        return self.serializer_class.Meta.model.objects.all()
+
+    def get_listing_queryset(self):
+        return self.serializer_class.Meta.model.objects.all()
+
+    def delete_objects(self, pks):
+        self.serializer_class.Meta.model.objects.filter(pk__in=pks).delete()
+
+    def check_items(self, items):
+        if not isinstance(items, list):
+            return {'non_field_errors': ["Expected a list of items."]}
+        if len(items) > self.max_items:
+            return {'non_field_errors': ["At most {:d} items may be sent at once.".format(self.max_items)]}
+        return None
+
+    def parse_ids(self, values):
+        ids = []
+        errors = []
+        for value in values:
+            try:
+                ids.append(uuid.UUID(str(value)))
+                errors.append({})
+            except ValueError:
+                ids.append(None)
+                errors.append({'id': ["Must be a valid UUID."]})
+        return ids, errors
+
+    def listing(self, instances):
+        # re-fetch what was written with the listing querysets so that the
+        # response costs a fixed number of queries.
+        by_pk = self.get_listing_queryset().in_bulk([i.pk for i in instances])
+        serializer = self.listing_serializer_class([by_pk[i.pk] for i in instances], many=True)
+        return serializer.data
+
+    def post(self, request):
+        errors = self.check_items(request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.serializer_class(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            instances = serializer.save()
+        return Response(self.listing(instances), status=status.HTTP_201_CREATED)
+
+    def put(self, request):
+        errors = self.check_items(request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        ids, errors = self.parse_ids(item.get('id') if isinstance(item, dict) else None for item in request.data)
+        by_id = self.get_update_queryset().in_bulk([i for i in ids if i is not None], field_name='uuid')
+        # an object updated twice in one request would only keep whichever
+        # item came last, so that is refused rather than guessed at.
+        given = collections.Counter(ids)
+        for i, err in zip(ids, errors):
+            if i is None:
+                continue
+            if i not in by_id:
+                err['id'] = ["Not found."]
+            elif given[i] > 1:
+                err['id'] = ["Given more than once."]
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.serializer_class([by_id[i] for i in ids], data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            instances = serializer.save()
+        return Response(self.listing(instances))
+
+    def delete(self, request):
+        errors = self.check_items(request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        ids, errors = self.parse_ids(request.data)
+        if any(errors):
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        model = self.serializer_class.Meta.model
+        with transaction.atomic():
+            existing = dict(model.objects.filter(uuid__in=ids).values_list('uuid', 'pk'))
+            self.delete_objects(existing.values())
+
+        # as with the single-item endpoints, deleting something that does not
+        # exist is not an error.
+        return Response([{'id': str(i), 'deleted': i in existing} for i in ids])
+
+
+class TopicBulkView(BulkView):
+    serializer_class = TopicSerializer
+    listing_serializer_class = TopicListingSerializer
+
+
+class FolderBulkView(BulkView):
+    serializer_class = FolderSerializer
+    listing_serializer_class = FolderListingSerializer
+
+    def get_update_queryset(self):
+        return Folder.objects.select_related('parent')
+
+    def get_listing_queryset(self):
+        return with_related_ids(Folder.objects.all(), 'parent').prefetch_related(topic_ids())
+
+    def delete_objects(self, pks):
+        for pk in pks:
+            delete_subtree(pk)
+
+
+class DocumentBulkView(BulkView):
+    serializer_class = DocumentSerializer
+    listing_serializer_class = DocumentListingSerializer
+
+    def get_update_queryset(self):
+        return Document.objects.select_related('folder')
+
+    def get_listing_queryset(self):
+        return documents_with_related()
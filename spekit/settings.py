@@ -54,6 +54,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-request query counts and timings; see docstore/middleware.py. First, so
+# that it measures everything else.
+if os.environ.get('DOCSTORE_INSTRUMENTATION', '') == '1':
+    MIDDLEWARE.insert(0, 'docstore.middleware.InstrumentationMiddleware')
+
 ROOT_URLCONF = 'spekit.urls'
 
 TEMPLATES = [
@@ -134,12 +139,170 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Django REST framework
+# JSON is rendered with orjson; see docstore/renderers.py.
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'docstore.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Document contents storage
+# Contents are kept out of the database in a content-addressed blob store; see
+# docstore/storage.py for the available backends.
+
+DOCSTORE_BLOB_STORAGE = 'docstore.storage.LocalBlobStorage'
+
+DOCSTORE_BLOB_ROOT = os.environ.get('DOCSTORE_BLOB_ROOT', BASE_DIR / 'blobs')
+
+# Set to 'gzip' to store new contents compressed. Contents that are already
+# stored are converted with the compress_blobs command.
+
+DOCSTORE_BLOB_COMPRESSION = os.environ.get('DOCSTORE_BLOB_COMPRESSION') or None
+
+# Where the chunks of uploads in progress are kept; see docstore/uploads.py.
+# None keeps them in a directory in DOCSTORE_BLOB_ROOT. Every process that
+# serves the API must see the same directory.
+
+DOCSTORE_UPLOAD_ROOT = os.environ.get('DOCSTORE_UPLOAD_ROOT')
+
+# Text search configuration used for document full-text search on Postgres.
+
+DOCSTORE_SEARCH_CONFIG = 'english'
+
+# Caches
+# Topic and folder detail responses are cached in the cache named by
+# DOCSTORE_RESPONSE_CACHE (None turns this off); see docstore/cache.py. The
+# local-memory backend evicts least recently used entries once MAX_ENTRIES is
+# reached. Any other Django cache backend may be configured in its place to
+# share the cache between processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'docstore': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'docstore-responses',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('DOCSTORE_CACHE_MAX_ENTRIES', 2000)),
+        },
+    },
+}
+
+DOCSTORE_RESPONSE_CACHE = 'docstore'
+
+# Concurrent requests for the same version of a topic, folder or document wait
+# for one of them to build its detail output; see docstore/singleflight.py.
+# Requests in different processes are coordinated through the backend, which
+# with CacheLockBackend is the cache named by DOCSTORE_SINGLE_FLIGHT_CACHE.
+# That has to be a cache shared between the processes, such as memcached or
+# Redis, for them to coordinate; the local-memory one only covers the threads
+# of each process. None coordinates threads only.
+
+DOCSTORE_SINGLE_FLIGHT_BACKEND = 'docstore.singleflight.CacheLockBackend'
+
+DOCSTORE_SINGLE_FLIGHT_CACHE = os.environ.get('DOCSTORE_SINGLE_FLIGHT_CACHE', 'default')
+
+# Serve the document endpoints with the async views in docstore/async_views.py.
+# Only worth it under ASGI, where spekit/asgi.py turns this on.
+
+DOCSTORE_ASYNC_VIEWS = os.environ.get('DOCSTORE_ASYNC_VIEWS', '') == '1'
+
+# Run background jobs on a thread of the process that starts them. Turn this
+# off to leave them to the run_jobs management command instead; see
+# docstore/jobs.py.
+
+DOCSTORE_JOBS_IN_PROCESS = os.environ.get('DOCSTORE_JOBS_IN_PROCESS', '1') == '1'
+
+# Requests slower than this are logged as warnings by the instrumentation
+# middleware, and profiled when sampled. Profiling is off unless the sample
+# rate (a fraction of requests, 0 to 1) is set.
+
+DOCSTORE_SLOW_REQUEST_MS = int(os.environ.get('DOCSTORE_SLOW_REQUEST_MS', 500))
+
+DOCSTORE_PROFILE_SAMPLE_RATE = float(os.environ.get('DOCSTORE_PROFILE_SAMPLE_RATE', 0))
+
+DOCSTORE_PROFILE_DIR = os.environ.get('DOCSTORE_PROFILE_DIR', BASE_DIR / 'profiles')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'docstore': {
+            'handlers': ['console'],
+            'level': os.environ.get('DOCSTORE_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# the version indexes carry their other columns along for index-only scans on
+# Postgres; other databases (SQLite, in tests) just get a plain index.
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
 CORS_ALLOWED_ORIGINS = [
     "https://www.dekarrin.com"
 ]
 
 import dj_database_url
-db_from_env = dj_database_url.config(conn_max_age=500)
+
+# Seconds that a database connection is kept open for reuse by later requests.
+DOCSTORE_DB_CONN_MAX_AGE = int(os.environ.get('DOCSTORE_DB_CONN_MAX_AGE', 500))
+
+db_from_env = dj_database_url.config(conn_max_age=DOCSTORE_DB_CONN_MAX_AGE)
 DATABASES['default'].update(db_from_env)
 
+# Read replicas, as a space-separated list of database URLs. The read-only views
+# read from one of them, picked at random for each request, and everything else
+# uses the default database; see docstore/routers.py. Tests do not create
+# databases for them.
+for i, url in enumerate(os.environ.get('DATABASE_REPLICA_URLS', '').split()):
+    DATABASES['replica_{:d}'.format(i)] = dict(
+        dj_database_url.parse(url, conn_max_age=DOCSTORE_DB_CONN_MAX_AGE),
+        TEST={'MIRROR': 'default'},
+    )
+
+DOCSTORE_READ_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica_')]
+
+DATABASE_ROUTERS = ['docstore.routers.ReplicaRouter']
+
+# Connection pooling. Each worker process, and each thread that the async views
+# hand database work to, holds its own connections, which adds up to more than
+# Postgres should have open. Put PgBouncer in front of it in transaction
+# pooling mode and set DOCSTORE_DB_POOLER=pgbouncer, which turns off what
+# transaction pooling cannot support:
+#
+#   - server-side cursors, which QuerySet.iterator() (and so the streamed
+#     listings) would otherwise use and which only live as long as the
+#     transaction they were opened in.
+#   - per-connection settings sent when connecting, as PgBouncer hands each
+#     transaction whatever server connection is free. Set the statement
+#     timeout on the database role instead:
+#
+#       ALTER ROLE spekitdev SET statement_timeout = '30s';
+#
+# CONN_MAX_AGE then only keeps the connection to PgBouncer open, which is
+# cheap, while PgBouncer limits the number of connections to Postgres itself.
+DOCSTORE_DB_POOLER = os.environ.get('DOCSTORE_DB_POOLER', '')
+
+# Longest a single statement may run before Postgres cancels it, in
+# milliseconds, so that a runaway query cannot hold on to a connection and its
+# locks indefinitely. 0 turns it off, which long migrations and imports may
+# need: DOCSTORE_DB_STATEMENT_TIMEOUT=0 python manage.py migrate.
+DOCSTORE_DB_STATEMENT_TIMEOUT = int(os.environ.get('DOCSTORE_DB_STATEMENT_TIMEOUT', 30000))
+
+for db in DATABASES.values():
+    if 'postgresql' not in db['ENGINE']:
+        continue
+    if DOCSTORE_DB_POOLER == 'pgbouncer':
+        db['DISABLE_SERVER_SIDE_CURSORS'] = True
+    elif DOCSTORE_DB_STATEMENT_TIMEOUT:
+        db.setdefault('OPTIONS', {})['options'] = '-c statement_timeout={:d}'.format(DOCSTORE_DB_STATEMENT_TIMEOUT)
+
 STATIC_ROOT = BASE_DIR / 'staticfiles'